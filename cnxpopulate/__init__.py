@@ -5,14 +5,30 @@
 # Public License version 3 (AGPLv3).
 # See LICENCE.txt for details.
 # ###
+import os
+import mmap
+import shutil
+import tempfile
 from io import BytesIO, StringIO
 try:
     from collections.abc import MutableMapping, MutableSequence
 except ImportError:
     from collections import MutableMapping, MutableSequence
+try:
+    # In Python 2 a memoryview can't be made of an mmap, a buffer can.
+    _view = buffer
+except NameError:
+    def _view(obj, offset=0, size=None):
+        view = memoryview(obj)
+        if size is None:
+            return view[offset:]
+        return view[offset:offset + size]
 import lxml.etree
 
 from . import kadabra
+from .abstracts import insert_abstract
+from .parsers import _generate_xpath_func
+from .lookups import LicenseTable, get_license_table, normalize_url
 
 
 __all__ = (
@@ -30,22 +46,11 @@ DOCUMENT_TYPES = (
     COLLECTION_XML,
     COLLECTION_HTML,
     )
-
-
-def _generate_xpath_func(xml_doc, default_namespace_name='base'):
-    """Generates an easy to work with xpath function."""
-    nsmap = xml_doc.nsmap.copy()
-    try:
-        nsmap[default_namespace_name] = nsmap.pop(None)
-    except KeyError:
-        # There isn't a default namespace.
-        pass
-    if "http://cnx.rice.edu/mdml/0.4" in nsmap.values():
-        # Fixes an issue where the namespace is defined twice, once in the
-        #   document tag and again in the metadata tag.
-        nsmap['md4'] = "http://cnx.rice.edu/mdml/0.4"
-        nsmap['md'] = "http://cnx.rice.edu/mdml"
-    return lambda xpth: xml_doc.xpath(xpth, namespaces=nsmap)
+# File data larger than this (in bytes) is spooled to a temporary file
+#   rather than held in memory.
+FILE_DATA_SPOOL_SIZE = 16 * 1024 * 1024
+# Size of the chunks used when copying file data.
+CHUNK_SIZE = 64 * 1024
 
 
 class Abstract:
@@ -63,6 +68,15 @@ class Abstract:
         return "<{} - [{}] '{}...'>".format(self.__class__.__name__,
                                             self.id, self.text[:10])
 
+    def save(self, cursor, abstract_index=None):
+        """Insert the abstract using ``cursor`` and set its ``id``.
+        When an ``abstracts.AbstractIndex`` is given as ``abstract_index``
+        a stored abstract of the same text is reused instead.
+        Returns the ``id``.
+        """
+        self.id = insert_abstract(cursor, self.text, abstract_index)
+        return self.id
+
 
 class License:
     """A license entry"""
@@ -84,28 +98,45 @@ class Licenses:
     """A collection of ``License`` objects. This object is a singleton
     that is created at runtime. The data for this singleton is populated
     on first use. It is done this way because license data is constant.
+    The data is loaded from ``source``, which is either a psycopg2
+    connection or the path to a JSON file of licenses
+    (see ``lookups.LicenseTable``).
     """
 
-    def __init__(self):
-        self._is_cached = False
-        self._licenses = []
+    def __init__(self, source=None):
+        self.source = source
+        self.clear()
 
     @property  # Read-only property
     def licenses(self):
         return self._licenses
 
-    def _populate_cache(self):
-        raise NotImplemented
+    def clear(self):
+        """Invalidate the cache."""
+        self._is_cached = False
+        self._licenses = []
+        self._index = {}
+
+    def populate(self, table):
+        """Populate the cache from a ``lookups.LicenseTable``."""
+        self._licenses = [License(**license) for license in table]
+        self._index = dict([(normalize_url(l.url), l,)
+                            for l in self._licenses])
         self._is_cached = True
 
+    def _populate_cache(self):
+        if self.source is None:
+            raise RuntimeError("No license source has been configured.")
+        elif isinstance(self.source, basestring):
+            table = LicenseTable.from_json(self.source)
+        else:
+            table = get_license_table(self.source)
+        self.populate(table)
+
     def retrieve_by_url(self, url):
         if not self._is_cached:
             self._populate_cache()
-        try:
-            license = [l for l in self.licenses if l.url == url][0]
-        except IndexError:
-            license = None
-        return license
+        return self._index.get(normalize_url(url))
 
 licenses = Licenses()
 
@@ -229,16 +260,117 @@ class Metadata(MutableMapping):
         return len(self._data) + len(self._special_attrs)
 
 
-class FileData(BytesIO):
-    """A file object representation that can be controlled."""
+class FileData(object):
+    """A file object representation that can be controlled.
+    The data is held in memory until it grows beyond ``max_size`` bytes,
+    at which point it is spooled to a temporary file. Alternatively the
+    data can be backed by an existing file (see ``from_path``).
+    Data on disk is memory-mapped to provide zero-copy views of it
+    (see ``view``), which are used to hash, sniff and upload the data
+    without reading it into memory. Data in memory (which is smaller than
+    ``max_size``) is viewed through a copy made once per change.
+    """
     id = None
 
-    # FIXME Do not store the bytes in memory, otherwise this is going to
-    #       consume the system.
-    # TODO Allow initialization from a filesystem file reference. This will
-    #      allow the object to remain thin before persistence in the database.
     # TODO Save the file as soon as possible. But find a way to rollback.
 
+    def __init__(self, data='', max_size=FILE_DATA_SPOOL_SIZE):
+        self.max_size = max_size
+        self._file = BytesIO()
+        self._on_disk = False
+        self._mmap = None
+        self._value = None
+        if data:
+            self.write(data)
+            self.seek(0)
+
+    @classmethod
+    def from_path(cls, path):
+        """Initializes the data from the file at ``path``, which is
+        read as needed rather than copied.
+        """
+        obj = cls.__new__(cls)
+        obj.max_size = None
+        obj._file = open(path, 'rb')
+        obj._on_disk = True
+        obj._mmap = None
+        obj._value = None
+        return obj
+
+    @property
+    def is_spooled(self):
+        """Tells whether the data is on disk."""
+        return self._on_disk
+
+    @property
+    def size(self):
+        """The size of the data in bytes."""
+        position = self._file.tell()
+        self._file.seek(0, os.SEEK_END)
+        size = self._file.tell()
+        self._file.seek(position)
+        return size
+
+    def write(self, data):
+        self._value = None
+        self._file.write(data)
+        if not self._on_disk and self._file.tell() > self.max_size:
+            self._rollover()
+
+    def _rollover(self):
+        """Move the data from memory to a temporary file."""
+        position = self._file.tell()
+        spooled = tempfile.TemporaryFile()
+        self._file.seek(0)
+        shutil.copyfileobj(self._file, spooled, CHUNK_SIZE)
+        spooled.seek(position)
+        self._file.close()
+        self._file = spooled
+        self._on_disk = True
+
+    def view(self, offset=0, size=None):
+        """A read-only view of ``size`` bytes of the data from ``offset``,
+        or of the rest of the data when ``size`` is None. Data on disk is
+        viewed through a memory map rather than read.
+        """
+        if self._on_disk:
+            self._file.flush()
+            length = self.size
+            if not length:
+                return _view(b'')
+            if self._mmap is None or len(self._mmap) != length:
+                # Views of a previous mapping keep it open.
+                self._mmap = mmap.mmap(self._file.fileno(), length,
+                                       access=mmap.ACCESS_READ)
+            data = self._mmap
+        else:
+            if self._value is None:
+                self._value = self._file.getvalue()
+            data = self._value
+        if size is None:
+            return _view(data, offset)
+        return _view(data, offset, size)
+
+    def iter_views(self, chunk_size=CHUNK_SIZE):
+        """Generate consecutive views of the data,
+        each of at most ``chunk_size`` bytes.
+        """
+        length = self.size
+        for offset in range(0, length, chunk_size):
+            yield self.view(offset, min(chunk_size, length - offset))
+
+    def close(self):
+        self._mmap = None
+        self._value = None
+        self._file.close()
+
+    def __getattr__(self, name):
+        # Delegate the file object interface to the underlying file.
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
 
 class File:
     """A file associated with a document. This could be the document's
@@ -267,7 +399,16 @@ class File:
         if encoding is None:
             encoding = kadabra.guess_encoding(fb)
         fb.seek(0)  # Just in case...
-        self._data = FileData(fb.read())
+        # Copy in chunks, so that large buffers are spooled to disk
+        #   rather than read into memory as a whole.
+        self._data = FileData()
+        shutil.copyfileobj(fb, self._data, CHUNK_SIZE)
+
+    def attach_path(self, path):
+        """Attach the file at ``path`` as the file data, without copying
+        or reading it (see ``FileData.from_path``).
+        """
+        self._data = FileData.from_path(path)
 
     @classmethod
     def from_file_buffer(cls, fb, filename, mimetype=None, encoding=None):
@@ -275,19 +416,31 @@ class File:
         obj.attach_file_buffer(fb, encoding=encoding)
         return obj
 
+    @classmethod
+    def from_path(cls, path, filename=None, mimetype=None):
+        if filename is None:
+            filename = os.path.basename(path)
+        obj = cls(filename, mimetype=mimetype)
+        obj.attach_path(path)
+        return obj
+
 
 class Files(MutableSequence):
-    """A collection of file objects associated with documents."""
+    """A collection of file objects associated with documents.
+    The files are indexed by filename, which makes lookups and membership
+    checks by filename constant time. A filename can only be used once.
+    Note, the index is only kept up to date with changes made through
+    this object, so don't rename a file while it is in here.
+    """
 
-    def __init__(self, files=[]):
-        self._files = files
+    def __init__(self, files=()):
+        self._files = []
+        self._index = {}
+        for file in files:
+            self.append(file)
 
     def retrieve_by_filename(self, filename):
-        try:
-            file = [f for f in self._files if f.filename == filename][0]
-        except IndexError:
-            file = None
-        return file
+        return self._index.get(filename)
 
     def retrieve_data_by_filename(self, filename):
         file = self.retrieve_by_filename(filename)
@@ -297,32 +450,43 @@ class Files(MutableSequence):
             data = None
         return data
 
+    def _check_filename(self, value, replacing=None):
+        existing = self._index.get(value.filename)
+        if existing is not None and existing is not replacing:
+            raise ValueError("A file named '{}' already exists." \
+                             .format(value.filename))
+
     # Abstract Base Class (ABC) methods
 
     def __getitem__(self, index):
         return self._files[index]
 
     def __setitem__(self, index, value):
-        # TODO Check for existance of the file.
-        self._files.insert(index, value)
+        existing = self._files[index]
+        self._check_filename(value, replacing=existing)
+        del self._index[existing.filename]
+        self._files[index] = value
+        self._index[value.filename] = value
 
     def __delitem__(self, index):
-        del self._files[index]
+        file = self._files.pop(index)
+        del self._index[file.filename]
 
     def __len__(self):
         return len(self._files)
 
     def insert(self, index, value):
-        self.__setitem__(index, value)
+        self._check_filename(value)
+        self._files.insert(index, value)
+        self._index[value.filename] = value
 
     # ABC method override(s)
 
     def __contains__(self, value):
-        if isinstance(value, str) \
-           and self.retrieve_by_filename(value) is not None:
-            return True
-        else:
-            return super(Files, self).__contains__(value)
+        if isinstance(value, (str, type(u''),)):
+            return value in self._index
+        filename = getattr(value, 'filename', None)
+        return self._index.get(filename) is value
 
 
 class Collection:
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""Interning of abstracts, so that identical abstract text is only
+stored once in the ``abstracts`` table. Boilerplate abstracts repeat
+across many modules and across every version of a collection.
+"""
+import hashlib
+
+from .blobs import HASH_ALGORITHM, DigestIndex
+
+
+__all__ = ('hash_text', 'insert_abstract', 'AbstractIndex',)
+
+# Number of abstracts kept in-process by default.
+CACHE_SIZE = 10000
+
+
+def hash_text(text):
+    """Hash the abstract ``text``. Returns the hex digest."""
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return hashlib.new(HASH_ALGORITHM, text).hexdigest()
+
+
+def insert_abstract(cursor, text, abstract_index=None):
+    """Insert the abstract ``text`` into the ``abstracts`` table, or reuse
+    a stored abstract of the same text when an ``AbstractIndex`` is given
+    as ``abstract_index``. Returns the ``abstractid``.
+    """
+    if abstract_index is not None:
+        return abstract_index.insert_abstract(cursor, text)
+    cursor.execute("INSERT INTO abstracts (abstract) "
+                   "VALUES (%s) "
+                   "RETURNING abstractid;", (text,))
+    return cursor.fetchone()[0]
+
+
+class AbstractIndex(DigestIndex):
+    """An index of abstract text hashes to ``abstracts.abstractid``
+    values, kept in the ``abstract_digests`` table (see ``DigestIndex``).
+    The most recently used ``cache_size`` abstracts are kept in-process.
+    """
+    table = 'abstract_digests'
+    id_column = 'abstractid'
+    references = 'abstracts'
+
+    def __init__(self, cache_size=CACHE_SIZE):
+        super(AbstractIndex, self).__init__(cache_size)
+
+    def insert_abstract(self, cursor, text):
+        """Insert the abstract ``text`` into the ``abstracts`` table,
+        unless identical text is already stored. A missing abstract (None)
+        isn't interned, but inserted as before. Returns the ``abstractid``.
+        """
+        if text is None:
+            return insert_abstract(cursor, text)
+        digest = hash_text(text)
+        abstract_id = self.get(cursor, digest)
+        if abstract_id is None:
+            abstract_id = insert_abstract(cursor, text)
+            recorded_id = self.add(cursor, digest, abstract_id)
+            if recorded_id != abstract_id:
+                self.discard(cursor, abstract_id)
+                abstract_id = recorded_id
+        return abstract_id
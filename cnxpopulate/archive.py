@@ -10,15 +10,28 @@
 import os
 import sys
 import argparse
+import functools
 import logging
 import json
 import uuid
 import zipfile
-from urllib import urlretrieve
+import multiprocessing
+from io import BytesIO
 
 import psycopg2
 
+from .abstracts import AbstractIndex, insert_abstract
 from .parsers import parse_collection_xml, parse_module_xml
+from .pgcopy import allocate_ids, copy_rows
+from .blobs import BlobIndex, hash_file, read_and_hash_file
+from .checkpoint import COLLECTION_DOCUMENT_ID, Checkpoint, FailureLog
+from .lookups import get_license_table
+from .fetch import download, prefetch
+from .fingerprints import Fingerprints, fingerprint_module
+from .metrics import add_instrumentation_arguments, instrument, metrics
+from .parsecache import MAX_SIZE as PARSE_CACHE_SIZE, ParseCache
+from .sources import get_source, open_source
+from .statements import BATCH_SIZE, PreparedStatements
 
 
 DESCRIPTION = __doc__
@@ -26,7 +39,26 @@ DEFAULT_PSYCOPG_CONNECTION_STRING = "dbname=cnxarchive user=cnxarchive " \
                                     "password=cnxarchive host=localhost " \
                                     "port=5432"
 here = os.path.abspath(os.path.dirname(__file__))
+MODULE_FILE_COLUMNS = ('module_ident', 'fileid', 'filename', 'mimetype',)
+# The files of a module directory that are not referenced as resources.
+MODULE_DOCUMENTS = ('index.cnxml', 'index_auto_generated.cnxml',)
 logger = logging.getLogger('populate')
+# Files larger than this (in bytes) are streamed into the database
+#   in chunks rather than read into memory.
+STREAM_THRESHOLD = 16 * 1024 * 1024
+# The connection and settings of a pool worker process,
+#   see ``create_worker_pool``.
+_worker_connection = None
+_worker_blob_index = None
+_worker_abstract_index = None
+_worker_statements = None
+_worker_parse_cache = None
+_worker_stream_threshold = STREAM_THRESHOLD
+_worker_source = None
+_worker_checkpoint = None
+# The run of the collection and the ``CollectionProgress`` loaded for it,
+#   see ``_populate_module_in_worker``.
+_worker_progress = (None, None,)
 
 
 def unpack(zip_file, output_directory=None):
@@ -39,65 +71,275 @@ def unpack(zip_file, output_directory=None):
 
 
 def acquire_content(id, versions=[], host='http://cnx.org',
-                    output_dir=here):
+                    output_dir=here, downloads=1, queue_size=2,
+                    extract=True):
     """Download or use the complete zip for the content at ``id`` for
     the specified ``versions`` from ``host``.
+    Up to ``downloads`` versions are acquired concurrently and at most
+    ``queue_size`` unpacked locations are held ahead of the consumer.
+    The locations are generated in the order of the ``versions``.
+    Interrupted downloads are resumed on the next run.
+    When ``extract`` is false the location of a complete zip is generated
+    rather than unpacking it, unless an unpacked directory is found.
     """
-    for version in versions:
-        download = '{}-{}.complete.zip'.format(id, version)
+    def acquire(version):
+        zip_name = '{}-{}.complete.zip'.format(id, version)
         directory = '{}_{}_complete'.format(id, version)
 
-        zip_location = os.path.join(output_dir, download)
+        zip_location = os.path.join(output_dir, zip_name)
         output_location = os.path.join(output_dir, directory)
         if os.path.exists(output_location):
             logger.debug("Using found directory, '{}'.".format(directory))
+            return output_location
         elif os.path.exists(zip_location):
-            logger.debug("Using found complete zip, '{}'".format(download))
-            unpack(zip_location, output_dir)
+            logger.debug("Using found complete zip, '{}'".format(zip_name))
         else:
             url = "{}/content/{}/{}/complete".format(host, id, version)
             # Download the complete zip
-            zip_file, headers = urlretrieve(url, filename=zip_location)
-            # Unpack it
+            with metrics.timer('download') as measure:
+                download(url, zip_location)
+                measure.bytes = os.path.getsize(zip_location)
+        if not extract:
+            return zip_location
+        # Unpack it
+        with metrics.timer('unzip', bytes=os.path.getsize(zip_location)):
             unpack(zip_location, output_dir)
-        yield output_location
-    raise StopIteration
+        return output_location
+
+    return prefetch(acquire, versions, workers=downloads,
+                    queue_size=queue_size)
 
 
-def populate_from_completezip(location, ident_mappings, psycopg_conn):
-    """Populate the database using an unpacked completezip
-    formated collection.
+def _add_file_digest(cursor, blob_index, digest, file_id):
+    """Record the new file at ``file_id`` in the ``blob_index``, removing
+    it again when a concurrent transaction stored the same content.
+    Returns the ``fileid`` to use.
     """
-    collection_xml_path = os.path.join(location, 'collection.xml')
-    with open(collection_xml_path, 'r') as fp:
-        collection_parts = parse_collection_xml(fp)
-    abstract, license_url, collection_metadata, contents = collection_parts
-    # Fix the uuid value and/or pull it from the ident_mapping
-    try:
-        collection_uuid = ident_mappings[collection_metadata['moduleid']]
-    except (KeyError,):
-        collection_uuid = uuid.uuid4()
-    collection_metadata['uuid'] = str(collection_uuid)
+    recorded_id = blob_index.add(cursor, digest, file_id)
+    if recorded_id != file_id:
+        blob_index.discard(cursor, file_id)
+    return recorded_id
 
-    with psycopg_conn.cursor() as cursor:
+
+def _stream_file(cursor, source, path, blob_index=None):
+    """Insert the contents of the file at ``path`` into the files table
+    by streaming it in fixed-size chunks through ``COPY``, so that the file
+    is never held in memory as a whole. Returns the ``fileid``.
+    """
+    if blob_index is not None:
+        with source.open(path) as fp:
+            digest = hash_file(fp)
+        file_id = blob_index.get(cursor, digest)
+        if file_id is not None:
+            return file_id
+    file_id = allocate_ids(cursor, 'files', 'fileid', 1)[0]
+    copy_rows(cursor, 'files', ('fileid', 'file',),
+              [(file_id, source.blob(path),)])
+    if blob_index is not None:
+        file_id = _add_file_digest(cursor, blob_index, digest, file_id)
+    return file_id
+
+
+def _insert_file(cursor, source, path, blob_index=None,
+                 stream_threshold=STREAM_THRESHOLD):
+    """Insert the contents of the file at ``path`` in the ``source``
+    into the files table.
+    Content already known to the ``blob_index`` is not inserted again.
+    Files larger than ``stream_threshold`` bytes are streamed rather than
+    read into memory; a threshold of None never streams.
+    Returns the ``fileid``.
+    """
+    size = source.getsize(path)
+    with metrics.timer('upload', bytes=size, rows=1):
+        if stream_threshold is not None and size > stream_threshold:
+            return _stream_file(cursor, source, path, blob_index)
+        with source.open(path) as fp:
+            if blob_index is None:
+                data, digest = fp.read(), None
+            else:
+                data, digest = read_and_hash_file(fp)
+        return _insert_file_data(cursor, data, digest, blob_index)
+
+
+def _insert_file_data(cursor, data, digest=None, blob_index=None):
+    """Insert the file contents ``data`` into the files table.
+    Content already known to the ``blob_index`` by its ``digest`` is not
+    inserted again. Returns the ``fileid``.
+    """
+    if blob_index is not None:
+        file_id = blob_index.get(cursor, digest)
+        if file_id is not None:
+            return file_id
+    cursor.execute("INSERT INTO files (file) VALUES (%s) "
+                   "RETURNING fileid;", (psycopg2.Binary(data),))
+    file_id = cursor.fetchone()[0]
+    if blob_index is not None:
+        file_id = _add_file_digest(cursor, blob_index, digest, file_id)
+    return file_id
+
+
+def _insert_module_file(cursor, module_ident, file_id, filename, mimetype):
+    with metrics.timer('insert', rows=1):
+        cursor.execute("INSERT INTO module_files "
+                       "  (module_ident, fileid, filename, mimetype) "
+                       "  VALUES (%s, %s, %s, %s) ",
+                       (module_ident, file_id, filename, mimetype,))
+
+
+def _insert_module_files(cursor, source, module_ident, files, statements,
+                         blob_index=None, stream_threshold=STREAM_THRESHOLD):
+    """Insert the ``files`` of the module at ``module_ident`` and relate
+    them to it, using the ``PreparedStatements`` given as ``statements``.
+    The files and module_files rows are sent in multi-row batches.
+    Each of the ``files`` is a tuple of (filename, mimetype, path, data,
+    digest), where the data is None for a file that is yet to be read.
+    Files larger than ``stream_threshold`` bytes are streamed on their own.
+    """
+    file_ids = []
+    for start in range(0, len(files), statements.batch_size):
+        batch = files[start:start + statements.batch_size]
+        batch_ids = [None] * len(batch)
+        new_files = []
+        # Positions of the new files by digest, for the files of the batch
+        #   that have the same content as one before them.
+        new_digests = {}
+        duplicates = []
+        for i, (filename, mimetype, path, data, digest) in enumerate(batch):
+            if data is None:
+                size = source.getsize(path)
+                if stream_threshold is not None and size > stream_threshold:
+                    batch_ids[i] = _insert_file(cursor, source, path,
+                                                blob_index, stream_threshold)
+                    continue
+                with metrics.timer('read', bytes=size):
+                    with source.open(path) as fp:
+                        if blob_index is None:
+                            data, digest = fp.read(), None
+                        else:
+                            data, digest = read_and_hash_file(fp)
+            if blob_index is not None:
+                batch_ids[i] = blob_index.get(cursor, digest)
+                if batch_ids[i] is not None:
+                    continue
+                if digest in new_digests:
+                    duplicates.append((i, new_digests[digest],))
+                    continue
+                new_digests[digest] = len(new_files)
+            new_files.append((i, data, digest,))
+
+        new_ids = allocate_ids(cursor, 'files', 'fileid', len(new_files))
+        with metrics.timer('upload', rows=len(new_files)) as measure:
+            measure.bytes = sum([len(data) for i, data, digest in new_files])
+            statements.insert(cursor, 'files', ('fileid', 'file',),
+                              [(file_id, psycopg2.Binary(data),)
+                               for file_id, (i, data, digest)
+                               in zip(new_ids, new_files)])
+        for file_id, (i, data, digest) in zip(new_ids, new_files):
+            if blob_index is not None:
+                file_id = _add_file_digest(cursor, blob_index, digest,
+                                           file_id)
+            batch_ids[i] = file_id
+        for i, position in duplicates:
+            batch_ids[i] = batch_ids[new_files[position][0]]
+        file_ids.extend(batch_ids)
+
+    rows = [(module_ident, file_id, filename, mimetype,)
+            for file_id, (filename, mimetype, path, data, digest)
+            in zip(file_ids, files)]
+    with metrics.timer('insert', rows=len(rows)):
+        statements.insert(cursor, 'module_files', MODULE_FILE_COLUMNS, rows)
+
+
+def _commit(psycopg_conn, *indexes):
+    """Commit the transaction and, along with it, the in-process entries
+    of the ``indexes`` (each a ``blobs.DigestIndex`` or None).
+    """
+    with metrics.timer('commit'):
+        psycopg_conn.commit()
+    for index in indexes:
+        if index is not None:
+            index.commit()
+
+
+def _read_document(source, path):
+    """Read the document at ``path`` in the ``source``.
+    Returns a file object over its contents and the contents' digest.
+    """
+    with metrics.timer('read') as measure:
+        with source.open(path) as fp:
+            data, digest = read_and_hash_file(fp)
+        measure.bytes = len(data)
+    return BytesIO(data), digest
+
+
+def _resolve_resources(source, module_id, resources):
+    """Resolve the module's ``resources`` (pairs of filename and mimetype)
+    against the index of its directory, which is scanned once rather than
+    probing for each file. Missing resources are logged as errors and left
+    out, while files that no resource refers to are logged as orphans.
+    Returns the (filename, mimetype, path) of each resource found.
+    """
+    index = source.index(module_id)
+    files = []
+    missing = []
+    for filename, mimetype in resources:
+        path = index.path(filename)
+        # Resources within a subdirectory are beyond the index.
+        if filename in index or '/' in filename and source.exists(path):
+            files.append((filename, mimetype, path,))
+        else:
+            missing.append(filename)
+    orphans = index.report([filename for filename, mimetype in resources],
+                           MODULE_DOCUMENTS)[1]
+    if missing:
+        logger.error("Missing resources of '{}' in '{}': {}" \
+                     .format(module_id, source.location, ', '.join(missing)))
+    if orphans:
+        logger.info("Unreferenced files of '{}' in '{}': {}" \
+                    .format(module_id, source.location, ', '.join(orphans)))
+    return files
+
+
+def _parse_document(parser, fp, digest, parse_cache=None):
+    """Parse the document ``fp`` with ``parser``, or take the result from
+    the ``ParseCache`` when one is given as ``parse_cache`` and it holds
+    the result for the document's content ``digest``.
+    """
+    if parse_cache is not None:
+        data = parse_cache.get(parser.__name__, digest)
+        if data is not None:
+            metrics.add('parse_cache')
+            return data
+    with metrics.timer('parse'):
+        data = parser(fp)
+    if parse_cache is not None:
+        parse_cache.put(parser.__name__, digest, data)
+    return data
+
+
+def _get_license_id(psycopg_conn, license_url):
+    with metrics.timer('license'):
+        return get_license_table(psycopg_conn).get_id(license_url)
+
+
+def _insert_collection(cursor, source, abstract, license_id, metadata,
+                       blob_index=None, stream_threshold=STREAM_THRESHOLD,
+                       abstract_index=None):
+    """Insert the collection's abstract, module entry and collection.xml.
+    Returns the ``module_ident`` of the collection.
+    """
+    with metrics.timer('insert', rows=2):
         # Insert the abstract
-        cursor.execute("INSERT INTO abstracts (abstract) "
-                       "VALUES (%s) "
-                       "RETURNING abstractid;", (abstract,))
-        abstract_id = cursor.fetchone()[0]
-        # Find the license id
-        cursor.execute("SELECT licenseid FROM licenses "
-                       "WHERE url = %s;", (license_url,))
-        license_id = cursor.fetchone()[0]
+        abstract_id = insert_abstract(cursor, abstract, abstract_index)
         # Relate the abstract and license
-        collection_metadata['abstractid'] = abstract_id
-        collection_metadata['licenseid'] = license_id
+        metadata['abstractid'] = abstract_id
+        metadata['licenseid'] = license_id
 
         # Insert the collection
-        collection_metadata = collection_metadata.items()
-        metadata_keys = ', '.join([x for x, y in collection_metadata])
-        metadata_value_spaces = ', '.join(['%s'] * len(collection_metadata))
-        metadata_values = [y for x, y in collection_metadata]
+        metadata = sorted(metadata.items())
+        metadata_keys = ', '.join([x for x, y in metadata])
+        metadata_value_spaces = ', '.join(['%s'] * len(metadata))
+        metadata_values = [y for x, y in metadata]
         cursor.execute("INSERT INTO modules  ({}) "
                        "VALUES ({}) "
                        "RETURNING module_ident;".format(metadata_keys,
@@ -105,79 +347,751 @@ def populate_from_completezip(location, ident_mappings, psycopg_conn):
                        metadata_values)
         collection_id = cursor.fetchone()[0]
 
-        # And finally insert the original collection.xml file
-        with open(collection_xml_path, 'r') as fp:
-            cursor.execute("INSERT INTO files (file) VALUES (%s) "
-                           "RETURNING fileid;",
-                           (psycopg2.Binary(fp.read()),))
-        file_id = cursor.fetchone()[0]
-        cursor.execute("INSERT INTO module_files "
-                       "  (module_ident, fileid, filename, mimetype) "
-                       "  VALUES (%s, %s, %s, %s) ",
-                       (collection_id, file_id, 'collection.xml', 'text/xml',))
-    psycopg_conn.commit()
+    # And finally insert the original collection.xml file
+    file_id = _insert_file(cursor, source, 'collection.xml', blob_index,
+                           stream_threshold)
+    _insert_module_file(cursor, collection_id, file_id, 'collection.xml',
+                        'text/xml')
+    return collection_id
 
-    for module_id in contents:
-        content_file_path = os.path.join(location, module_id, 'index.cnxml')
-        content_w_metadata_file_path = os.path.join(location, module_id,
-                                                   'index_auto_generated.cnxml')
-        with open(content_w_metadata_file_path, 'r') as fp:
-            abstract, license_url, metadata, resources = parse_module_xml(fp)
+
+def _insert_module(cursor, abstract, license_id, metadata,
+                   abstract_index=None, statements=None):
+    """Insert the module's abstract (when it has one) and module entry,
+    the latter with the ``PreparedStatements`` when given as ``statements``.
+    Returns the ``module_ident`` of the module.
+    """
+    with metrics.timer('insert') as measure:
+        if abstract is not None:
+            # Insert the abstract
+            abstract_id = insert_abstract(cursor, abstract, abstract_index)
+            metadata['abstractid'] = abstract_id
+            measure.rows += 1
+        metadata['licenseid'] = license_id
+
+        # Insert the module
+        metadata = sorted(metadata.items())
+        if statements is not None:
+            measure.rows += 1
+            return statements.insert(cursor, 'modules',
+                                     [x for x, y in metadata],
+                                     [[y for x, y in metadata]],
+                                     returning='module_ident')[0]
+        metadata_keys = ', '.join([x for x, y in metadata])
+        metadata_value_spaces = ', '.join(['%s'] * len(metadata))
+        metadata_values = [y for x, y in metadata]
+        cursor.execute("INSERT INTO modules  ({}) "
+                       "VALUES ({}) "
+                       "RETURNING module_ident;".format(metadata_keys,
+                                                        metadata_value_spaces),
+                       metadata_values)
+        measure.rows += 1
+        return cursor.fetchone()[0]
+
+
+def _restore_ident_mapping(psycopg_conn, ident_mappings, moduleid,
+                           collection_id):
+    """Map ``moduleid`` to the uuid that the collection at
+    ``collection_id`` was populated with, so that it continues to be used.
+    """
+    with psycopg_conn.cursor() as cursor:
+        cursor.execute("SELECT uuid FROM modules "
+                       "WHERE module_ident = %s;", (collection_id,))
+        ident_mappings[moduleid] = uuid.UUID(str(cursor.fetchone()[0]))
+
+
+def _populate_collection(source, ident_mappings, psycopg_conn, blob_index,
+                         stream_threshold, checkpoint, commit=True,
+                         abstract_index=None, parse_cache=None):
+    """Populate the collection itself, which is committed unless
+    ``commit`` is false (see ``populate_from_completezip``).
+    Returns the collection's metadata, its contents (the module ids) and
+    its ``CollectionProgress`` when a ``checkpoint`` is given.
+    """
+    fp, digest = _read_document(source, 'collection.xml')
+    collection_parts = _parse_document(parse_collection_xml, fp, digest,
+                                       parse_cache)
+    abstract, license_url, collection_metadata, contents = collection_parts
+    moduleid = collection_metadata['moduleid']
+
+    progress = None
+    collection_id = None
+    if checkpoint is not None:
+        progress = checkpoint.for_collection(
+            psycopg_conn, moduleid, collection_metadata['version'])
+        collection_id = progress.lookup(COLLECTION_DOCUMENT_ID, digest)
+
+    if collection_id is None:
+        # Fix the uuid value and/or pull it from the ident_mapping
+        try:
+            collection_uuid = ident_mappings[moduleid]
+        except (KeyError,):
+            collection_uuid = uuid.uuid4()
+        collection_metadata['uuid'] = str(collection_uuid)
+
+        license_id = _get_license_id(psycopg_conn, license_url)
+        with psycopg_conn.cursor() as cursor:
+            collection_id = _insert_collection(
+                cursor, source, abstract, license_id, collection_metadata,
+                blob_index, stream_threshold, abstract_index)
+            if progress is not None:
+                progress.record(cursor, COLLECTION_DOCUMENT_ID, digest,
+                                collection_id)
+        if commit:
+            _commit(psycopg_conn, blob_index, abstract_index)
+    else:
+        logger.debug("Resuming the population of '{}'." \
+                     .format(source.location))
+        _restore_ident_mapping(psycopg_conn, ident_mappings, moduleid,
+                               collection_id)
+    return collection_metadata, contents, progress
+
+
+def populate_from_completezip(location, ident_mappings, psycopg_conn,
+                              pool=None, blob_index=None,
+                              stream_threshold=STREAM_THRESHOLD,
+                              checkpoint=None, commit_every=None,
+                              failures=None, fingerprints=None,
+                              abstract_index=None, batch_size=None,
+                              parse_cache=None):
+    """Populate the database using a completezip formated collection.
+    The ``location`` is an unpacked completezip, a complete zip or
+    a source (see ``sources.get_source``). The collection is always inserted
+    on ``psycopg_conn``, while the modules are spread across the workers
+    of ``pool`` when one is given (see ``create_worker_pool``).
+    Files are deduplicated by content when a ``BlobIndex`` is given
+    as ``blob_index``, and likewise abstracts by their text when
+    an ``AbstractIndex`` is given as ``abstract_index``. Files larger than
+    ``stream_threshold`` bytes are streamed into the database in chunks.
+    When a ``Checkpoint`` is given as ``checkpoint`` the progress is
+    recorded, and documents recorded by a previous run are skipped.
+    By default the collection and each module are committed separately
+    and a failure stops the population. When ``commit_every`` is given,
+    the collection and the modules are committed ``commit_every`` modules
+    at a time, each module within a savepoint. A module that fails is then
+    rolled back on its own and recorded in ``failures`` (a ``FailureLog``),
+    while the population continues. When a ``Fingerprints`` is given as
+    ``fingerprints`` the modules are loaded incrementally: a module
+    that is unchanged since it was last populated for the collection
+    reuses the rows populated then. Neither applies to the workers
+    of a ``pool``. When a ``batch_size`` is given the modules are inserted
+    with statements prepared on the server (see ``PreparedStatements``),
+    and their files are inserted ``batch_size`` rows at a time.
+    When a ``ParseCache`` is given as ``parse_cache`` the documents whose
+    content has been parsed before aren't parsed again.
+    Returns the number of modules in the collection.
+    """
+    with open_source(location) as source:
+        collection_metadata, contents, progress = _populate_collection(
+            source, ident_mappings, psycopg_conn, blob_index,
+            stream_threshold, checkpoint, commit=commit_every is None,
+            abstract_index=abstract_index, parse_cache=parse_cache)
+        moduleid = collection_metadata['moduleid']
+        if pool is None and fingerprints is not None:
+            fingerprints = fingerprints.for_collection(psycopg_conn, moduleid)
+        else:
+            fingerprints = None
+        statements = None
+        if pool is None and batch_size is not None:
+            statements = PreparedStatements(batch_size)
+
+        if pool is None and commit_every is None:
+            for module_id in contents:
+                populate_module(source, module_id, psycopg_conn, blob_index,
+                                stream_threshold, progress,
+                                fingerprints=fingerprints,
+                                abstract_index=abstract_index,
+                                statements=statements,
+                                parse_cache=parse_cache)
+        elif pool is None:
+            if failures is None:
+                failures = FailureLog()
+            collection_key = (moduleid, collection_metadata['version'],)
+            for i, module_id in enumerate(contents):
+                _populate_module_in_savepoint(
+                    source, module_id, psycopg_conn, blob_index,
+                    stream_threshold, progress, failures, collection_key,
+                    fingerprints, abstract_index, statements, parse_cache)
+                if (i + 1) % commit_every == 0:
+                    _commit(psycopg_conn, blob_index, abstract_index)
+            _commit(psycopg_conn, blob_index, abstract_index)
+        else:
+            # Each module is committed by the worker that inserts it,
+            #   just as the serial path commits each module.
+            progress_key = progress is not None and progress.key or None
+            # Identifies this run of the collection to the workers.
+            run = uuid.uuid4().hex
+            tasks = [(source.location, module_id, progress_key, run,)
+                     for module_id in contents]
+            results = pool.map(_populate_module_in_worker, tasks, chunksize=1)
+            for content_id, snapshot in results:
+                metrics.merge(snapshot)
+        if statements is not None:
+            with psycopg_conn.cursor() as cursor:
+                statements.deallocate(cursor)
+        return len(contents)
+
+
+def populate_module(location, module_id, psycopg_conn, blob_index=None,
+                    stream_threshold=STREAM_THRESHOLD, progress=None,
+                    commit=True, fingerprints=None, abstract_index=None,
+                    statements=None, parse_cache=None):
+    """Populate the database with the module at ``module_id`` within
+    the completezip at ``location`` (see ``populate_from_completezip``).
+    When the collection's ``CollectionProgress`` is given as ``progress``,
+    a module it records as populated is skipped. Likewise, when the
+    collection's ``CollectionFingerprints`` are given as ``fingerprints``,
+    a module that is unchanged since it was last populated is skipped.
+    When ``PreparedStatements`` are given as ``statements`` they are used
+    to insert the module and its files, and likewise a ``ParseCache``
+    given as ``parse_cache`` is used to parse the module.
+    The module is committed unless ``commit`` is false.
+    Returns the ``module_ident`` of the inserted (or skipped) module.
+    """
+    with open_source(location) as source:
+        content_file_path = '/'.join([module_id, 'index.cnxml'])
+        content_w_metadata_file_path = '/'.join([module_id,
+                                                 'index_auto_generated.cnxml'])
+        fp, digest = _read_document(source, content_w_metadata_file_path)
+        if progress is not None:
+            content_id = progress.lookup(module_id, digest)
+            if content_id is not None:
+                return content_id
+        if fingerprints is not None:
+            with metrics.timer('fingerprint'):
+                fingerprint = fingerprint_module(source, module_id)
+            content_id = fingerprints.lookup(module_id, fingerprint)
+            if content_id is not None:
+                metrics.add('reuse')
+                return content_id
+        abstract, license_url, metadata, resources = _parse_document(
+            parse_module_xml, fp, digest, parse_cache)
+        # Find the license id
+        license_id = _get_license_id(psycopg_conn, license_url)
+        files = [('index.cnxml', 'text/xml', content_file_path,)]
+        files.extend(_resolve_resources(source, module_id, resources))
+        files = [file + (None, None,) for file in files]
         with psycopg_conn.cursor() as cursor:
-            if abstract is not None:
-                # Insert the abstract
-                cursor.execute("INSERT INTO abstracts (abstract) "
-                               "VALUES (%s) "
-                               "RETURNING abstractid;", (abstract,))
-                abstract_id = cursor.fetchone()[0]
-                metadata['abstractid'] = abstract_id
-            # Find the license id
-            cursor.execute("SELECT licenseid FROM licenses "
-                           "WHERE url = %s;", (license_url,))
-            license_id = cursor.fetchone()[0]
-            metadata['licenseid'] = license_id
-
-            # Insert the collection
-            metadata = metadata.items()
-            metadata_keys = ', '.join([x for x, y in metadata])
-            metadata_value_spaces = ', '.join(['%s'] * len(metadata))
-            metadata_values = [y for x, y in metadata]
-            cursor.execute("INSERT INTO modules  ({}) "
-                           "VALUES ({}) "
-                           "RETURNING module_ident;".format(
-                               metadata_keys,
-                               metadata_value_spaces),
-                           metadata_values)
-            content_id = cursor.fetchone()[0]
-
-            # And finally insert the original collection.xml file
-            with open(content_file_path, 'r') as fp:
-                payload = (psycopg2.Binary(fp.read()),)
-                cursor.execute("INSERT INTO files (file) VALUES (%s) "
-                               "RETURNING fileid;", payload)
-                file_id = cursor.fetchone()[0]
-                cursor.execute("INSERT INTO module_files "
-                               "  (module_ident, fileid, filename, mimetype) "
-                               "  VALUES (%s, %s, %s, %s) ",
-                               (content_id, file_id, 'index.cnxml',
-                                'text/xml',))
-        for filename, mimetype in resources:
-            resource_file_path = os.path.join(location, module_id, filename)
-            if not os.path.exists(resource_file_path):
-                # FIXME Should at least log this as an error.
-                continue
+            content_id = _insert_module(cursor, abstract, license_id,
+                                        metadata, abstract_index, statements)
+            # And finally insert the original index.cnxml file
+            #   and the resources
+            if statements is not None:
+                _insert_module_files(cursor, source, content_id, files,
+                                     statements, blob_index,
+                                     stream_threshold)
+            else:
+                for filename, mimetype, path, data, file_digest in files:
+                    file_id = _insert_file(cursor, source, path, blob_index,
+                                           stream_threshold)
+                    _insert_module_file(cursor, content_id, file_id,
+                                        filename, mimetype)
+        if progress is not None:
             with psycopg_conn.cursor() as cursor:
-                with open(resource_file_path, 'rb') as fp:
-                    cursor.execute("INSERT INTO files (file) VALUES (%s) "
-                                   "RETURNING fileid;",
-                                   (psycopg2.Binary(fp.read()),))
-                    file_id = cursor.fetchone()[0]
-                cursor.execute("INSERT INTO module_files "
-                               "  (module_ident, fileid, filename, mimetype) "
-                               "  VALUES (%s, %s, %s, %s) ",
-                               (content_id, file_id, filename,
-                                mimetype,))
-        psycopg_conn.commit()
+                progress.record(cursor, module_id, digest, content_id)
+        if fingerprints is not None:
+            with psycopg_conn.cursor() as cursor:
+                fingerprints.record(cursor, module_id, fingerprint,
+                                    content_id)
+        if commit:
+            _commit(psycopg_conn, blob_index, abstract_index)
+        return content_id
+
+
+def _populate_module_in_savepoint(source, module_id, psycopg_conn,
+                                  blob_index, stream_threshold, progress,
+                                  failures, collection_key,
+                                  fingerprints=None, abstract_index=None,
+                                  statements=None, parse_cache=None):
+    """Populate the module within a savepoint, so that a failure only
+    rolls back the module. The failure is recorded in ``failures``
+    for the collection's (id, version) ``collection_key``.
+    Returns the ``module_ident``, or None when the module failed.
+    """
+    indexes = [index for index in (blob_index, abstract_index,)
+               if index is not None]
+    with psycopg_conn.cursor() as cursor:
+        cursor.execute("SAVEPOINT populate_module;")
+    for index in indexes:
+        index.savepoint()
+    try:
+        content_id = populate_module(source, module_id, psycopg_conn,
+                                     blob_index, stream_threshold, progress,
+                                     commit=False, fingerprints=fingerprints,
+                                     abstract_index=abstract_index,
+                                     statements=statements,
+                                     parse_cache=parse_cache)
+    except Exception as exc:
+        logger.exception("Failed to populate '{}' of '{}'." \
+                         .format(module_id, source.location))
+        with psycopg_conn.cursor() as cursor:
+            cursor.execute("ROLLBACK TO SAVEPOINT populate_module;")
+            for index in indexes:
+                index.rollback_to_savepoint()
+            failures.record(cursor, collection_key[0], collection_key[1],
+                            module_id, exc)
+        metrics.add('failure')
+        return None
+    with psycopg_conn.cursor() as cursor:
+        cursor.execute("RELEASE SAVEPOINT populate_module;")
+        failures.clear(cursor, collection_key[0], collection_key[1],
+                       module_id)
+    for index in indexes:
+        index.release_savepoint()
+    return content_id
+
+
+def create_index_tables(psycopg_conn_str, dedupe_files=False,
+                        dedupe_abstracts=False):
+    """Create the tables of the indexes that are used, ahead of the
+    transactions (possibly of many processes) that populate with them.
+    """
+    indexes = []
+    if dedupe_files:
+        indexes.append(BlobIndex())
+    if dedupe_abstracts:
+        indexes.append(AbstractIndex())
+    if not indexes:
+        return
+    psycopg_conn = psycopg2.connect(psycopg_conn_str)
+    try:
+        for index in indexes:
+            index.create_table(psycopg_conn)
+    finally:
+        psycopg_conn.close()
+
+
+def _init_worker(psycopg_conn_str, dedupe_files=False,
+                 stream_threshold=STREAM_THRESHOLD, resume=False,
+                 dedupe_abstracts=False, batch_size=None, parse_cache=None,
+                 parse_cache_size=PARSE_CACHE_SIZE):
+    """Initialize a pool worker with its own database connection."""
+    global _worker_connection, _worker_blob_index, _worker_stream_threshold
+    global _worker_checkpoint, _worker_abstract_index, _worker_statements
+    global _worker_parse_cache
+    _worker_connection = psycopg2.connect(psycopg_conn_str)
+    if dedupe_files:
+        _worker_blob_index = BlobIndex()
+        _worker_blob_index.create_table(_worker_connection)
+    if dedupe_abstracts:
+        _worker_abstract_index = AbstractIndex()
+        _worker_abstract_index.create_table(_worker_connection)
+    if batch_size is not None:
+        # Prepared for the worker's connection, for as long as it lasts.
+        _worker_statements = PreparedStatements(batch_size)
+    if parse_cache is not None:
+        _worker_parse_cache = ParseCache(parse_cache, parse_cache_size)
+    _worker_stream_threshold = stream_threshold
+    if resume:
+        _worker_checkpoint = Checkpoint()
+
+
+def _populate_module_in_worker(task):
+    global _worker_source, _worker_progress
+    location, module_id, progress_key, run = task
+    progress = None
+    if progress_key is not None:
+        # The progress is loaded once for each run of the collection.
+        if _worker_progress[0] != run:
+            _worker_progress = (run, _worker_checkpoint.for_collection(
+                _worker_connection, *progress_key),)
+        progress = _worker_progress[1]
+    # Keep the source open between the modules of a collection,
+    #   which saves rereading a zip's directory for every module.
+    if _worker_source is None or _worker_source.location != location:
+        if _worker_source is not None:
+            _worker_source.close()
+        _worker_source = get_source(location)
+    # The metrics of the module are handed back to the parent process.
+    metrics.reset()
+    try:
+        content_id = populate_module(_worker_source, module_id,
+                                     _worker_connection, _worker_blob_index,
+                                     _worker_stream_threshold, progress,
+                                     abstract_index=_worker_abstract_index,
+                                     statements=_worker_statements,
+                                     parse_cache=_worker_parse_cache)
+    except Exception:
+        # Leave the worker ready for its next module.
+        _worker_connection.rollback()
+        for index in (_worker_blob_index, _worker_abstract_index,):
+            if index is not None:
+                index.rollback()
+        raise
+    return content_id, metrics.snapshot()
+
+
+def create_worker_pool(workers, psycopg_conn_str, dedupe_files=False,
+                       stream_threshold=STREAM_THRESHOLD, resume=False,
+                       dedupe_abstracts=False, batch_size=None,
+                       parse_cache=None, parse_cache_size=PARSE_CACHE_SIZE):
+    """Create a process pool of ``workers`` for module population.
+    Each worker process holds its own psycopg2 connection and, when
+    ``dedupe_files`` is true, its own ``BlobIndex``. When ``resume`` is
+    true each worker holds its own ``Checkpoint``, and likewise its own
+    ``AbstractIndex`` when ``dedupe_abstracts`` is true. When a
+    ``batch_size`` is given each worker prepares its own statements
+    (see ``populate_from_completezip``). When the path of a ``parse_cache``
+    is given each worker opens the ``ParseCache`` there, of at most
+    ``parse_cache_size`` bytes.
+    """
+    create_index_tables(psycopg_conn_str, dedupe_files, dedupe_abstracts)
+    return multiprocessing.Pool(workers, _init_worker,
+                                (psycopg_conn_str, dedupe_files,
+                                 stream_threshold, resume,
+                                 dedupe_abstracts, batch_size,
+                                 parse_cache, parse_cache_size,))
+
+
+def _gather_documents(source, collection_parts, digest, parse_cache=None):
+    """Gather the collection and its modules from the ``source`` for
+    a bulk load, given the parsed collection.xml (``collection_parts``)
+    and its ``digest``. The modules are parsed using the ``ParseCache``
+    when one is given as ``parse_cache``.
+    Returns a list of documents, each as a tuple of
+    (abstract, license url, metadata, [(filename, mimetype, path)]),
+    and the (document id, digest) of each document for the checkpoint.
+    """
+    abstract, license_url, collection_metadata, contents = collection_parts
+    # The collection always has an abstract row, even when it is empty.
+    documents = [(abstract, license_url, collection_metadata,
+                  [('collection.xml', 'text/xml', 'collection.xml',)],)]
+    document_keys = [(COLLECTION_DOCUMENT_ID, digest,)]
+    for module_id in contents:
+        content_file_path = '/'.join([module_id, 'index.cnxml'])
+        content_w_metadata_file_path = '/'.join(
+            [module_id, 'index_auto_generated.cnxml'])
+        fp, digest = _read_document(source, content_w_metadata_file_path)
+        document_keys.append((module_id, digest,))
+        parts = _parse_document(parse_module_xml, fp, digest, parse_cache)
+        abstract, license_url, metadata, resources = parts
+        files = [('index.cnxml', 'text/xml', content_file_path,)]
+        files.extend(_resolve_resources(source, module_id, resources))
+        documents.append((abstract, license_url, metadata, files,))
+    return documents, document_keys
+
+
+def _count_abstracts(documents):
+    """The number of abstract rows of the gathered ``documents``."""
+    return 1 + len([d for d in documents[1:] if d[0] is not None])
+
+
+def _hash_files(source, documents):
+    """The content digest of each file of the gathered ``documents``."""
+    digests = []
+    for abstract, license_url, metadata, files in documents:
+        for filename, mimetype, path in files:
+            with source.open(path) as fp:
+                digests.append(hash_file(fp))
+    return digests
+
+
+def _build_rows(source, documents, license_table, abstract_ids,
+                module_idents, file_ids, digests, known_fileids):
+    """Build the rows of the gathered ``documents`` using the assigned
+    ``abstract_ids``, ``module_idents`` and ``file_ids``. The ``digests``
+    (one per file, or None) are used to reuse the ``known_fileids``, which
+    is a mapping of digest to fileid that is added to as files are given
+    an id. Returns the abstract rows, a mapping of column names
+    to module rows, the file rows, the total size of the files,
+    the new (digest, fileid) pairs and the module_files rows.
+    """
+    abstract_ids = list(reversed(abstract_ids))
+    file_ids = list(reversed(file_ids))
+    digests = list(reversed(digests))
+    abstract_rows = []
+    # Modules are grouped by their column set, so that columns the
+    #   row-by-row path leaves out still receive their defaults.
+    module_rows = {}
+    file_rows = []
+    file_bytes = 0
+    new_digests = []
+    module_file_rows = []
+    for i, document in enumerate(documents):
+        abstract, license_url, metadata, files = document
+        if i == 0 or abstract is not None:
+            abstract_id = abstract_ids.pop()
+            abstract_rows.append((abstract_id, abstract,))
+            metadata['abstractid'] = abstract_id
+        metadata['licenseid'] = license_table.get_id(license_url)
+        module_ident = module_idents[i]
+        metadata['module_ident'] = module_ident
+        columns = tuple(sorted(metadata.keys()))
+        module_rows.setdefault(columns, []).append(
+            [metadata[c] for c in columns])
+        for filename, mimetype, path in files:
+            digest = digests.pop()
+            file_id = known_fileids.get(digest)
+            if file_id is None:
+                file_id = file_ids.pop()
+                file_rows.append((file_id, source.blob(path),))
+                file_bytes += source.getsize(path)
+                if digest is not None:
+                    known_fileids[digest] = file_id
+                    new_digests.append((digest, file_id,))
+            module_file_rows.append((module_ident, file_id,
+                                     filename, mimetype,))
+    return (abstract_rows, module_rows, file_rows, file_bytes, new_digests,
+            module_file_rows,)
+
+
+def bulk_populate_from_completezip(location, ident_mappings, psycopg_conn,
+                                   blob_index=None, checkpoint=None,
+                                   parse_cache=None):
+    """Populate the database using a completezip formated collection
+    (see ``populate_from_completezip``). Unlike that function this gathers
+    the rows for the entire collection and streams them into the database
+    using ``COPY``, with the ids pre-allocated from the table sequences.
+    The whole collection is committed as a single transaction.
+    Files are deduplicated by content when a ``BlobIndex`` is given
+    as ``blob_index``. When a ``Checkpoint`` is given as ``checkpoint``
+    the population is recorded, and a collection recorded by a previous run
+    is skipped. Documents are parsed using the ``ParseCache`` when one is
+    given as ``parse_cache``. Returns the number of modules in the collection.
+    """
+    with open_source(location) as source:
+        fp, digest = _read_document(source, 'collection.xml')
+        collection_parts = _parse_document(parse_collection_xml, fp, digest,
+                                           parse_cache)
+        abstract, license_url, collection_metadata, contents = collection_parts
+        moduleid = collection_metadata['moduleid']
+
+        progress = None
+        if checkpoint is not None:
+            progress = checkpoint.for_collection(
+                psycopg_conn, moduleid, collection_metadata['version'])
+            collection_id = progress.lookup(COLLECTION_DOCUMENT_ID, digest)
+            if collection_id is not None:
+                logger.debug("Skipping the populated '{}'." \
+                             .format(source.location))
+                _restore_ident_mapping(psycopg_conn, ident_mappings,
+                                       moduleid, collection_id)
+                return len(contents)
+
+        # Fix the uuid value and/or pull it from the ident_mapping
+        try:
+            collection_uuid = ident_mappings[moduleid]
+        except (KeyError,):
+            collection_uuid = uuid.uuid4()
+        collection_metadata['uuid'] = str(collection_uuid)
+
+        documents, document_keys = _gather_documents(source, collection_parts,
+                                                     digest, parse_cache)
+
+        with metrics.timer('license'):
+            license_table = get_license_table(psycopg_conn)
+        with psycopg_conn.cursor() as cursor:
+            abstract_ids = allocate_ids(cursor, 'abstracts', 'abstractid',
+                                        _count_abstracts(documents))
+            module_idents = allocate_ids(cursor, 'modules', 'module_ident',
+                                         len(documents))
+            # Work out how many files need a new row. Without a blob index
+            #   every file does, otherwise only the first file of each content
+            #   hash that is not already stored.
+            known_fileids = {}
+            if blob_index is None:
+                digests = [None] * sum([len(d[3]) for d in documents])
+                new_file_count = len(digests)
+            else:
+                digests = _hash_files(source, documents)
+                for digest in set(digests):
+                    file_id = blob_index.get(cursor, digest)
+                    if file_id is not None:
+                        known_fileids[digest] = file_id
+                new_file_count = len(set(digests)) - len(known_fileids)
+            file_ids = allocate_ids(cursor, 'files', 'fileid', new_file_count)
+
+            rows = _build_rows(source, documents, license_table, abstract_ids,
+                               module_idents, file_ids, digests, known_fileids)
+            (abstract_rows, module_rows, file_rows, file_bytes, new_digests,
+             module_file_rows,) = rows
+
+            with metrics.timer('copy', rows=len(abstract_rows)
+                               + len(documents)):
+                copy_rows(cursor, 'abstracts', ('abstractid', 'abstract',),
+                          abstract_rows)
+                for columns, rows in sorted(module_rows.items()):
+                    copy_rows(cursor, 'modules', columns, rows)
+            with metrics.timer('upload', bytes=file_bytes,
+                               rows=len(file_rows)):
+                copy_rows(cursor, 'files', ('fileid', 'file',), file_rows)
+                # Content another transaction stored at the same time
+                #   is used in place of ours.
+                replaced_fileids = {}
+                for digest, file_id in new_digests:
+                    recorded_file_id = blob_index.add(cursor, digest, file_id)
+                    if recorded_file_id != file_id:
+                        replaced_fileids[file_id] = recorded_file_id
+                        blob_index.discard(cursor, file_id)
+                module_file_rows = [
+                    (module_ident, replaced_fileids.get(file_id, file_id),
+                     filename, mimetype,)
+                    for module_ident, file_id, filename, mimetype
+                    in module_file_rows]
+            with metrics.timer('copy', rows=len(module_file_rows)):
+                copy_rows(cursor, 'module_files',
+                          ('module_ident', 'fileid', 'filename', 'mimetype',),
+                          module_file_rows)
+            if progress is not None:
+                for (document_id, digest), module_ident \
+                        in zip(document_keys, module_idents):
+                    progress.record(cursor, document_id, digest, module_ident)
+        _commit(psycopg_conn, blob_index)
+        logger.debug("Bulk loaded {} documents and {} files from '{}'." \
+                     .format(len(documents), len(file_rows), source.location))
+    return len(contents)
+
+
+def add_populate_arguments(parser):
+    """Add the arguments that configure how content is acquired and
+    populated to the ``argparse`` ``parser``.
+    """
+    parser.add_argument('-u', '--legacy-url', default='http://cnx.org',
+                        help="defaults to http://cnx.org")
+    parser.add_argument('-p', '--psycopg-conn-str',
+                        default=DEFAULT_PSYCOPG_CONNECTION_STRING,
+                        help="a psycopg2 connection string")
+    parser.add_argument('--downloads', type=int, default=1,
+                        help="number of versions to download concurrently")
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help="number of versions to acquire ahead of "
+                             "the one being populated")
+    parser.add_argument('--no-extract', dest='extract',
+                        action='store_false',
+                        help="read the content directly from the complete "
+                             "zips rather than unpacking them")
+    parser.add_argument('--bulk', action='store_true',
+                        help="load each collection in a single transaction "
+                             "using COPY")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="number of processes to populate modules with")
+    parser.add_argument('--dedupe-files', action='store_true',
+                        help="store identical file content only once")
+    parser.add_argument('--dedupe-abstracts', action='store_true',
+                        help="store identical abstract text only once")
+    parser.add_argument('--resume', action='store_true',
+                        help="record progress in the database and skip "
+                             "what a previous run has already populated")
+    parser.add_argument('--stream-threshold', type=int,
+                        default=STREAM_THRESHOLD,
+                        help="size in bytes above which files are streamed "
+                             "into the database in chunks "
+                             "(default: %(default)s)")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="read and parse modules in threads ahead of "
+                             "the database writes")
+    parser.add_argument('--readers', type=int, default=4,
+                        help="number of reader threads of the --pipeline "
+                             "(default: %(default)s)")
+    parser.add_argument('--incremental', action='store_true',
+                        help="reuse the modules that are unchanged since "
+                             "the collection's previous version")
+    parser.add_argument('--prepare', action='store_true',
+                        help="insert with prepared statements, sending "
+                             "the files in multi-row batches")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help="number of rows in each batch of --prepare "
+                             "(default: %(default)s)")
+    parser.add_argument('--parse-cache', metavar='PATH',
+                        help="keep the parsed documents in a cache at PATH, "
+                             "so that unchanged documents aren't parsed "
+                             "again")
+    parser.add_argument('--parse-cache-size', type=int,
+                        default=PARSE_CACHE_SIZE,
+                        help="size in bytes the --parse-cache is kept within "
+                             "(default: %(default)s)")
+    parser.add_argument('--commit-every', type=int, metavar='N',
+                        help="commit every N modules, rolling back and "
+                             "recording a failed module rather than "
+                             "stopping")
+
+
+def check_populate_arguments(parser, args):
+    """Check the combination of the parsed ``args``
+    (see ``add_populate_arguments``).
+    """
+    if args.bulk and args.workers > 1:
+        parser.error("--bulk can't be used with --workers")
+    if args.bulk and (args.dedupe_abstracts or args.prepare):
+        parser.error("--bulk can't be used with --dedupe-abstracts "
+                     "or --prepare")
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    if args.parse_cache_size < 1:
+        parser.error("--parse-cache-size must be at least 1")
+    if args.pipeline and (args.bulk or args.workers > 1
+                          or args.commit_every is not None):
+        parser.error("--pipeline can't be used with --bulk, --workers "
+                     "or --commit-every")
+    if args.incremental and (args.bulk or args.workers > 1 or args.pipeline):
+        parser.error("--incremental can't be used with --bulk, --workers "
+                     "or --pipeline")
+    if args.commit_every is not None:
+        if args.commit_every < 1:
+            parser.error("--commit-every must be at least 1")
+        if args.bulk or args.workers > 1:
+            parser.error("--commit-every can't be used with --bulk "
+                         "or --workers")
+
+
+def rollback_populate(populate):
+    """Forget the entries that the indexes of ``populate`` (see
+    ``make_populate``) added in a transaction that has been rolled back,
+    so that they aren't used by the next one.
+    """
+    keywords = getattr(populate, 'keywords', None) or {}
+    for name in ('blob_index', 'abstract_index',):
+        index = keywords.get(name)
+        if index is not None:
+            index.rollback()
+
+
+def make_populate(args, pool=None, checkpoint=None):
+    """Make the function that populates a location according to the
+    parsed ``args`` (see ``add_populate_arguments``). The function is
+    called as ``populate(location, ident_mappings, psycopg_conn)``.
+    Each call of this makes its own ``BlobIndex``, which isn't to be
+    shared between threads, and opens its own ``ParseCache``.
+    """
+    blob_index = None
+    if args.dedupe_files:
+        blob_index = BlobIndex()
+    abstract_index = None
+    if args.dedupe_abstracts:
+        abstract_index = AbstractIndex()
+    batch_size = None
+    if args.prepare:
+        batch_size = args.batch_size
+    parse_cache = None
+    if args.parse_cache is not None:
+        parse_cache = ParseCache(args.parse_cache, args.parse_cache_size)
+    if args.bulk:
+        return functools.partial(bulk_populate_from_completezip,
+                                 blob_index=blob_index,
+                                 checkpoint=checkpoint,
+                                 parse_cache=parse_cache)
+    if args.pipeline:
+        from .pipeline import pipelined_populate_from_completezip
+        return functools.partial(pipelined_populate_from_completezip,
+                                 blob_index=blob_index,
+                                 stream_threshold=args.stream_threshold,
+                                 checkpoint=checkpoint,
+                                 readers=args.readers,
+                                 abstract_index=abstract_index,
+                                 batch_size=batch_size,
+                                 parse_cache=parse_cache)
+    fingerprints = None
+    if args.incremental:
+        fingerprints = Fingerprints()
+    return functools.partial(populate_from_completezip, pool=pool,
+                             blob_index=blob_index,
+                             stream_threshold=args.stream_threshold,
+                             checkpoint=checkpoint,
+                             commit_every=args.commit_every,
+                             fingerprints=fingerprints,
+                             abstract_index=abstract_index,
+                             batch_size=batch_size,
+                             parse_cache=parse_cache)
 
 
 def main(argv=None):
@@ -186,26 +1100,44 @@ def main(argv=None):
     parser.add_argument('collection_id', help="(e.g. col11496)")
     parser.add_argument('--versions', nargs='+', default=['latest'],
                         help="a series of version numbers")
-    parser.add_argument('-u', '--legacy-url', default='http://cnx.org',
-                        help="defaults to http://cnx.org")
-    parser.add_argument('-p', '--psycopg-conn-str',
-                        default=DEFAULT_PSYCOPG_CONNECTION_STRING,
-                        help="a psycopg2 connection string")
+    add_populate_arguments(parser)
+    add_instrumentation_arguments(parser)
     args = parser.parse_args(argv)
+    check_populate_arguments(parser, args)
 
     output_dir = os.getcwd()
     locations = acquire_content(args.collection_id, args.versions,
                                 host=args.legacy_url,
-                                output_dir=output_dir)
+                                output_dir=output_dir,
+                                downloads=args.downloads,
+                                queue_size=args.prefetch,
+                                extract=args.extract)
 
     collection_uuid = uuid.uuid4()
     ident_mappings = {args.collection_id: collection_uuid}
-    for location in locations:
-        with psycopg2.connect(args.psycopg_conn_str) as db_connection:
-            populate_from_completezip(location,
-                                      ident_mappings,
-                                      db_connection)
-            db_connection.commit()
+    create_index_tables(args.psycopg_conn_str, args.dedupe_files,
+                        args.dedupe_abstracts)
+    pool = None
+    if args.workers > 1:
+        pool = create_worker_pool(args.workers, args.psycopg_conn_str,
+                                  args.dedupe_files, args.stream_threshold,
+                                  args.resume, args.dedupe_abstracts,
+                                  args.prepare and args.batch_size or None,
+                                  args.parse_cache, args.parse_cache_size)
+    checkpoint = None
+    if args.resume:
+        checkpoint = Checkpoint()
+    populate = make_populate(args, pool, checkpoint)
+    try:
+        with instrument(args):
+            for location in locations:
+                with psycopg2.connect(args.psycopg_conn_str) as db_connection:
+                    populate(location, ident_mappings, db_connection)
+                    db_connection.commit()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
 
 if __name__ == '__main__':
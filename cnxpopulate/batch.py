@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""Populate a cnx-archive database with many collections in a single run.
+The collections are read from a file (or stdin), one per line as the
+collection id followed by the versions to populate, e.g.::
+
+    col11496 1.1 1.2
+    col10001
+
+A collection without versions is populated at its latest version.
+"""
+import os
+import sys
+import time
+import argparse
+import logging
+import threading
+import uuid
+
+import psycopg2.pool
+
+from .archive import (acquire_content, add_populate_arguments,
+                      check_populate_arguments, create_index_tables,
+                      create_worker_pool, make_populate,
+                      rollback_populate)
+from .checkpoint import Checkpoint
+from .fetch import prefetch
+from .metrics import add_instrumentation_arguments, instrument
+
+
+__all__ = ('read_batch', 'CollectionResult', 'BatchPopulator',
+           'format_report',)
+
+logger = logging.getLogger('populate')
+
+
+def read_batch(fp):
+    """Read the collections listed in the file ``fp``. Blank lines and
+    lines starting with ``#`` are ignored.
+    Returns a list of (collection id, versions) tuples.
+    """
+    entries = []
+    for line in fp:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        parts = line.split()
+        entries.append((parts[0], parts[1:] or ['latest'],))
+    return entries
+
+
+class CollectionResult(object):
+    """The outcome of populating one of the collections in a batch."""
+
+    def __init__(self, collection_id, versions):
+        self.collection_id = collection_id
+        self.versions = versions
+        self.populated_versions = []
+        self.modules = 0
+        self.seconds = 0.0
+        self.error = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class BatchPopulator(object):
+    """Populates a batch of collections using the connections of
+    ``connection_pool`` (a ``psycopg2.pool``), which is shared by the whole
+    run. The identity mappings are also kept for the whole run.
+    ``make_populate`` is called once per thread to make the function that
+    populates a location (see ``archive.make_populate``).
+    """
+
+    def __init__(self, connection_pool, make_populate, output_dir,
+                 host='http://cnx.org', downloads=1, queue_size=2,
+                 extract=True):
+        self.connection_pool = connection_pool
+        self.make_populate = make_populate
+        self.output_dir = output_dir
+        self.host = host
+        self.downloads = downloads
+        self.queue_size = queue_size
+        self.extract = extract
+        self.ident_mappings = {}
+        self._local = threading.local()
+
+    def _populate(self):
+        try:
+            return self._local.populate
+        except AttributeError:
+            self._local.populate = self.make_populate()
+            return self._local.populate
+
+    def populate_collection(self, entry):
+        """Populate the versions of a collection, where ``entry`` is
+        a (collection id, versions) tuple. A failure is recorded in the
+        returned ``CollectionResult`` rather than raised, so that it
+        doesn't stop the rest of the batch.
+        """
+        collection_id, versions = entry
+        result = CollectionResult(collection_id, versions)
+        self.ident_mappings.setdefault(collection_id, uuid.uuid4())
+        populate = self._populate()
+        start = time.time()
+        db_connection = self.connection_pool.getconn()
+        try:
+            locations = acquire_content(collection_id, versions,
+                                        host=self.host,
+                                        output_dir=self.output_dir,
+                                        downloads=self.downloads,
+                                        queue_size=self.queue_size,
+                                        extract=self.extract)
+            for i, location in enumerate(locations):
+                with db_connection:
+                    modules = populate(location, self.ident_mappings,
+                                       db_connection)
+                result.populated_versions.append(versions[i])
+                result.modules += modules or 0
+        except Exception as exc:
+            logger.exception("Failed to populate '{}'." \
+                             .format(collection_id))
+            rollback_populate(populate)
+            result.error = exc
+        finally:
+            self.connection_pool.putconn(db_connection)
+            result.seconds = time.time() - start
+        return result
+
+    def run(self, entries, jobs=1):
+        """Populate the collections of ``entries`` (see ``read_batch``),
+        ``jobs`` collections at a time. Generates a ``CollectionResult``
+        for each of the ``entries`` in order.
+        """
+        return prefetch(self.populate_collection, entries, workers=jobs,
+                        queue_size=jobs)
+
+
+def format_report(results, seconds):
+    """Format the per-collection ``results`` and the overall throughput
+    of a batch that took ``seconds`` to run.
+    """
+    lines = []
+    for result in results:
+        status = result.ok and 'ok' or 'failed: {}'.format(result.error)
+        lines.append("{:<12} {:>3}/{:<3} versions {:>6} modules "
+                     "{:9.2f}s  {}".format(result.collection_id,
+                                           len(result.populated_versions),
+                                           len(result.versions),
+                                           result.modules, result.seconds,
+                                           status))
+    failed = len([r for r in results if not r.ok])
+    versions = sum([len(r.populated_versions) for r in results])
+    modules = sum([r.modules for r in results])
+    seconds = max(seconds, 1e-6)
+    lines.append("{} collections ({} failed), {} versions and {} modules "
+                 "in {:.2f}s".format(len(results), failed, versions,
+                                     modules, seconds))
+    lines.append("{:.2f} versions/s, {:.2f} modules/s" \
+                 .format(versions / seconds, modules / seconds))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """Main commandline interface"""
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('batch_file', nargs='?', type=argparse.FileType('r'),
+                        default=sys.stdin,
+                        help="the collections to populate "
+                             "(default: stdin)")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="number of collections to populate "
+                             "concurrently, each on its own connection")
+    add_populate_arguments(parser)
+    add_instrumentation_arguments(parser)
+    args = parser.parse_args(argv)
+    check_populate_arguments(parser, args)
+
+    entries = read_batch(args.batch_file)
+    jobs = max(args.jobs, 1)
+    connection_pool = psycopg2.pool.ThreadedConnectionPool(
+        1, jobs, args.psycopg_conn_str)
+    create_index_tables(args.psycopg_conn_str, args.dedupe_files,
+                        args.dedupe_abstracts)
+    pool = None
+    if args.workers > 1:
+        pool = create_worker_pool(args.workers, args.psycopg_conn_str,
+                                  args.dedupe_files, args.stream_threshold,
+                                  args.resume, args.dedupe_abstracts,
+                                  args.prepare and args.batch_size or None,
+                                  args.parse_cache, args.parse_cache_size)
+    checkpoint = None
+    if args.resume:
+        checkpoint = Checkpoint()
+    populator = BatchPopulator(
+        connection_pool, lambda: make_populate(args, pool, checkpoint),
+        os.getcwd(), host=args.legacy_url, downloads=args.downloads,
+        queue_size=args.prefetch, extract=args.extract)
+
+    results = []
+    start = time.time()
+    try:
+        with instrument(args):
+            for result in populator.run(entries, jobs):
+                logger.info("Populated '{}' in {:.2f}s." \
+                            .format(result.collection_id, result.seconds))
+                results.append(result)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        connection_pool.closeall()
+    print(format_report(results, time.time() - start))
+    return len([r for r in results if not r.ok]) and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
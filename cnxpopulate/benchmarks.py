@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""Benchmarks for the population utility. The population benchmarks run
+against a throwaway cnx-archive database, because the loaders commit
+what they insert.
+"""
+import os
+import time
+import json
+import shutil
+import argparse
+import platform
+import tempfile
+from io import BytesIO
+
+import lxml.etree
+import psycopg2
+
+from .archive import (DEFAULT_PSYCOPG_CONNECTION_STRING,
+                      create_worker_pool, populate_from_completezip,
+                      bulk_populate_from_completezip)
+from .lookups import LicenseTable
+from .parsers import (_parse_common_elements, _xpath_parse_common_elements,
+                      parse_collection_xml, parse_module_xml)
+from .synthetic import make_completezip
+
+
+here = os.path.abspath(os.path.dirname(__file__))
+TEST_COLLECTION_XML = os.path.join(here, 'test-data', 'collection.xml')
+TEST_LICENSES_JSON = os.path.join(here, 'test-data', 'licenses.json')
+LOADERS = (
+    ('row-by-row', populate_from_completezip,),
+    ('bulk', bulk_populate_from_completezip,),
+    )
+METADATA_EXTRACTORS = (
+    ('xpath', _xpath_parse_common_elements,),
+    ('single-pass', _parse_common_elements,),
+    )
+SYNTHETIC_MODULE_ENTRY = """\
+      <col:module document="m{0}" version="latest"
+                  repository="http://cnx.org/content">
+        <md:title>Synthetic module {0}</md:title>
+      </col:module>
+"""
+
+
+def _timings(func, repeat):
+    """Run ``func`` ``repeat`` times and return the wall-clock times."""
+    timings = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    return timings
+
+
+def _timeit(func, repeat):
+    """Run ``func`` ``repeat`` times and return the best wall-clock time."""
+    return min(_timings(func, repeat))
+
+
+def _report(results):
+    baseline = results[0][1]
+    for name, seconds in results:
+        print("{:<12} {:8.3f}s  {:6.2f}x".format(name, seconds,
+                                                 baseline / seconds))
+
+
+def bench_loaders(location, psycopg_conn_str, repeat=3):
+    """Time each of the ``LOADERS`` against the unpacked completezip at
+    ``location``. Returns a list of (name, seconds) tuples.
+    """
+    results = []
+    for name, loader in LOADERS:
+        def run():
+            ident_mappings = {}
+            with psycopg2.connect(psycopg_conn_str) as db_connection:
+                loader(location, ident_mappings, db_connection)
+        results.append((name, _timeit(run, repeat),))
+    return results
+
+
+def bench_commit_every(location, psycopg_conn_str, batch_sizes, repeat=3):
+    """Time the row-by-row loader against the completezip at ``location``
+    when committing every module (the default) and then every N modules
+    for each of the ``batch_sizes``. Returns a list of
+    (name, seconds) tuples.
+    """
+    results = []
+    for commit_every in [None] + list(batch_sizes):
+        def run():
+            with psycopg2.connect(psycopg_conn_str) as db_connection:
+                populate_from_completezip(location, {}, db_connection,
+                                          commit_every=commit_every)
+        name = commit_every is None and 'per-module' \
+            or 'every {}'.format(commit_every)
+        results.append((name, _timeit(run, repeat),))
+    return results
+
+
+def bench_workers(location, psycopg_conn_str, worker_counts, repeat=3):
+    """Time the row-by-row loader against the completezip at ``location``
+    on its own and with a pool of workers for each of the
+    ``worker_counts``, to see how the throughput scales with the workers.
+    Returns a list of (name, seconds) tuples.
+    """
+    results = []
+    for workers in [None] + list(worker_counts):
+        pool = None
+        if workers is not None:
+            pool = create_worker_pool(workers, psycopg_conn_str)
+        try:
+            def run():
+                with psycopg2.connect(psycopg_conn_str) as db_connection:
+                    populate_from_completezip(location, {}, db_connection,
+                                              pool=pool)
+            name = workers is None and 'serial' \
+                or '{} workers'.format(workers)
+            results.append((name, _timeit(run, repeat),))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+    return results
+
+
+def make_synthetic_collection_xml(modules):
+    """Make a collection.xml document by adding ``modules`` synthetic
+    module entries to the test collection.xml.
+    """
+    with open(TEST_COLLECTION_XML, 'r') as fp:
+        xml = fp.read()
+    entries = ''.join([SYNTHETIC_MODULE_ENTRY.format(90000 + i)
+                       for i in range(modules)])
+    head, tail = xml.rsplit('</col:content>', 1)
+    return head + entries + '</col:content>' + tail
+
+
+def bench_metadata_extraction(xml, number=100, repeat=3):
+    """Time each of the ``METADATA_EXTRACTORS`` over ``number`` runs
+    against the ``xml`` document. Returns a list of (name, seconds) tuples.
+    """
+    doc = lxml.etree.fromstring(xml)
+    results = []
+    for name, extractor in METADATA_EXTRACTORS:
+        def run():
+            for i in range(number):
+                extractor(doc)
+        results.append((name, _timeit(run, repeat),))
+    return results
+
+
+def bench_suite(location, psycopg_conn_str=None, number=10, repeat=3):
+    """Time the parsers, the model and (when ``psycopg_conn_str`` is given)
+    the row-by-row loader against the completezip at ``location``.
+    Returns a list of result dictionaries, each with the benchmark's
+    ``name``, the ``number`` of operations per run and the ``timings``
+    of each run.
+    """
+    import cnxpopulate as pkg
+    from .sources import open_source
+
+    results = []
+
+    def add(name, func, number=number):
+        timings = _timings(func, repeat)
+        results.append({'name': name, 'number': number, 'timings': timings,
+                        'best': min(timings),
+                        'per_operation': min(timings) / number})
+
+    with open_source(location) as source:
+        with source.open('collection.xml') as fp:
+            collection_xml = fp.read()
+        contents = parse_collection_xml(BytesIO(collection_xml))[3]
+        module_xmls = []
+        for module_id in contents:
+            path = '/'.join([module_id, 'index_auto_generated.cnxml'])
+            with source.open(path) as fp:
+                module_xmls.append(fp.read())
+
+    add('parse_collection_xml', lambda: [
+        parse_collection_xml(BytesIO(collection_xml))
+        for i in range(number)])
+    add('parse_module_xml',
+        lambda: [parse_module_xml(BytesIO(xml)) for xml in module_xmls],
+        number=len(module_xmls))
+
+    pkg.licenses.populate(LicenseTable.from_json(TEST_LICENSES_JSON))
+    try:
+        add('Collection.from_file_buffer', lambda: [
+            pkg.Collection.from_file_buffer(BytesIO(collection_xml))
+            for i in range(number)])
+    finally:
+        pkg.licenses.clear()
+
+    if psycopg_conn_str is not None:
+        def populate():
+            with psycopg2.connect(psycopg_conn_str) as db_connection:
+                populate_from_completezip(location, {}, db_connection)
+        add('populate_from_completezip', populate, number=1)
+    return results
+
+
+def write_results(results, filepath, parameters):
+    """Write the benchmark ``results`` and the ``parameters`` they were
+    made with to ``filepath`` as JSON, along with a description of the
+    environment, so that runs can be compared between releases.
+    """
+    document = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'environment': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            },
+        'parameters': parameters,
+        'results': results,
+        }
+    with open(filepath, 'w') as fp:
+        json.dump(document, fp, indent=2, sort_keys=True)
+
+
+def main(argv=None):
+    """Main commandline interface"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    populate_parser = subparsers.add_parser(
+        'populate', help="compare the database loaders")
+    populate_parser.add_argument('location',
+                                 help="an unpacked completezip directory")
+    populate_parser.add_argument('-p', '--psycopg-conn-str',
+                                 default=DEFAULT_PSYCOPG_CONNECTION_STRING,
+                                 help="a psycopg2 connection string")
+    populate_parser.add_argument('-r', '--repeat', type=int, default=3,
+                                 help="number of runs per loader, "
+                                      "the best is kept")
+
+    parse_parser = subparsers.add_parser(
+        'parse', help="compare the metadata extractors")
+    parse_parser.add_argument('-m', '--modules', type=int, default=20000,
+                              help="number of module entries in the "
+                                   "synthetic document")
+    parse_parser.add_argument('-n', '--number', type=int, default=100,
+                              help="number of extractions per run")
+
+    commit_parser = subparsers.add_parser(
+        'commit', help="compare transaction batch sizes")
+    commit_parser.add_argument('-p', '--psycopg-conn-str',
+                               default=DEFAULT_PSYCOPG_CONNECTION_STRING,
+                               help="a psycopg2 connection string to "
+                                    "a throwaway database")
+    commit_parser.add_argument('-m', '--modules', type=int, default=200,
+                               help="number of modules in the synthetic "
+                                    "collection")
+    commit_parser.add_argument('-b', '--batch-sizes', type=int, nargs='+',
+                               default=[1, 10, 50, 200],
+                               help="the --commit-every values to compare")
+    commit_parser.add_argument('-r', '--repeat', type=int, default=3,
+                               help="number of runs per batch size, "
+                                    "the best is kept")
+
+    workers_parser = subparsers.add_parser(
+        'workers', help="compare the number of worker processes")
+    workers_parser.add_argument('-p', '--psycopg-conn-str',
+                                default=DEFAULT_PSYCOPG_CONNECTION_STRING,
+                                help="a psycopg2 connection string to "
+                                     "a throwaway database")
+    workers_parser.add_argument('-m', '--modules', type=int, default=200,
+                                help="number of modules in the synthetic "
+                                     "collection")
+    workers_parser.add_argument('-w', '--workers', type=int, nargs='+',
+                                default=[1, 2, 4, 8, 16],
+                                help="the --workers values to compare")
+    workers_parser.add_argument('-r', '--repeat', type=int, default=3,
+                                help="number of runs per number of "
+                                     "workers, the best is kept")
+
+    suite_parser = subparsers.add_parser(
+        'suite', help="run the benchmark suite against synthetic content")
+    suite_parser.add_argument('-m', '--modules', type=int, default=50)
+    suite_parser.add_argument('-i', '--images', type=int, default=5,
+                              help="number of images per module")
+    suite_parser.add_argument('-s', '--image-size', type=int,
+                              default=32 * 1024,
+                              help="size of each image in bytes")
+    suite_parser.add_argument('--shared-ratio', type=float, default=0.0,
+                              help="portion of the images shared "
+                                   "between modules")
+    suite_parser.add_argument('--seed', type=int, default=0)
+    suite_parser.add_argument('--zip', dest='as_zip', action='store_true',
+                              help="read from a complete zip rather than "
+                                   "a directory")
+    suite_parser.add_argument('-n', '--number', type=int, default=10,
+                              help="number of operations per run")
+    suite_parser.add_argument('-r', '--repeat', type=int, default=3,
+                              help="number of runs per benchmark")
+    suite_parser.add_argument('-p', '--psycopg-conn-str', default=None,
+                              help="a psycopg2 connection string to a "
+                                   "throwaway database, which enables the "
+                                   "population benchmark")
+    suite_parser.add_argument('-o', '--output',
+                              default='benchmark-results.json',
+                              help="the file to write the results to "
+                                   "(default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    if args.benchmark == 'populate':
+        _report(bench_loaders(args.location, args.psycopg_conn_str,
+                              args.repeat))
+    elif args.benchmark == 'parse':
+        with open(TEST_COLLECTION_XML, 'r') as fp:
+            documents = (
+                ('collection.xml', fp.read(),),
+                ('synthetic', make_synthetic_collection_xml(args.modules),),
+                )
+        for title, xml in documents:
+            print("{} ({} bytes)".format(title, len(xml)))
+            _report(bench_metadata_extraction(xml, args.number))
+    elif args.benchmark == 'commit':
+        output_dir = tempfile.mkdtemp()
+        try:
+            location = make_completezip(output_dir, args.modules, images=1,
+                                        image_size=1024)
+            results = bench_commit_every(location, args.psycopg_conn_str,
+                                         args.batch_sizes, args.repeat)
+        finally:
+            shutil.rmtree(output_dir)
+        _report(results)
+        for name, seconds in results:
+            print("{:<12} {:8.1f} modules/s".format(name,
+                                                   args.modules / seconds))
+    elif args.benchmark == 'workers':
+        output_dir = tempfile.mkdtemp()
+        try:
+            location = make_completezip(output_dir, args.modules)
+            results = bench_workers(location, args.psycopg_conn_str,
+                                    args.workers, args.repeat)
+        finally:
+            shutil.rmtree(output_dir)
+        _report(results)
+        for name, seconds in results:
+            print("{:<12} {:8.1f} modules/s".format(name,
+                                                   args.modules / seconds))
+    elif args.benchmark == 'suite':
+        parameters = dict([(name, getattr(args, name),)
+                           for name in ('modules', 'images', 'image_size',
+                                        'shared_ratio', 'seed', 'as_zip',
+                                        'number', 'repeat',)])
+        output_dir = tempfile.mkdtemp()
+        try:
+            location = make_completezip(output_dir, args.modules,
+                                        args.images, args.image_size,
+                                        args.shared_ratio, seed=args.seed,
+                                        as_zip=args.as_zip)
+            results = bench_suite(location, args.psycopg_conn_str,
+                                  args.number, args.repeat)
+        finally:
+            shutil.rmtree(output_dir)
+        write_results(results, args.output, parameters)
+        for result in results:
+            print("{:<28} {:10.6f}s per operation" \
+                  .format(result['name'], result['per_operation']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""Content addressed storage of file blobs. Identical file content is
+only stored once in the ``files`` table.
+"""
+import hashlib
+from collections import OrderedDict
+
+import psycopg2
+
+
+__all__ = ('hash_file', 'read_and_hash_file', 'DigestIndex', 'BlobIndex',)
+
+HASH_ALGORITHM = 'sha1'
+CHUNK_SIZE = 64 * 1024
+
+
+def _iter_chunks(fp):
+    try:
+        # File data (see ``cnxpopulate.FileData``) is viewed, not read.
+        iter_views = fp.iter_views
+    except AttributeError:
+        pass
+    else:
+        for view in iter_views(CHUNK_SIZE):
+            yield view
+        return
+    while True:
+        chunk = fp.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+def hash_file(fp):
+    """Hash the contents of the file object (``fp``) in chunks.
+    Returns the hex digest.
+    """
+    hasher = hashlib.new(HASH_ALGORITHM)
+    for chunk in _iter_chunks(fp):
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def read_and_hash_file(fp):
+    """Read the contents of the file object (``fp``), hashing it as
+    it streams in. Returns the data and its hex digest.
+    """
+    hasher = hashlib.new(HASH_ALGORITHM)
+    chunks = []
+    for chunk in _iter_chunks(fp):
+        hasher.update(chunk)
+        chunks.append(chunk)
+    return ''.join(chunks), hasher.hexdigest()
+
+
+class DigestIndex(object):
+    """An index of content digests to the ids of the rows holding that
+    content. Lookups are made against an in-process mapping first and then
+    against the ``table`` of the index, which is created on first use.
+    When ``cache_size`` is given at most that many committed entries are
+    kept in-process, the least recently used being dropped first.
+
+    Entries added in the current transaction are held separately until
+    ``commit`` is called, so that a rollback (see ``rollback``) does not
+    leave the in-process mapping pointing at rows that no longer exist.
+    The same goes for a rollback to a savepoint (see ``savepoint``).
+
+    Several processes can use the same table at once, e.g. the workers
+    of a pool. The table is best made ahead of them (see ``create_table``),
+    and content that two of them store at once is recorded by the first
+    (see ``add``).
+    """
+    # The index's table, the id column and the table the ids refer to.
+    table = None
+    id_column = None
+    references = None
+
+    def __init__(self, cache_size=None):
+        self.cache_size = cache_size
+        self._ids = OrderedDict()
+        self._pending = {}
+        # The digests added since the savepoint, see ``savepoint``.
+        self._savepoint = None
+        self._has_table = False
+
+    def __len__(self):
+        return len(self._ids) + len(self._pending)
+
+    def _ensure_table(self, cursor):
+        if self._has_table:
+            return
+        cursor.execute("CREATE TABLE IF NOT EXISTS {} ("
+                       "  digest TEXT PRIMARY KEY,"
+                       "  {} INTEGER NOT NULL REFERENCES {}"
+                       ");".format(self.table, self.id_column,
+                                   self.references))
+        self._has_table = True
+
+    def create_table(self, psycopg_conn):
+        """Create the index's table in a transaction of its own, rather
+        than within the first transaction that uses the index, where
+        concurrent transactions would race to create it.
+        """
+        try:
+            with psycopg_conn.cursor() as cursor:
+                self._ensure_table(cursor)
+            psycopg_conn.commit()
+        except psycopg2.IntegrityError:
+            # Another process created it at the same time.
+            psycopg_conn.rollback()
+            self._has_table = True
+
+    def _cache(self, digest, id):
+        self._ids[digest] = id
+        if self.cache_size is not None:
+            while len(self._ids) > self.cache_size:
+                self._ids.popitem(last=False)
+
+    def get(self, cursor, digest):
+        """Look up the id for the given ``digest``.
+        Returns None when the content has not been stored.
+        """
+        try:
+            id = self._ids.pop(digest)
+        except KeyError:
+            pass
+        else:
+            self._ids[digest] = id
+            return id
+        try:
+            return self._pending[digest]
+        except KeyError:
+            pass
+        self._ensure_table(cursor)
+        cursor.execute("SELECT {} FROM {} WHERE digest = %s;" \
+                       .format(self.id_column, self.table), (digest,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        # Rows found in the database have already been committed.
+        self._cache(digest, row[0])
+        return row[0]
+
+    def add(self, cursor, digest, id):
+        """Record the ``id`` of the row holding the content for
+        ``digest``. When another transaction has recorded the digest
+        (having stored the same content at the same time) its id is kept.
+        Returns the recorded id, which is ``id`` unless the row at ``id``
+        duplicates another's (see ``discard``).
+        """
+        self._ensure_table(cursor)
+        # This waits on a concurrent transaction that inserted the digest,
+        #   and does nothing once that transaction commits.
+        cursor.execute("INSERT INTO {} (digest, {}) VALUES (%s, %s) "
+                       "ON CONFLICT (digest) DO NOTHING;" \
+                       .format(self.table, self.id_column), (digest, id,))
+        if cursor.rowcount == 0:
+            cursor.execute("SELECT {} FROM {} WHERE digest = %s;" \
+                           .format(self.id_column, self.table), (digest,))
+            id = cursor.fetchone()[0]
+        if self._savepoint is not None and digest not in self._pending:
+            self._savepoint.append(digest)
+        self._pending[digest] = id
+        return id
+
+    def discard(self, cursor, id):
+        """Delete the row at ``id``, which duplicates the content of
+        another (see ``add``), before anything refers to it.
+        """
+        cursor.execute("DELETE FROM {} WHERE {} = %s;" \
+                       .format(self.references, self.id_column), (id,))
+
+    def commit(self):
+        """Mark the entries added since the last commit as durable."""
+        for digest, id in self._pending.items():
+            self._cache(digest, id)
+        self._pending = {}
+        self._savepoint = None
+
+    def rollback(self):
+        """Forget the entries added since the last commit."""
+        self._pending = {}
+        self._savepoint = None
+
+    def savepoint(self):
+        """Mark the entries added so far, to go along with a savepoint
+        in the transaction. Only the latest savepoint is kept.
+        """
+        self._savepoint = []
+
+    def release_savepoint(self):
+        self._savepoint = None
+
+    def rollback_to_savepoint(self):
+        """Forget the entries added since the savepoint."""
+        for digest in self._savepoint or ():
+            del self._pending[digest]
+        self._savepoint = None
+
+
+class BlobIndex(DigestIndex):
+    """An index of content hashes to ``files.fileid`` values,
+    kept in the ``file_digests`` table (see ``DigestIndex``).
+    """
+    table = 'file_digests'
+    id_column = 'fileid'
+    references = 'files'
+
+    def insert_file(self, cursor, fp):
+        """Insert the contents of the file object (``fp``) into the
+        ``files`` table, unless identical content is already stored.
+        File data (see ``cnxpopulate.FileData``) is hashed and uploaded
+        from views of it rather than read. Returns the ``fileid``.
+        """
+        try:
+            view = fp.view
+        except AttributeError:
+            data, digest = read_and_hash_file(fp)
+        else:
+            data, digest = view(), hash_file(fp)
+        fileid = self.get(cursor, digest)
+        if fileid is None:
+            cursor.execute("INSERT INTO files (file) VALUES (%s) "
+                           "RETURNING fileid;", (psycopg2.Binary(data),))
+            fileid = cursor.fetchone()[0]
+            recorded_fileid = self.add(cursor, digest, fileid)
+            if recorded_fileid != fileid:
+                self.discard(cursor, fileid)
+                fileid = recorded_fileid
+        return fileid
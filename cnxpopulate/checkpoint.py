@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""Checkpointing of population progress, so that an interrupted run can
+be resumed without inserting duplicates.
+
+Progress is recorded in the ``populate_progress`` table within the same
+transaction as the work it records. A document is therefore either
+populated and recorded, or neither.
+"""
+
+
+__all__ = ('COLLECTION_DOCUMENT_ID', 'Checkpoint', 'CollectionProgress',
+           'FailureLog',)
+
+# The document id used to record the collection itself.
+COLLECTION_DOCUMENT_ID = 'collection.xml'
+
+
+class CollectionProgress(object):
+    """The recorded progress for one version of a collection. Documents
+    are identified by their directory in the completezip (the module id)
+    and the digest of their metadata file, so that a document whose
+    content has changed since it was recorded is populated again.
+    """
+
+    def __init__(self, checkpoint, moduleid, version, done=None):
+        self.checkpoint = checkpoint
+        self.moduleid = moduleid
+        self.version = version
+        self._done = done or {}
+
+    @property
+    def key(self):
+        return (self.moduleid, self.version,)
+
+    def __len__(self):
+        return len(self._done)
+
+    def lookup(self, document_id, digest):
+        """Look up the ``module_ident`` of a populated document.
+        Returns None when the document has yet to be populated.
+        """
+        try:
+            recorded_digest, module_ident = self._done[document_id]
+        except KeyError:
+            return None
+        if recorded_digest != digest:
+            return None
+        return module_ident
+
+    def record(self, cursor, document_id, digest, module_ident):
+        """Record the document as populated. This is to be done on the
+        cursor (and thus within the transaction) that populated it.
+        """
+        table = self.checkpoint.table
+        cursor.execute("DELETE FROM {} WHERE collectionid = %s "
+                       "AND collection_version = %s "
+                       "AND document_id = %s;".format(table),
+                       (self.moduleid, self.version, document_id,))
+        cursor.execute("INSERT INTO {} (collectionid, collection_version, "
+                       "  document_id, digest, module_ident) "
+                       "VALUES (%s, %s, %s, %s, %s);".format(table),
+                       (self.moduleid, self.version, document_id, digest,
+                        module_ident,))
+
+
+class Checkpoint(object):
+    """Access to the recorded progress of population runs."""
+    table = 'populate_progress'
+
+    def __init__(self):
+        self._has_table = False
+
+    def _ensure_table(self, cursor):
+        if self._has_table:
+            return
+        cursor.execute("CREATE TABLE IF NOT EXISTS {} ("
+                       "  collectionid TEXT NOT NULL,"
+                       "  collection_version TEXT NOT NULL,"
+                       "  document_id TEXT NOT NULL,"
+                       "  digest TEXT NOT NULL,"
+                       "  module_ident INTEGER NOT NULL,"
+                       "  PRIMARY KEY (collectionid, collection_version,"
+                       "               document_id)"
+                       ");".format(self.table))
+        self._has_table = True
+
+    def for_collection(self, psycopg_conn, moduleid, version):
+        """Retrieve the ``CollectionProgress`` for the collection
+        ``moduleid`` at ``version``. The recorded progress is loaded anew
+        for each run of the collection, so that a run picks up what
+        the previous runs recorded, including those of this process.
+        """
+        key = (moduleid, version,)
+        with psycopg_conn.cursor() as cursor:
+            self._ensure_table(cursor)
+            cursor.execute("SELECT document_id, digest, module_ident "
+                           "FROM {} WHERE collectionid = %s "
+                           "AND collection_version = %s;".format(self.table),
+                           key)
+            done = dict([(document_id, (digest, module_ident,))
+                         for document_id, digest, module_ident
+                         in cursor.fetchall()])
+        return CollectionProgress(self, moduleid, version, done)
+
+
+class FailureLog(object):
+    """A record of the documents that failed to populate, kept in the
+    ``populate_failures`` table so that they can be retried later.
+    A failure is cleared once its document populates (see ``clear``).
+    """
+    table = 'populate_failures'
+
+    def __init__(self):
+        self._failures = None
+
+    def _load(self, cursor):
+        if self._failures is not None:
+            return
+        cursor.execute("CREATE TABLE IF NOT EXISTS {} ("
+                       "  collectionid TEXT NOT NULL,"
+                       "  collection_version TEXT NOT NULL,"
+                       "  document_id TEXT NOT NULL,"
+                       "  error TEXT NOT NULL,"
+                       "  failed TIMESTAMP WITH TIME ZONE "
+                       "    NOT NULL DEFAULT CURRENT_TIMESTAMP,"
+                       "  PRIMARY KEY (collectionid, collection_version,"
+                       "               document_id)"
+                       ");".format(self.table))
+        cursor.execute("SELECT collectionid, collection_version, document_id "
+                       "FROM {};".format(self.table))
+        self._failures = set(cursor.fetchall())
+
+    def record(self, cursor, moduleid, version, document_id, error):
+        """Record the failure of the document, replacing a previous
+        failure of it. This is to be done in the transaction that
+        failed, after rolling back the document.
+        """
+        self._load(cursor)
+        key = (moduleid, version, document_id,)
+        cursor.execute("DELETE FROM {} WHERE collectionid = %s "
+                       "AND collection_version = %s "
+                       "AND document_id = %s;".format(self.table), key)
+        cursor.execute("INSERT INTO {} (collectionid, collection_version, "
+                       "  document_id, error) "
+                       "VALUES (%s, %s, %s, %s);".format(self.table),
+                       key + ('{}: {}'.format(type(error).__name__, error),))
+        self._failures.add(key)
+
+    def clear(self, cursor, moduleid, version, document_id):
+        """Clear the failure of a document that has now populated."""
+        self._load(cursor)
+        key = (moduleid, version, document_id,)
+        if key not in self._failures:
+            return
+        cursor.execute("DELETE FROM {} WHERE collectionid = %s "
+                       "AND collection_version = %s "
+                       "AND document_id = %s;".format(self.table), key)
+        self._failures.discard(key)
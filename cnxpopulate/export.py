@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""Export completezip content to COPY format files without a database,
+and load those exports into a cnx-archive database.
+
+An export is a directory of COPY text format files, one per table (and
+per column set of the modules), with a ``manifest.json`` that lists them
+in the order they are to be loaded. The rows are given ids local to the
+export. The loader gives them ids from the database's sequences
+as it loads them, so exports made independently can be loaded side
+by side.
+"""
+import os
+import re
+import json
+import uuid
+import argparse
+
+import psycopg2
+
+from .archive import (DEFAULT_PSYCOPG_CONNECTION_STRING, _build_rows,
+                      _count_abstracts, _gather_documents, _hash_files,
+                      _read_document)
+from .blobs import BlobIndex
+from .lookups import LicenseTable
+from .metrics import metrics
+from .parsers import parse_collection_xml
+from .pgcopy import CHUNK_SIZE, write_copy_rows
+from .sources import open_source
+
+
+__all__ = ('MANIFEST_FILENAME', 'export_completezip', 'load_export',)
+
+MANIFEST_FILENAME = 'manifest.json'
+MANIFEST_VERSION = 1
+# The id column of the tables whose ids are assigned by the loader.
+ID_COLUMNS = {
+    'abstracts': 'abstractid',
+    'modules': 'module_ident',
+    'files': 'fileid',
+    }
+# The table whose ids are held by each (table, column).
+REFERENCES = {
+    ('abstracts', 'abstractid'): 'abstracts',
+    ('modules', 'module_ident'): 'modules',
+    ('modules', 'abstractid'): 'abstracts',
+    ('files', 'fileid'): 'files',
+    ('module_files', 'module_ident'): 'modules',
+    ('module_files', 'fileid'): 'files',
+    }
+_IDENTIFIER = re.compile(r'^[a-z_][a-z0-9_]*$')
+
+
+def _write_table(output_dir, filename, table, columns, rows):
+    with open(os.path.join(output_dir, filename), 'wb') as fp:
+        write_copy_rows(fp, rows)
+    return {'table': table, 'columns': list(columns), 'file': filename,
+            'rows': len(rows)}
+
+
+def export_completezip(location, output_dir, license_table,
+                       ident_mappings=None):
+    """Export the completezip at ``location`` (see
+    ``archive.populate_from_completezip``) to ``output_dir`` as
+    COPY format files and a manifest. No database is used: the licenses
+    are looked up in the given ``license_table`` (a ``LicenseTable``) and
+    the ids are local to the export. Files of identical content are
+    exported once. Returns the manifest.
+    """
+    if ident_mappings is None:
+        ident_mappings = {}
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open_source(location) as source:
+        fp, digest = _read_document(source, 'collection.xml')
+        with metrics.timer('parse'):
+            collection_parts = parse_collection_xml(fp)
+        collection_metadata = collection_parts[2]
+        moduleid = collection_metadata['moduleid']
+        collection_uuid = ident_mappings.setdefault(moduleid, uuid.uuid4())
+        collection_metadata['uuid'] = str(collection_uuid)
+
+        documents, document_keys = _gather_documents(source, collection_parts,
+                                                     digest)
+        digests = _hash_files(source, documents)
+        abstract_ids = range(1, _count_abstracts(documents) + 1)
+        module_idents = range(1, len(documents) + 1)
+        file_ids = range(1, len(set(digests)) + 1)
+        (abstract_rows, module_rows, file_rows, file_bytes, new_digests,
+         module_file_rows,) = _build_rows(source, documents, license_table,
+                                          abstract_ids, module_idents,
+                                          file_ids, digests, {})
+
+        tables = [_write_table(output_dir, 'abstracts.copy', 'abstracts',
+                               ('abstractid', 'abstract',), abstract_rows)]
+        for i, (columns, rows) in enumerate(sorted(module_rows.items())):
+            tables.append(_write_table(output_dir, 'modules-{}.copy'.format(i),
+                                       'modules', columns, rows))
+        with metrics.timer('export', bytes=file_bytes, rows=len(file_rows)):
+            tables.append(_write_table(output_dir, 'files.copy', 'files',
+                                       ('fileid', 'file',), file_rows))
+        tables.append(_write_table(
+            output_dir, 'module_files.copy', 'module_files',
+            ('module_ident', 'fileid', 'filename', 'mimetype',),
+            module_file_rows))
+
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'collection': {'id': moduleid,
+                       'version': collection_metadata['version'],
+                       'uuid': str(collection_uuid)},
+        'digests': dict([(str(file_id), digest,)
+                         for digest, file_id in new_digests]),
+        'tables': tables,
+        }
+    with open(os.path.join(output_dir, MANIFEST_FILENAME), 'w') as fp:
+        json.dump(manifest, fp, indent=2, sort_keys=True)
+    return manifest
+
+
+def _check_identifier(name):
+    if not _IDENTIFIER.match(name):
+        raise ValueError("Invalid identifier in the manifest, '{}'." \
+                         .format(name))
+    return name
+
+
+def _load_table(cursor, export_dir, index, entry, mapped=0):
+    """Load a table ``entry`` of a manifest. The rows are copied into
+    a staging table, given ids from the sequences and then inserted.
+    The ``mapped`` number of rows have already been given ids (of rows
+    in the database holding the same content) and are not inserted.
+    """
+    table = _check_identifier(entry['table'])
+    if table not in ('abstracts', 'modules', 'files', 'module_files',):
+        raise ValueError("Unknown table in the manifest, '{}'." \
+                         .format(table))
+    columns = [_check_identifier(column) for column in entry['columns']]
+    if mapped and mapped == entry['rows']:
+        return
+    staging = '_staging_{}'.format(index)
+    cursor.execute("CREATE TEMP TABLE {} ON COMMIT DROP AS "
+                   "SELECT {} FROM {} WITH NO DATA;" \
+                   .format(staging, ', '.join(columns), table))
+    with open(os.path.join(export_dir, entry['file']), 'rb') as fp:
+        cursor.copy_expert("COPY {} ({}) FROM STDIN" \
+                           .format(staging, ', '.join(columns)),
+                           fp, size=CHUNK_SIZE)
+
+    id_column = ID_COLUMNS.get(table)
+    if mapped and id_column in columns:
+        cursor.execute("DELETE FROM {0} s USING _ids_{1} m "
+                       "WHERE m.local = s.{2};" \
+                       .format(staging, table, id_column))
+    if id_column in columns:
+        cursor.execute("INSERT INTO _ids_{} (local, id) "
+                       "SELECT {}, nextval(pg_get_serial_sequence(%s, %s)) "
+                       "FROM {};".format(table, id_column, staging),
+                       (table, id_column,))
+    values = []
+    joins = []
+    for column in columns:
+        reference = REFERENCES.get((table, column))
+        if reference is None:
+            values.append('s.{}'.format(column))
+            continue
+        alias = 'm{}'.format(len(joins))
+        values.append('{}.id'.format(alias))
+        joins.append("JOIN _ids_{0} {1} ON {1}.local = s.{2}" \
+                     .format(reference, alias, column))
+    cursor.execute("INSERT INTO {} ({}) SELECT {} FROM {} s {};" \
+                   .format(table, ', '.join(columns), ', '.join(values),
+                           staging, ' '.join(joins)))
+
+
+def load_export(export_dir, psycopg_conn, blob_index=None):
+    """Load the export at ``export_dir`` (see ``export_completezip``) into
+    the database as a single transaction. When a ``BlobIndex`` is given
+    as ``blob_index`` the files whose content is already stored refer to
+    the stored content rather than being loaded again, and the digests
+    of the loaded files are added to it. Returns the manifest.
+    """
+    with open(os.path.join(export_dir, MANIFEST_FILENAME), 'r') as fp:
+        manifest = json.load(fp)
+    if manifest['version'] != MANIFEST_VERSION:
+        raise ValueError("Unsupported export version, '{}'." \
+                         .format(manifest['version']))
+    with psycopg_conn.cursor() as cursor:
+        for table in sorted(ID_COLUMNS):
+            cursor.execute("CREATE TEMP TABLE _ids_{} ("
+                           "  local INTEGER PRIMARY KEY,"
+                           "  id INTEGER NOT NULL"
+                           ") ON COMMIT DROP;".format(table))
+        new_digests = sorted(manifest['digests'].items())
+        if blob_index is not None:
+            # The files of stored content are given the stored ids.
+            new_digests = []
+            for local, digest in sorted(manifest['digests'].items()):
+                fileid = blob_index.get(cursor, digest)
+                if fileid is None:
+                    new_digests.append((local, digest,))
+                    continue
+                cursor.execute("INSERT INTO _ids_files (local, id) "
+                               "VALUES (%s, %s);", (int(local), fileid,))
+        mapped = {'files': len(manifest['digests']) - len(new_digests)}
+        for index, entry in enumerate(manifest['tables']):
+            with metrics.timer('copy', rows=entry['rows']):
+                _load_table(cursor, export_dir, index, entry,
+                            mapped.get(entry['table'], 0))
+        if blob_index is not None:
+            for local, digest in new_digests:
+                cursor.execute("SELECT id FROM _ids_files "
+                               "WHERE local = %s;", (int(local),))
+                fileid = cursor.fetchone()[0]
+                recorded_fileid = blob_index.add(cursor, digest, fileid)
+                if recorded_fileid != fileid:
+                    # Another transaction stored the content at the
+                    #   same time, its copy is used in place of ours.
+                    cursor.execute("UPDATE module_files SET fileid = %s "
+                                   "WHERE fileid = %s;",
+                                   (recorded_fileid, fileid,))
+                    blob_index.discard(cursor, fileid)
+    with metrics.timer('commit'):
+        psycopg_conn.commit()
+    if blob_index is not None:
+        blob_index.commit()
+    return manifest
+
+
+def main(argv=None):
+    """Main commandline interface"""
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+
+    export_parser = subparsers.add_parser(
+        'export', help="export a completezip to COPY format files")
+    export_parser.add_argument('location',
+                               help="an unpacked completezip or complete zip")
+    export_parser.add_argument('output_dir',
+                               help="the directory to write the export to")
+    export_parser.add_argument('-l', '--licenses', required=True,
+                               help="a JSON file of the licenses table")
+
+    load_parser = subparsers.add_parser(
+        'load', help="load exports into the database")
+    load_parser.add_argument('export_dirs', nargs='+', metavar='export_dir')
+    load_parser.add_argument('-p', '--psycopg-conn-str',
+                             default=DEFAULT_PSYCOPG_CONNECTION_STRING,
+                             help="a psycopg2 connection string")
+    load_parser.add_argument('--dedupe-files', action='store_true',
+                             help="record the digests of the loaded files "
+                                  "for deduplication by later runs")
+    args = parser.parse_args(argv)
+
+    if args.command == 'export':
+        license_table = LicenseTable.from_json(args.licenses)
+        export_completezip(args.location, args.output_dir, license_table)
+    elif args.command == 'load':
+        blob_index = None
+        if args.dedupe_files:
+            blob_index = BlobIndex()
+        with psycopg2.connect(args.psycopg_conn_str) as db_connection:
+            for export_dir in args.export_dirs:
+                load_export(export_dir, db_connection, blob_index)
+
+
+if __name__ == '__main__':
+    main()
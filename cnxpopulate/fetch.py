@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""Resumable downloads and a pipeline to acquire content concurrently."""
+import os
+import threading
+try:
+    from urllib2 import HTTPError, Request, urlopen
+except ImportError:
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+__all__ = ('download', 'prefetch',)
+
+CHUNK_SIZE = 64 * 1024
+PARTIAL_SUFFIX = '.part'
+
+
+def download(url, filename, chunk_size=CHUNK_SIZE):
+    """Download ``url`` to ``filename``. The data is written to a partial
+    file alongside ``filename`` until the download completes. When a
+    partial file is found the download is resumed from where it stopped
+    using an HTTP Range request.
+    """
+    partial = filename + PARTIAL_SUFFIX
+    offset = 0
+    if os.path.exists(partial):
+        offset = os.path.getsize(partial)
+    request = Request(url)
+    if offset:
+        request.add_header('Range', 'bytes={}-'.format(offset))
+    try:
+        response = urlopen(request)
+    except HTTPError as exc:
+        if exc.code == 416 and offset:
+            # Nothing beyond what we have, the partial file is complete.
+            os.rename(partial, filename)
+            return filename
+        raise
+    try:
+        # A server that ignores the Range header sends the whole file.
+        mode = offset and response.getcode() == 206 and 'ab' or 'wb'
+        with open(partial, mode) as fp:
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                fp.write(chunk)
+    finally:
+        response.close()
+    os.rename(partial, filename)
+    return filename
+
+
+class _Pending(object):
+    """The pending result of applying a function to an item."""
+
+    def __init__(self, item):
+        self.item = item
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+def _work(func, jobs, stopped):
+    while not stopped.is_set():
+        pending = jobs.get()
+        if pending is None:
+            break
+        try:
+            pending.result = func(pending.item)
+        except Exception as exc:
+            pending.error = exc
+        pending.done.set()
+
+
+def _dispatch(items, jobs, results, workers, stopped):
+    for item in items:
+        if stopped.is_set():
+            break
+        pending = _Pending(item)
+        # Blocks while the consumer is ``queue_size`` results behind.
+        results.put(pending)
+        jobs.put(pending)
+    if not stopped.is_set():
+        results.put(None)
+    for i in range(workers):
+        jobs.put(None)
+
+
+def prefetch(func, items, workers=1, queue_size=2):
+    """Apply ``func`` to each of the ``items`` using a number of
+    ``workers`` threads, generating the results in the order of the items.
+    At most ``queue_size`` results are worked on or held ahead of
+    the consumer, which bounds how far the work runs ahead.
+    An exception raised by ``func`` is raised when its result is reached.
+    """
+    jobs = queue.Queue()
+    results = queue.Queue(maxsize=max(queue_size, 1))
+    stopped = threading.Event()
+    threads = [threading.Thread(target=_work, args=(func, jobs, stopped,))
+               for i in range(workers)]
+    threads.append(threading.Thread(target=_dispatch,
+                                    args=(items, jobs, results, workers,
+                                          stopped,)))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        while True:
+            pending = results.get()
+            if pending is None:
+                break
+            # Wait with a timeout, so that the wait can be interrupted.
+            while not pending.done.wait(1):
+                pass
+            if pending.error is not None:
+                raise pending.error
+            yield pending.result
+    finally:
+        stopped.set()
+        # Unblock the dispatcher, should it be waiting on a full queue.
+        while not results.empty():
+            results.get_nowait()
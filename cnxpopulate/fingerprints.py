@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""Fingerprints of module directories, which allow a version of
+a collection to be loaded incrementally from the previous version.
+
+A module's fingerprint is a digest of the names and contents of all
+the files in its directory (the cnxml and the resources). A module whose
+fingerprint is the same as when it was last populated for the collection
+reuses the rows populated then, rather than being parsed and inserted
+again. Fingerprints are recorded in the ``populate_fingerprints`` table
+within the same transaction as the module they describe.
+"""
+import hashlib
+
+from .blobs import HASH_ALGORITHM, hash_file
+
+
+__all__ = ('fingerprint_module', 'Fingerprints', 'CollectionFingerprints',)
+
+
+def fingerprint_module(source, module_id):
+    """Fingerprint the directory of the module at ``module_id`` within
+    the ``source``. Returns the hex digest.
+    """
+    hasher = hashlib.new(HASH_ALGORITHM)
+    for path in source.list_files(module_id):
+        with source.open(path) as fp:
+            digest = hash_file(fp)
+        hasher.update('{}\0{}\n'.format(path[len(module_id):], digest))
+    return hasher.hexdigest()
+
+
+class CollectionFingerprints(object):
+    """The fingerprints of a collection's modules as they were last
+    populated, each with the ``module_ident`` it was populated as.
+    """
+
+    def __init__(self, fingerprints, moduleid, modules=None):
+        self.fingerprints = fingerprints
+        self.moduleid = moduleid
+        self._modules = modules or {}
+
+    def __len__(self):
+        return len(self._modules)
+
+    def lookup(self, document_id, fingerprint):
+        """Look up the ``module_ident`` the document was last populated
+        as. Returns None when the document has changed since, or has yet
+        to be populated.
+        """
+        try:
+            recorded_fingerprint, module_ident = self._modules[document_id]
+        except KeyError:
+            return None
+        if recorded_fingerprint != fingerprint:
+            return None
+        return module_ident
+
+    def record(self, cursor, document_id, fingerprint, module_ident):
+        """Record the document's fingerprint. This is to be done on the
+        cursor (and thus within the transaction) that populated it.
+        """
+        table = self.fingerprints.table
+        cursor.execute("DELETE FROM {} WHERE collectionid = %s "
+                       "AND document_id = %s;".format(table),
+                       (self.moduleid, document_id,))
+        cursor.execute("INSERT INTO {} (collectionid, document_id, "
+                       "  fingerprint, module_ident) "
+                       "VALUES (%s, %s, %s, %s);".format(table),
+                       (self.moduleid, document_id, fingerprint,
+                        module_ident,))
+
+
+class Fingerprints(object):
+    """Access to the recorded fingerprints of populated modules."""
+    table = 'populate_fingerprints'
+
+    def __init__(self):
+        self._has_table = False
+
+    def _ensure_table(self, cursor):
+        if self._has_table:
+            return
+        cursor.execute("CREATE TABLE IF NOT EXISTS {} ("
+                       "  collectionid TEXT NOT NULL,"
+                       "  document_id TEXT NOT NULL,"
+                       "  fingerprint TEXT NOT NULL,"
+                       "  module_ident INTEGER NOT NULL,"
+                       "  PRIMARY KEY (collectionid, document_id)"
+                       ");".format(self.table))
+        self._has_table = True
+
+    def for_collection(self, psycopg_conn, moduleid):
+        """Retrieve the ``CollectionFingerprints`` for the collection
+        ``moduleid``. Unlike a checkpoint's progress these are loaded
+        anew for each version, as populating a version changes them.
+        """
+        with psycopg_conn.cursor() as cursor:
+            self._ensure_table(cursor)
+            cursor.execute("SELECT document_id, fingerprint, module_ident "
+                           "FROM {} WHERE collectionid = %s;" \
+                           .format(self.table), (moduleid,))
+            modules = dict([(document_id, (fingerprint, module_ident,))
+                            for document_id, fingerprint, module_ident
+                            in cursor.fetchall()])
+        return CollectionFingerprints(self, moduleid, modules)
@@ -5,32 +5,107 @@
 # See LICENCE.txt for details.
 # ###
 # Partial usage of the kadabra package
+"""Guess the mime-type and encoding of content using libmagic.
+Only a prefix of at most ``SNIFF_SIZE`` bytes is examined and the results
+are cached by the digest of that prefix. Each thread has its own magic
+handles, because they can't be shared between threads.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
 import magic
 
 
-__all__ = ('guess_type', 'guess_encoding',)
+__all__ = ('guess_type', 'guess_encoding', 'classify',)
 
-_mime_type_magic = None
-_mime_encoding_magic = None
+# Number of bytes read from the start of a buffer to make a guess.
+SNIFF_SIZE = 64 * 1024
+# Number of guesses kept in the cache.
+CACHE_SIZE = 4096
 
+_local = threading.local()
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
 
-def guess_type(buf):
-    """Guesses the mime-type"""
-    global _mime_type_magic
-    if _mime_type_magic is None:
-        _mime_type_magic = magic.Magic(mime=True)
+
+def _magic(name):
+    """Retrieve this thread's magic handle, where ``name`` is either
+    'mime' or 'mime_encoding'.
+    """
     try:
-        return _mime_type_magic.from_buffer(buf.read())
+        return getattr(_local, name)
     except AttributeError:
-        return _mime_type_magic.from_buffer(buf)
+        handle = magic.Magic(**{name: True})
+        setattr(_local, name, handle)
+        return handle
 
 
-def guess_encoding(buf):
-    """Guesses the encoding type for the given buffer."""
-    global _mime_encoding_magic
-    if _mime_encoding_magic is None:
-        _mime_encoding_magic = magic.Magic(mime_encoding=True)
+def _prefix(buf, size=SNIFF_SIZE):
+    """Read at most ``size`` bytes from the start of ``buf``, which is
+    either a file object or a string, buffer or memoryview. A file object
+    is read from its current position and then put back there, while file
+    data (see ``cnxpopulate.FileData``) is viewed from its start.
+    """
     try:
-        return _mime_encoding_magic.from_buffer(buf.read())
+        view = buf.view
     except AttributeError:
-        return _mime_encoding_magic.from_buffer(buf)
+        pass
+    else:
+        return bytes(view(0, size))
+    try:
+        read = buf.read
+    except AttributeError:
+        data = buf[:size]
+    else:
+        try:
+            position = buf.tell()
+        except (AttributeError, IOError,):
+            position = None
+        data = read(size)
+        if position is not None:
+            buf.seek(position)
+    try:
+        return data.tobytes()
+    except AttributeError:
+        return bytes(data)
+
+
+def _guess(name, prefix):
+    key = (name, hashlib.sha1(prefix).digest(),)
+    with _cache_lock:
+        try:
+            result = _cache.pop(key)
+        except KeyError:
+            pass
+        else:
+            _cache[key] = result
+            return result
+    result = _magic(name).from_buffer(prefix)
+    with _cache_lock:
+        _cache[key] = result
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return result
+
+
+def guess_type(buf):
+    """Guesses the mime-type"""
+    return _guess('mime', _prefix(buf))
+
+
+def guess_encoding(buf):
+    """Guesses the encoding type for the given buffer."""
+    return _guess('mime_encoding', _prefix(buf))
+
+
+def classify(bufs):
+    """Guesses the mime-type and encoding of each of the ``bufs``.
+    Returns a list of (mime-type, encoding) tuples.
+    """
+    results = []
+    for buf in bufs:
+        prefix = _prefix(buf)
+        results.append((_guess('mime', prefix),
+                        _guess('mime_encoding', prefix),))
+    return results
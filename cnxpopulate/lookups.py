@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""Cached lookup tables for data that is constant in the database."""
+import json
+
+
+__all__ = ('normalize_url', 'LicenseTable', 'get_license_table',)
+
+# Cached license tables keyed by the connection's dsn,
+#   see ``get_license_table``.
+_license_tables = {}
+
+
+def normalize_url(url):
+    """Normalize a license url for lookup purposes, so that for example
+    ``.../by/2.0/`` and ``.../by/2.0`` are considered the same.
+    """
+    return url.strip().rstrip('/')
+
+
+class LicenseTable(object):
+    """The licenses indexed by their normalized url. Each license is
+    a dictionary with the keys ``id``, ``code``, ``version``, ``name``
+    and ``url``, as found in the ``licenses`` table.
+    """
+
+    def __init__(self, licenses=()):
+        self._licenses = {}
+        for license in licenses:
+            self._licenses[normalize_url(license['url'])] = license
+
+    def __len__(self):
+        return len(self._licenses)
+
+    def __iter__(self):
+        return iter(self._licenses.values())
+
+    @classmethod
+    def from_cursor(cls, cursor):
+        """Load the licenses from the database with a single query."""
+        cursor.execute("SELECT licenseid, code, version, name, url "
+                       "FROM licenses;")
+        keys = ('id', 'code', 'version', 'name', 'url',)
+        return cls([dict(zip(keys, row)) for row in cursor.fetchall()])
+
+    @classmethod
+    def from_json(cls, filepath):
+        """Load the licenses from a JSON file of license dictionaries."""
+        with open(filepath, 'r') as fp:
+            return cls(json.load(fp))
+
+    def get(self, url):
+        """Look up the license for ``url``. Returns None when the
+        license is not known.
+        """
+        return self._licenses.get(normalize_url(url))
+
+    def get_id(self, url):
+        """Look up the license id for ``url``."""
+        try:
+            return self._licenses[normalize_url(url)]['id']
+        except KeyError:
+            raise ValueError("Unknown license url, '{}'.".format(url))
+
+
+def get_license_table(psycopg_conn):
+    """Retrieve the ``LicenseTable`` for the database ``psycopg_conn`` is
+    connected to. The licenses are queried once per database and then
+    served from memory, because license data is constant.
+    """
+    try:
+        return _license_tables[psycopg_conn.dsn]
+    except KeyError:
+        with psycopg_conn.cursor() as cursor:
+            table = LicenseTable.from_cursor(cursor)
+        _license_tables[psycopg_conn.dsn] = table
+        return table
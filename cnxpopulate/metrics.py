@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""Timers and counters for the stages of population (download, unzip,
+read, parse, license lookup, insert, upload, copy and commit).
+The stages are measured in the module level ``metrics``, which can be
+reported as a progress line, a JSON summary or a Prometheus textfile.
+"""
+import os
+import sys
+import time
+import json
+import pstats
+import cProfile
+import threading
+import contextlib
+from collections import OrderedDict
+
+
+__all__ = ('Metrics', 'ProgressReporter', 'metrics',
+           'add_instrumentation_arguments', 'instrument',)
+
+METRIC_PREFIX = 'cnxpopulate'
+_COUNTERS = (
+    ('calls', 'Number of times the stage ran.',),
+    ('seconds', 'Time spent in the stage.',),
+    ('bytes', 'Bytes processed by the stage.',),
+    ('rows', 'Database rows written by the stage.',),
+    )
+
+
+class _Measure(object):
+    """The bytes and rows of a timed stage, which can be set while
+    the stage runs (see ``Metrics.timer``).
+    """
+
+    def __init__(self, bytes=0, rows=0):
+        self.bytes = bytes
+        self.rows = rows
+
+
+def _format_bytes(value):
+    for unit in ('B', 'KiB', 'MiB', 'GiB',):
+        if value < 1024:
+            break
+        value /= 1024.0
+    return "{:.1f}{}".format(value, unit)
+
+
+class Metrics(object):
+    """Thread-safe totals of the calls, seconds, bytes and rows of each
+    stage of population.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self._stages = OrderedDict()
+
+    def add(self, stage, seconds=0.0, bytes=0, rows=0, calls=1):
+        with self._lock:
+            totals = self._stages.setdefault(
+                stage, dict([(name, 0,) for name, help in _COUNTERS]))
+            totals['calls'] += calls
+            totals['seconds'] += seconds
+            totals['bytes'] += bytes
+            totals['rows'] += rows
+
+    @contextlib.contextmanager
+    def timer(self, stage, bytes=0, rows=0):
+        """Time the ``stage`` of the with block. The block is given
+        a measure whose ``bytes`` and ``rows`` can be set when they aren't
+        known up front.
+        """
+        measure = _Measure(bytes, rows)
+        start = time.time()
+        try:
+            yield measure
+        finally:
+            self.add(stage, time.time() - start, measure.bytes, measure.rows)
+
+    def snapshot(self):
+        """A copy of the totals of each stage, see ``merge``."""
+        with self._lock:
+            return [(stage, totals.copy(),)
+                    for stage, totals in self._stages.items()]
+
+    def merge(self, snapshot):
+        """Add the totals of a ``snapshot`` of another ``Metrics``,
+        for example one kept by a worker process.
+        """
+        for stage, totals in snapshot:
+            self.add(stage, **totals)
+
+    def summary(self):
+        """The totals and rates of each stage as a dictionary."""
+        stages = OrderedDict()
+        for stage, totals in self.snapshot():
+            seconds = totals['seconds']
+            totals['bytes_per_second'] = seconds and totals['bytes'] / seconds
+            totals['rows_per_second'] = seconds and totals['rows'] / seconds
+            stages[stage] = totals
+        return {'elapsed': time.time() - self.started, 'stages': stages}
+
+    def format_progress(self):
+        """Format the totals as a single line of progress."""
+        summary = self.summary()
+        parts = ["{:.1f}s".format(summary['elapsed'])]
+        for stage, totals in summary['stages'].items():
+            part = "{} {}x {:.1f}s".format(stage, totals['calls'],
+                                           totals['seconds'])
+            if totals['bytes']:
+                part += " {} ({}/s)".format(
+                    _format_bytes(totals['bytes']),
+                    _format_bytes(totals['bytes_per_second']))
+            if totals['rows']:
+                part += " {} rows ({:.1f}/s)".format(totals['rows'],
+                                                     totals['rows_per_second'])
+            parts.append(part)
+        return ' | '.join(parts)
+
+    def write_json(self, filepath):
+        with open(filepath, 'w') as fp:
+            json.dump(self.summary(), fp, indent=2)
+
+    def write_prometheus(self, filepath, prefix=METRIC_PREFIX):
+        """Write the totals to ``filepath`` in the Prometheus text format,
+        as read by the node exporter's textfile collector. The file is
+        replaced rather than rewritten, so it is never read half written.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for name, help in _COUNTERS:
+            metric = '{}_stage_{}_total'.format(prefix, name)
+            lines.append('# HELP {} {}'.format(metric, help))
+            lines.append('# TYPE {} counter'.format(metric))
+            for stage, totals in snapshot:
+                lines.append('{}{{stage="{}"}} {}'.format(metric, stage,
+                                                          totals[name]))
+        partial = filepath + '.tmp'
+        with open(partial, 'w') as fp:
+            fp.write('\n'.join(lines) + '\n')
+        os.rename(partial, filepath)
+
+
+class ProgressReporter(object):
+    """Write a progress line for ``metrics`` to ``stream`` every
+    ``interval`` seconds from a background thread. The Prometheus textfile
+    is also refreshed when a ``prometheus_textfile`` is given.
+    """
+
+    def __init__(self, metrics, interval=30, stream=None,
+                 prometheus_textfile=None):
+        self.metrics = metrics
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self.prometheus_textfile = prometheus_textfile
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.report()
+
+    def report(self):
+        self.stream.write(self.metrics.format_progress() + '\n')
+        self.stream.flush()
+        if self.prometheus_textfile is not None:
+            self.metrics.write_prometheus(self.prometheus_textfile)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+
+# The metrics of this process.
+metrics = Metrics()
+
+
+def add_instrumentation_arguments(parser):
+    """Add the arguments of ``instrument`` to the ``argparse`` ``parser``."""
+    parser.add_argument('--progress-interval', type=float, default=30,
+                        help="seconds between progress lines, "
+                             "0 to disable (default: %(default)s)")
+    parser.add_argument('--metrics-json',
+                        help="write a JSON summary of the stage timings "
+                             "to this file at exit")
+    parser.add_argument('--prometheus-textfile',
+                        help="write the stage metrics to this file in "
+                             "the Prometheus text format")
+    parser.add_argument('--profile',
+                        help="profile the run (the main thread) with "
+                             "cProfile and write the stats to this file")
+
+
+@contextlib.contextmanager
+def instrument(args, metrics=metrics, stream=None):
+    """Instrument the with block according to the parsed ``args``
+    (see ``add_instrumentation_arguments``).
+    """
+    stream = stream or sys.stderr
+    metrics.reset()
+    reporter = None
+    if args.progress_interval > 0:
+        reporter = ProgressReporter(metrics, args.progress_interval, stream,
+                                    args.prometheus_textfile)
+        reporter.start()
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield metrics
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            stats = pstats.Stats(args.profile, stream=stream)
+            stats.sort_stats('cumulative').print_stats(25)
+        if reporter is not None:
+            reporter.stop()
+        stream.write(metrics.format_progress() + '\n')
+        if args.metrics_json:
+            metrics.write_json(args.metrics_json)
+        if args.prometheus_textfile:
+            metrics.write_prometheus(args.prometheus_textfile)
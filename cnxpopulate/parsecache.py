@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""A persistent cache of parsed documents, so that populating the same
+content again (e.g. after a database problem) skips the XML parsing.
+
+The results of ``parse_collection_xml`` and ``parse_module_xml`` are kept
+in a local SQLite database, keyed by the parser, the digest of the
+document's content and the ``parsers.PARSER_VERSION``. The least recently
+used results are evicted once the cache grows beyond its size limit.
+"""
+import sqlite3
+import threading
+import time
+import zlib
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from .parsers import PARSER_VERSION
+
+
+__all__ = ('ParseCache',)
+
+# Size in bytes the cache is kept within by default.
+MAX_SIZE = 256 * 1024 * 1024
+# Eviction frees space down to this fraction of the size limit,
+#   so that it isn't needed again on the very next result.
+EVICTION_RATIO = 0.9
+
+
+class ParseCache(object):
+    """A cache of parsed documents in the SQLite database at ``path``,
+    which holds at most ``max_size`` bytes of (compressed) results.
+    Results of parser versions other than ``version`` are dropped
+    when the cache is opened. An instance can be shared between threads,
+    and several processes can use the same database.
+    """
+    table = 'parse_results'
+
+    def __init__(self, path, max_size=MAX_SIZE, version=PARSER_VERSION):
+        self.path = path
+        self.max_size = max_size
+        self.version = version
+        self._lock = threading.Lock()
+        # Each statement is committed on its own. The cache holds nothing
+        #   that can't be parsed again, so it isn't synced to disk.
+        self._conn = sqlite3.connect(path, timeout=60,
+                                     isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.execute("PRAGMA synchronous = OFF;")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS {} ("
+                           "  kind TEXT NOT NULL,"
+                           "  digest TEXT NOT NULL,"
+                           "  version INTEGER NOT NULL,"
+                           "  result BLOB NOT NULL,"
+                           "  size INTEGER NOT NULL,"
+                           "  used REAL NOT NULL,"
+                           "  PRIMARY KEY (kind, digest, version)"
+                           ");".format(self.table))
+        self._conn.execute("CREATE INDEX IF NOT EXISTS {0}_used "
+                           "ON {0} (used);".format(self.table))
+        self._conn.execute("DELETE FROM {} WHERE version != ?;" \
+                           .format(self.table), (version,))
+        self._size = self._total_size()
+
+    def __repr__(self):
+        return "<{} '{}'>".format(self.__class__.__name__, self.path)
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT count(*) FROM {};" \
+                                      .format(self.table)).fetchone()[0]
+
+    def _total_size(self):
+        return self._conn.execute("SELECT coalesce(sum(size), 0) FROM {};" \
+                                  .format(self.table)).fetchone()[0]
+
+    def get(self, kind, digest):
+        """Look up the result of the ``kind`` of parser (its name) for
+        the document of content ``digest``. Returns None when it isn't
+        cached.
+        """
+        key = (kind, digest, self.version,)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT result FROM {} WHERE kind = ? AND digest = ? "
+                "AND version = ?;".format(self.table), key).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE {} SET used = ? WHERE kind = ? "
+                               "AND digest = ? AND version = ?;" \
+                               .format(self.table), (time.time(),) + key)
+        return pickle.loads(zlib.decompress(bytes(row[0])))
+
+    def put(self, kind, digest, result):
+        """Keep the ``result`` of the ``kind`` of parser for the document
+        of content ``digest``, evicting the least recently used results
+        when the cache grows beyond its size limit.
+        """
+        data = zlib.compress(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO {} "
+                               "  (kind, digest, version, result, size, used) "
+                               "VALUES (?, ?, ?, ?, ?, ?);" \
+                               .format(self.table),
+                               (kind, digest, self.version,
+                                sqlite3.Binary(data), len(data), time.time(),))
+            self._size += len(data)
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        # The size is recounted, as other processes may share the cache.
+        size = self._total_size()
+        limit = int(self.max_size * EVICTION_RATIO)
+        evicted = []
+        if size > self.max_size:
+            rows = self._conn.execute("SELECT kind, digest, version, size "
+                                      "FROM {} ORDER BY used;" \
+                                      .format(self.table)).fetchall()
+            for kind, digest, version, row_size in rows:
+                if size <= limit:
+                    break
+                evicted.append((kind, digest, version,))
+                size -= row_size
+            self._conn.executemany("DELETE FROM {} WHERE kind = ? "
+                                   "AND digest = ? AND version = ?;" \
+                                   .format(self.table), evicted)
+        self._size = size
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
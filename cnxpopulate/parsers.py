@@ -10,11 +10,22 @@ import os
 import lxml.etree
 
 
-__all__ = ('parse_collection_xml', 'parse_module_xml',)
+__all__ = ('parse_collection_xml', 'parse_module_xml', 'compile_xpath',
+           'PARSER_VERSION',)
 
 
-def _generate_xpath_func(xml_doc, default_namespace_name='base'):
-    """Generates an easy to work with xpath function."""
+ROLE_TYPES = ('author', 'maintainer', 'licensor',)
+# The version of the parsers' results. This is to be incremented whenever
+#   a change alters what the parsers return, which invalidates the results
+#   kept by a ``parsecache.ParseCache``.
+PARSER_VERSION = 1
+# Compiled xpath expressions keyed by the expression and namespace mapping,
+#   see ``compile_xpath``.
+_compiled_xpaths = {}
+
+
+def _namespaces(xml_doc, default_namespace_name='base'):
+    """Generates the namespace prefix mapping used in xpath expressions."""
     nsmap = xml_doc.nsmap.copy()
     try:
         nsmap[default_namespace_name] = nsmap.pop(None)
@@ -26,11 +37,33 @@ def _generate_xpath_func(xml_doc, default_namespace_name='base'):
         #   document tag and again in the metadata tag.
         nsmap['md4'] = "http://cnx.rice.edu/mdml/0.4"
         nsmap['md'] = "http://cnx.rice.edu/mdml"
-    return lambda xpth: xml_doc.xpath(xpth, namespaces=nsmap)
+    return nsmap
+
+
+def compile_xpath(expression, namespaces):
+    """Compile the xpath ``expression`` for the ``namespaces`` mapping.
+    Each expression and namespace mapping pair is only compiled once.
+    """
+    key = (expression, tuple(sorted(namespaces.items())),)
+    try:
+        return _compiled_xpaths[key]
+    except KeyError:
+        xpath = lxml.etree.XPath(expression, namespaces=namespaces)
+        _compiled_xpaths[key] = xpath
+        return xpath
 
 
-def _parse_common_elements(xml_doc):
-    """Parse the common elements between a ColXML and CnXML files."""
+def _generate_xpath_func(xml_doc, default_namespace_name='base'):
+    """Generates an easy to work with xpath function."""
+    nsmap = _namespaces(xml_doc, default_namespace_name)
+    return lambda xpth: compile_xpath(xpth, nsmap)(xml_doc)
+
+
+def _xpath_parse_common_elements(xml_doc):
+    """Parse the common elements between a ColXML and CnXML files.
+    This is the reference implementation of ``_parse_common_elements``,
+    which makes a separate pass over the document for each value.
+    """
     xpath = _generate_xpath_func(xml_doc)
 
     # Pull the abstract
@@ -73,6 +106,107 @@ def _parse_common_elements(xml_doc):
     return [abstract, license, metadata]
 
 
+def _text_nodes(element):
+    """The equivalent of the ``text()`` xpath for ``element``."""
+    nodes = []
+    if element.text is not None:
+        nodes.append(element.text)
+    for child in element:
+        if child.tail is not None:
+            nodes.append(child.tail)
+    return nodes
+
+
+def _string_value(element):
+    return ''.join(element.itertext())
+
+
+def _parse_common_elements(xml_doc, extra_tag=None):
+    """Parse the common elements between a ColXML and CnXML files.
+    This walks the document once, rather than once per value, and gives
+    the same results as ``_xpath_parse_common_elements``.
+    Elements matching the optional ``extra_tag`` are collected during the
+    same walk and returned as a fourth item.
+    """
+    md = _namespaces(xml_doc).get('md')
+    if md is None:
+        # Without the prefix the xpath implementation raises an error,
+        #   which is left to it to do.
+        data = _xpath_parse_common_elements(xml_doc)
+        if extra_tag is not None:
+            data.append(list(xml_doc.iter(extra_tag)))
+        return data
+
+    def qname(name):
+        return '{{{}}}{}'.format(md, name)
+    single_value_tags = dict([(qname(name), name) for name in (
+        'abstract', 'content-id', 'version', 'title', 'language',)])
+    license_tag = qname('license')
+    roles_tag, role_tag = qname('roles'), qname('role')
+
+    values = {}
+    license = None
+    roles = dict([(type_, []) for type_ in ROLE_TYPES])
+    extras = []
+    tags = single_value_tags.keys() + [license_tag, role_tag]
+    if extra_tag is not None:
+        tags.append(extra_tag)
+    for element in xml_doc.iter(*tags):
+        tag = element.tag
+        if tag == extra_tag:
+            extras.append(element)
+        elif tag == license_tag:
+            if license is None:
+                license = element.get('url')
+        elif tag == role_tag:
+            parent = element.getparent()
+            if parent is None or parent.tag != roles_tag:
+                continue
+            # Mirrors the ``md:role[type="..."]`` predicate, which tests
+            #   for a ``type`` child element rather than the attribute.
+            types = set([_string_value(child) for child in element
+                         if child.tag == 'type'])
+            for type_ in ROLE_TYPES:
+                if type_ in types:
+                    roles[type_].extend(_text_nodes(element))
+        elif single_value_tags[tag] not in values:
+            nodes = _text_nodes(element)
+            if nodes:
+                values[single_value_tags[tag]] = nodes[0]
+
+    # Pull the abstract
+    abstract = values.get('abstract')
+
+    # Pull the license
+    if license is None:
+        raise ValueError("Missing license metadata.")
+
+    def value(name):
+        try:
+            return values[name]
+        except KeyError:
+            raise IndexError("Missing {} metadata.".format(name))
+
+    # Pull the collection metadata
+    metadata = {
+        'moduleid': value('content-id'),
+        'version': value('version'),
+        'name': value('title'),
+        'doctype': '',  # Can't be null, but appears unused.
+        'submitter': '',
+        'submitlog': '',
+        'language': value('language'),
+        'authors': roles['author'],
+        'maintainers': roles['maintainer'],
+        'licensors': roles['licensor'],
+        }
+
+    data = [abstract, license, metadata]
+    if extra_tag is not None:
+        data.append(extras)
+    return data
+
+
 def parse_collection_xml(fp):
     """Parse into the file into segments that will fit into the database.
     Returns the abstract content, license url, metadata dictionary,
@@ -81,13 +215,14 @@ def parse_collection_xml(fp):
     # Parse the document
     tree = lxml.etree.parse(fp)
     doc = tree.getroot()
-    xpath = _generate_xpath_func(doc, 'colxml')
+    module_tag = '{{{}}}module'.format(_namespaces(doc, 'colxml')['colxml'])
 
-    data = _parse_common_elements(doc)
+    data = _parse_common_elements(doc, module_tag)
     data[2]['portal_type'] = 'Collection'
     # Pull the linked content (modules)
-    contents = xpath('//colxml:module/@document')[:]
-    data.append(contents)
+    contents = [e.get('document') for e in data[3]
+                if e.get('document') is not None]
+    data[3] = contents
     return data
 
 
@@ -100,14 +235,17 @@ def parse_module_xml(fp):
     # Parse the document
     tree = lxml.etree.parse(fp)
     doc = tree.getroot()
-    xpath = _generate_xpath_func(doc, 'cnxml')
+    image_tag = '{{{}}}image'.format(_namespaces(doc, 'cnxml')['cnxml'])
 
-    data = _parse_common_elements(doc)
+    data = _parse_common_elements(doc, image_tag)
     data[2]['portal_type'] = 'Module'
     # Pull the linked content (modules)
-    resources = [(e.get('src'), e.get('mime-type'),)
-                 for e in xpath('//cnxml:image')]
-    filenames = [filename for filename, mimetype in resources]
-    resources = [r for i, r in enumerate(resources) if r[0] not in filenames[:i]]
-    data.append(resources)
+    resources = []
+    seen = set()
+    for e in data[3]:
+        filename = e.get('src')
+        if filename not in seen:
+            seen.add(filename)
+            resources.append((filename, e.get('mime-type'),))
+    data[3] = resources
     return data
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""Utilities for streaming rows into PostgreSQL with ``COPY``."""
+import binascii
+
+
+__all__ = ('format_copy_value', 'format_copy_row', 'iter_copy_data',
+           'write_copy_rows', 'CopyDataReader', 'copy_rows', 'allocate_ids',
+           'Blob', 'BlobPath',)
+
+# Size of the chunks read from disk when streaming a blob into COPY data.
+CHUNK_SIZE = 64 * 1024
+_COPY_ESCAPES = (
+    ('\\', '\\\\'),
+    ('\t', '\\t'),
+    ('\n', '\\n'),
+    ('\r', '\\r'),
+    )
+
+
+class Blob(object):
+    """A value to be copied as ``bytea`` whose contents are read from the
+    file object returned by the ``opener`` callable. The contents are read
+    in chunks when the COPY data is written, so the blob is never held
+    in memory as a whole.
+    """
+
+    def __init__(self, opener):
+        self.open = opener
+
+
+class BlobPath(str):
+    """A filesystem path whose contents are to be copied as ``bytea``,
+    in the same manner as a ``Blob``.
+    """
+
+    def open(self):
+        return open(self, 'rb')
+
+
+def _escape(text):
+    for char, replacement in _COPY_ESCAPES:
+        text = text.replace(char, replacement)
+    return text
+
+
+def _to_text(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _format_array(values):
+    """Format a sequence as a PostgreSQL array literal."""
+    elements = []
+    for value in values:
+        if value is None:
+            elements.append('NULL')
+            continue
+        value = _to_text(value).replace('\\', '\\\\').replace('"', '\\"')
+        elements.append('"{}"'.format(value))
+    return '{' + ','.join(elements) + '}'
+
+
+def format_copy_value(value):
+    """Format a single python value as a field of COPY text format data."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, (list, tuple,)):
+        return _escape(_format_array(value))
+    if isinstance(value, (bytearray, buffer,)):
+        return _escape('\\x' + binascii.hexlify(value))
+    if isinstance(value, bool):
+        return value and 't' or 'f'
+    return _escape(_to_text(value))
+
+
+def format_copy_row(values):
+    """Format a sequence of values as a line of COPY text format data."""
+    return '\t'.join([format_copy_value(v) for v in values]) + '\n'
+
+
+def _iter_blob(blob):
+    # The hex form of bytea is escaped as '\\x' in COPY text format.
+    yield '\\\\x'
+    with blob.open() as fp:
+        while True:
+            chunk = fp.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield binascii.hexlify(chunk)
+
+
+def iter_copy_data(rows):
+    """Generate the COPY text data for the ``rows`` in pieces.
+    Values that are ``Blob`` or ``BlobPath`` instances are streamed
+    in chunks of ``CHUNK_SIZE``.
+    """
+    for row in rows:
+        for i, value in enumerate(row):
+            if i:
+                yield '\t'
+            if isinstance(value, (Blob, BlobPath,)):
+                for piece in _iter_blob(value):
+                    yield piece
+            else:
+                yield format_copy_value(value)
+        yield '\n'
+
+
+def write_copy_rows(out, rows):
+    """Write the ``rows`` to the ``out`` file object as COPY text data."""
+    for piece in iter_copy_data(rows):
+        out.write(piece)
+
+
+class CopyDataReader(object):
+    """A read-only file object over the COPY text data for ``rows``.
+    The data is generated as it is read, so memory use stays flat
+    regardless of the size of the rows.
+    """
+
+    def __init__(self, rows):
+        self._pieces = iter_copy_data(rows)
+        self._buffer = ''
+
+    def read(self, size=-1):
+        pieces = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            try:
+                piece = next(self._pieces)
+            except StopIteration:
+                break
+            pieces.append(piece)
+            length += len(piece)
+        data = ''.join(pieces)
+        if size < 0:
+            self._buffer = ''
+            return data
+        self._buffer = data[size:]
+        return data[:size]
+
+
+def copy_rows(cursor, table, columns, rows):
+    """Stream the ``rows`` into ``table`` using ``COPY ... FROM STDIN``."""
+    cursor.copy_expert("COPY {} ({}) FROM STDIN".format(
+                           table, ', '.join(columns)),
+                       CopyDataReader(rows), size=CHUNK_SIZE)
+
+
+def allocate_ids(cursor, table, column, count):
+    """Pre-allocate ``count`` ids from the sequence behind ``column``
+    on ``table``. The ids are returned in ascending order.
+    """
+    if count <= 0:
+        return []
+    cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, %s)) "
+                   "FROM generate_series(1, %s);", (table, column, count,))
+    return sorted([row[0] for row in cursor.fetchall()])
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""A pipelined variant of ``archive.populate_from_completezip`` that
+overlaps the reading and parsing of modules with the database writes.
+
+A pool of reader threads reads, hashes and parses the modules ahead of
+the writer, which is the calling thread and the only user of the
+database connection. The modules are written in their collection order
+using the same statements as ``populate_from_completezip`` (the reference
+implementation), so both produce the same rows. At most ``queue_size``
+modules are held ahead of the writer, which bounds the memory used.
+"""
+import threading
+
+from .archive import (STREAM_THRESHOLD, _commit, _get_license_id,
+                      _insert_file, _insert_file_data, _insert_module,
+                      _insert_module_file, _insert_module_files,
+                      _parse_document, _populate_collection,
+                      _read_document, _resolve_resources)
+from .blobs import read_and_hash_file
+from .fetch import prefetch
+from .metrics import metrics
+from .parsers import parse_module_xml
+from .sources import get_source, open_source
+from .statements import PreparedStatements
+
+
+__all__ = ('pipelined_populate_from_completezip',)
+
+READERS = 4
+QUEUE_SIZE = 8
+
+
+class _PreparedModule(object):
+    """A module that has been read and parsed, ready to be written.
+    Each of the ``files`` is a tuple of (filename, mimetype, path, data,
+    digest), where the data is None for a file that is too large to be
+    held in memory and will be streamed by the writer.
+    """
+
+    def __init__(self, module_id, digest, parts, files):
+        self.module_id = module_id
+        self.digest = digest
+        self.parts = parts
+        self.files = files
+
+
+class _Reader(object):
+    """Reads modules of the completezip at ``location`` for the reader
+    threads. Each thread opens a source of its own, because a zip file
+    can't be read by several threads at once.
+    """
+
+    def __init__(self, location, hash_files=False,
+                 stream_threshold=STREAM_THRESHOLD, parse_cache=None):
+        self.location = location
+        self.hash_files = hash_files
+        self.stream_threshold = stream_threshold
+        self.parse_cache = parse_cache
+        self._local = threading.local()
+        self._sources = []
+        self._lock = threading.Lock()
+
+    def _source(self):
+        try:
+            return self._local.source
+        except AttributeError:
+            source = get_source(self.location)
+            with self._lock:
+                self._sources.append(source)
+            self._local.source = source
+            return source
+
+    def close(self):
+        with self._lock:
+            for source in self._sources:
+                source.close()
+            self._sources = []
+
+    def _read_file(self, source, path):
+        size = source.getsize(path)
+        if self.stream_threshold is not None and size > self.stream_threshold:
+            return None, None
+        with metrics.timer('read', bytes=size):
+            with source.open(path) as fp:
+                if self.hash_files:
+                    return read_and_hash_file(fp)
+                return fp.read(), None
+
+    def __call__(self, module_id):
+        source = self._source()
+        content_file_path = '/'.join([module_id, 'index.cnxml'])
+        content_w_metadata_file_path = '/'.join([module_id,
+                                                 'index_auto_generated.cnxml'])
+        fp, digest = _read_document(source, content_w_metadata_file_path)
+        parts = _parse_document(parse_module_xml, fp, digest,
+                                self.parse_cache)
+        files = [('index.cnxml', 'text/xml', content_file_path,)]
+        files.extend(_resolve_resources(source, module_id, parts[3]))
+        files = [file + self._read_file(source, file[2]) for file in files]
+        return _PreparedModule(module_id, digest, parts, files)
+
+
+def _write_module(psycopg_conn, source, module, blob_index=None,
+                  stream_threshold=STREAM_THRESHOLD, progress=None,
+                  abstract_index=None, statements=None):
+    """Write the prepared ``module`` to the database, in the same manner
+    as ``archive.populate_module``. Returns the ``module_ident``.
+    """
+    if progress is not None:
+        content_id = progress.lookup(module.module_id, module.digest)
+        if content_id is not None:
+            return content_id
+    abstract, license_url, metadata, resources = module.parts
+    license_id = _get_license_id(psycopg_conn, license_url)
+    with psycopg_conn.cursor() as cursor:
+        content_id = _insert_module(cursor, abstract, license_id, metadata,
+                                    abstract_index, statements)
+        if statements is not None:
+            _insert_module_files(cursor, source, content_id, module.files,
+                                 statements, blob_index, stream_threshold)
+        else:
+            for filename, mimetype, path, data, digest in module.files:
+                if data is None:
+                    file_id = _insert_file(cursor, source, path, blob_index,
+                                           stream_threshold)
+                else:
+                    with metrics.timer('upload', bytes=len(data), rows=1):
+                        file_id = _insert_file_data(cursor, data, digest,
+                                                    blob_index)
+                _insert_module_file(cursor, content_id, file_id, filename,
+                                    mimetype)
+        if progress is not None:
+            progress.record(cursor, module.module_id, module.digest,
+                            content_id)
+    _commit(psycopg_conn, blob_index, abstract_index)
+    return content_id
+
+
+def pipelined_populate_from_completezip(location, ident_mappings,
+                                        psycopg_conn, blob_index=None,
+                                        stream_threshold=STREAM_THRESHOLD,
+                                        checkpoint=None, readers=READERS,
+                                        queue_size=QUEUE_SIZE,
+                                        abstract_index=None, batch_size=None,
+                                        parse_cache=None):
+    """Populate the database using a completezip formated collection,
+    as ``archive.populate_from_completezip`` does, while ``readers``
+    threads read and parse up to ``queue_size`` modules ahead of
+    the database writes. Files larger than ``stream_threshold`` bytes
+    aren't read ahead, but streamed into the database when written.
+    Abstracts are interned when an ``AbstractIndex`` is given as
+    ``abstract_index``, and statements are prepared when a ``batch_size``
+    is given, and documents are parsed using the ``ParseCache`` given as
+    ``parse_cache`` (see ``archive.populate_from_completezip``).
+    Returns the number of modules in the collection.
+    """
+    with open_source(location) as source:
+        collection_metadata, contents, progress = _populate_collection(
+            source, ident_mappings, psycopg_conn, blob_index,
+            stream_threshold, checkpoint, abstract_index=abstract_index,
+            parse_cache=parse_cache)
+        statements = None
+        if batch_size is not None:
+            statements = PreparedStatements(batch_size)
+        reader = _Reader(source.location, blob_index is not None,
+                         stream_threshold, parse_cache)
+        try:
+            modules = prefetch(reader, contents, workers=readers,
+                               queue_size=queue_size)
+            for module in modules:
+                _write_module(psycopg_conn, source, module, blob_index,
+                              stream_threshold, progress, abstract_index,
+                              statements)
+        finally:
+            reader.close()
+        if statements is not None:
+            with psycopg_conn.cursor() as cursor:
+                statements.deallocate(cursor)
+        return len(contents)
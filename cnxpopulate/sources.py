@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""Sources of completezip formatted content. A source provides access to
+the files of a collection by their '/' separated path relative to the
+collection's directory (e.g. ``m10001/index.cnxml``), whether the content
+has been extracted to a directory or is still within its complete zip.
+"""
+import os
+import stat
+import time
+import contextlib
+import functools
+import zipfile
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        # Python 2 without the scandir package, see ``_scan``.
+        scandir = None
+
+from .pgcopy import Blob, BlobPath
+
+
+__all__ = ('DirectoryIndex', 'DirectorySource', 'ZipSource', 'get_source',
+           'open_source',)
+
+
+def _split(path):
+    """Split a '/' separated ``path`` into its directory and name."""
+    directory, sep, name = path.rpartition('/')
+    return directory, name
+
+
+def _scan(dirpath):
+    """Generate the name, size and modification time of each file in
+    the directory at ``dirpath`` in a single pass over it.
+    """
+    if scandir is not None:
+        for entry in scandir(dirpath):
+            if entry.is_file():
+                info = entry.stat()
+                yield entry.name, info.st_size, info.st_mtime
+        return
+    for name in os.listdir(dirpath):
+        info = os.stat(os.path.join(dirpath, name))
+        if stat.S_ISREG(info.st_mode):
+            yield name, info.st_size, info.st_mtime
+
+
+class DirectoryIndex(object):
+    """The files in a ``directory`` of a source (not those in its
+    subdirectories), each with its size and modification time.
+    The ``entries`` are (name, size, mtime) tuples.
+    """
+
+    def __init__(self, directory, entries=()):
+        self.directory = directory
+        self._entries = dict([(name, (size, mtime,))
+                              for name, size, mtime in entries])
+
+    def __repr__(self):
+        return "<{} '{}' ({} files)>".format(self.__class__.__name__,
+                                             self.directory, len(self))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(sorted(self._entries))
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def path(self, name):
+        return '/'.join([self.directory, name])
+
+    def getsize(self, name):
+        return self._entries[name][0]
+
+    def getmtime(self, name):
+        return self._entries[name][1]
+
+    def report(self, filenames, expected=()):
+        """Compare the index to the ``filenames`` that are referenced.
+        Returns the names of the referenced files that are missing and
+        those of the files that are neither referenced nor ``expected``
+        (the orphans).
+        """
+        missing = sorted(set([name for name in filenames
+                              if name not in self._entries]))
+        known = set(filenames) | set(expected)
+        orphans = [name for name in self if name not in known]
+        return missing, orphans
+
+
+class DirectorySource(object):
+    """Content in an unpacked completezip directory,
+    e.g. ``{id}_{version}_complete``.
+    """
+
+    def __init__(self, location):
+        self.location = location
+        self._indexes = {}
+
+    def __repr__(self):
+        return "<{} '{}'>".format(self.__class__.__name__, self.location)
+
+    def _path(self, path):
+        return os.path.join(self.location, *path.split('/'))
+
+    def open(self, path):
+        """Open the file at ``path`` for reading."""
+        return open(self._path(path), 'rb')
+
+    def index(self, directory):
+        """The ``DirectoryIndex`` of ``directory``, which is made in
+        a single pass over the directory and then kept. The files of an
+        indexed directory are looked up in its index rather than on disk
+        (see ``exists`` and ``getsize``).
+        """
+        try:
+            return self._indexes[directory]
+        except KeyError:
+            pass
+        try:
+            entries = list(_scan(self._path(directory)))
+        except OSError:
+            entries = []
+        index = DirectoryIndex(directory, entries)
+        self._indexes[directory] = index
+        return index
+
+    def exists(self, path):
+        """Whether the file at ``path`` exists."""
+        directory, name = _split(path)
+        try:
+            return name in self._indexes[directory]
+        except KeyError:
+            return os.path.exists(self._path(path))
+
+    def getsize(self, path):
+        directory, name = _split(path)
+        try:
+            return self._indexes[directory].getsize(name)
+        except KeyError:
+            return os.path.getsize(self._path(path))
+
+    def list_files(self, directory):
+        """The paths of the files within ``directory``, at any depth."""
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(self._path(directory)):
+            relative = os.path.relpath(dirpath, self.location)
+            prefix = '/'.join(relative.split(os.sep))
+            paths.extend(['/'.join([prefix, filename])
+                          for filename in filenames])
+        return sorted(paths)
+
+    def blob(self, path):
+        """A value that streams the file's contents into ``COPY`` data."""
+        return BlobPath(self._path(path))
+
+    def close(self):
+        pass
+
+
+class ZipSource(object):
+    """Content read directly from a complete zip, without extracting it.
+    The ``root`` is the directory within the zip that contains the
+    collection, which by default is the top-level directory holding
+    the ``collection.xml``.
+    """
+
+    def __init__(self, zip_file, root=None):
+        self.location = zip_file
+        self._zipfile = zipfile.ZipFile(zip_file, 'r')
+        self._members = dict([(info.filename, info,)
+                              for info in self._zipfile.infolist()])
+        if root is None:
+            roots = [name[:-len('collection.xml')]
+                     for name in self._members
+                     if name.endswith('/collection.xml')
+                     and name.count('/') == 1]
+            root = roots and roots[0] or ''
+        elif root and not root.endswith('/'):
+            root += '/'
+        self.root = root
+        # The entries of each directory, see ``index``.
+        self._directories = None
+
+    def __repr__(self):
+        return "<{} '{}'>".format(self.__class__.__name__, self.location)
+
+    def _info(self, path):
+        try:
+            return self._members[self.root + path]
+        except KeyError:
+            raise IOError("No such file in '{}', '{}'" \
+                          .format(self.location, path))
+
+    def open(self, path):
+        """Open a streaming handle on the member at ``path``."""
+        return self._zipfile.open(self._info(path))
+
+    def exists(self, path):
+        return (self.root + path) in self._members
+
+    def getsize(self, path):
+        return self._info(path).file_size
+
+    def _scan_directories(self):
+        """Group the files of the zip by their directory, in a single pass
+        over its table of contents.
+        """
+        directories = {}
+        for name, info in self._members.items():
+            if not name.startswith(self.root) or name.endswith('/'):
+                continue
+            directory, name = _split(name[len(self.root):])
+            mtime = time.mktime(info.date_time + (0, 0, -1,))
+            directories.setdefault(directory, []).append(
+                (name, info.file_size, mtime,))
+        return directories
+
+    def index(self, directory):
+        """The ``DirectoryIndex`` of ``directory``, made from the zip's
+        table of contents, which is grouped by directory on first use.
+        """
+        if self._directories is None:
+            self._directories = self._scan_directories()
+        directory = directory.rstrip('/')
+        return DirectoryIndex(directory,
+                              self._directories.get(directory, ()))
+
+    def list_files(self, directory):
+        """The paths of the files within ``directory``, at any depth."""
+        prefix = self.root + directory.rstrip('/') + '/'
+        return sorted([name[len(self.root):] for name in self._members
+                       if name.startswith(prefix) and not name.endswith('/')])
+
+    def blob(self, path):
+        """A value that streams the file's contents into ``COPY`` data."""
+        return Blob(functools.partial(self.open, path))
+
+    def close(self):
+        self._zipfile.close()
+
+
+def get_source(location):
+    """Retrieve the source for ``location``, which is either a source,
+    the path to a complete zip or the path to an unpacked completezip.
+    """
+    if hasattr(location, 'open'):
+        return location
+    if os.path.isfile(location) and zipfile.is_zipfile(location):
+        return ZipSource(location)
+    return DirectorySource(location)
+
+
+@contextlib.contextmanager
+def open_source(location):
+    """Context manager for the source of ``location``
+    (see ``get_source``). A source created for the ``location`` is closed
+    on exit, while a given source is left open for its owner to close.
+    """
+    source = get_source(location)
+    try:
+        yield source
+    finally:
+        if source is not location:
+            source.close()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""Server-side prepared INSERT statements, for the row-by-row population
+where ``COPY`` can't be used. Each shape of INSERT is built and planned
+once with ``PREPARE`` and then run with ``EXECUTE``, and rows are sent
+in multi-row ``VALUES`` batches.
+"""
+import itertools
+
+
+__all__ = ('PreparedStatements',)
+
+# Number of rows sent in each multi-row INSERT by default.
+BATCH_SIZE = 100
+# Numbers the statements prepared by this process, so that the names
+#   prepared on a connection never clash, even after a failure left
+#   some of them prepared.
+_counter = itertools.count(1)
+
+
+class PreparedStatements(object):
+    """The INSERT statements prepared on a connection. A statement is
+    prepared for each shape of INSERT: its table, columns, number of rows
+    (at most ``batch_size``) and returning column.
+    Prepared statements belong to the session of the connection, so an
+    instance is only to be used with one connection, and ``deallocate``
+    is to be called when done with it.
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE, prefix='populate'):
+        if batch_size < 1:
+            raise ValueError("The batch size must be at least 1.")
+        self.batch_size = batch_size
+        self.prefix = prefix
+        self._names = {}
+
+    def __len__(self):
+        return len(self._names)
+
+    def _prepare(self, cursor, table, columns, count, returning):
+        key = (table, tuple(columns), count, returning,)
+        try:
+            return self._names[key]
+        except KeyError:
+            pass
+        name = '{}_{}'.format(self.prefix, next(_counter))
+        width = len(columns)
+        values = ', '.join(
+            ['({})'.format(', '.join(['${}'.format(i * width + j + 1)
+                                      for j in range(width)]))
+             for i in range(count)])
+        statement = "PREPARE {} AS INSERT INTO {} ({}) VALUES {}" \
+                    .format(name, table, ', '.join(columns), values)
+        if returning is not None:
+            statement += " RETURNING {}".format(returning)
+        cursor.execute(statement + ';')
+        self._names[key] = name
+        return name
+
+    def insert(self, cursor, table, columns, rows, returning=None):
+        """Insert the ``rows`` (sequences of values in the order of the
+        ``columns``) into ``table``, ``batch_size`` rows at a time.
+        When a ``returning`` column is given its value is returned for
+        each of the rows, which is only dependable for a single row.
+        """
+        results = []
+        for start in range(0, len(rows), self.batch_size):
+            batch = rows[start:start + self.batch_size]
+            name = self._prepare(cursor, table, columns, len(batch),
+                                 returning)
+            args = [value for row in batch for value in row]
+            cursor.execute("EXECUTE {} ({});".format(
+                name, ', '.join(['%s'] * len(args))), args)
+            if returning is not None:
+                results.extend([row[0] for row in cursor.fetchall()])
+        return results
+
+    def deallocate(self, cursor):
+        """Deallocate the prepared statements."""
+        for name in sorted(self._names.values()):
+            cursor.execute("DEALLOCATE {};".format(name))
+        self._names = {}
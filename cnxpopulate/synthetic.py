@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""Generate synthetic completezip content for benchmarks and tests.
+The content is generated from a seed, so the same parameters always make
+the same files.
+"""
+import os
+import random
+import hashlib
+import argparse
+import zipfile
+
+
+__all__ = ('make_completezip',)
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+LICENSE_URL = 'http://creativecommons.org/licenses/by/1.0'
+COLLECTION_XML = """\
+<col:collection xmlns="http://cnx.rice.edu/collxml"
+                xmlns:col="http://cnx.rice.edu/collxml"
+                xmlns:md="http://cnx.rice.edu/mdml">
+  <metadata mdml-version="0.5">
+    <md:content-id>{id}</md:content-id>
+    <md:title>Synthetic collection {id}</md:title>
+    <md:version>{version}</md:version>
+    <md:language>en</md:language>
+    <md:license url="{license_url}"/>
+    <md:abstract>A synthetic collection of {modules} modules</md:abstract>
+  </metadata>
+  <col:content>
+{entries}  </col:content>
+</col:collection>
+"""
+COLLECTION_MODULE_ENTRY = """\
+    <col:module document="{id}" version="latest"
+                repository="http://cnx.org/content">
+      <md:title>Synthetic module {id}</md:title>
+    </col:module>
+"""
+MODULE_XML = """\
+<document xmlns="http://cnx.rice.edu/cnxml"
+          xmlns:md="http://cnx.rice.edu/mdml/0.4" id="{id}">
+  <title>Synthetic module {id}</title>
+  <metadata xmlns:md="http://cnx.rice.edu/mdml">
+    <md:content-id>{id}</md:content-id>
+    <md:title>Synthetic module {id}</md:title>
+    <md:version>1.1</md:version>
+    <md:language>en</md:language>
+    <md:license url="{license_url}"/>
+    <md:abstract>A synthetic module</md:abstract>
+  </metadata>
+  <content>
+{figures}  </content>
+</document>
+"""
+MODULE_FIGURE = """\
+    <figure><media><image src="{}" mime-type="image/png"/></media></figure>
+"""
+
+
+def _content(key, size):
+    """Make ``size`` bytes of content, which is the same for the same
+    ``key`` and doesn't compress well, like real images.
+    """
+    blocks = [PNG_SIGNATURE]
+    length = len(PNG_SIGNATURE)
+    digest = hashlib.sha512(key).digest()
+    while length < size:
+        blocks.append(digest)
+        length += len(digest)
+        digest = hashlib.sha512(digest).digest()
+    return ''.join(blocks)[:size]
+
+
+def _generate(modules, images, image_size, shared_ratio, collection_id,
+              version, seed):
+    """Generate the (path, data) of each file of the collection."""
+    rng = random.Random(seed)
+    module_ids = ['m{}'.format(90000 + i) for i in range(modules)]
+    entries = ''.join([COLLECTION_MODULE_ENTRY.format(id=module_id)
+                       for module_id in module_ids])
+    yield 'collection.xml', COLLECTION_XML.format(
+        id=collection_id, version=version, license_url=LICENSE_URL,
+        modules=modules, entries=entries)
+    for module_id in module_ids:
+        filenames = []
+        for i in range(images):
+            # A shared image has the same name and content in each module.
+            if rng.random() < shared_ratio:
+                filename = 'shared-{}.png'.format(i)
+                key = '{}:{}'.format(seed, filename)
+            else:
+                filename = 'image-{}.png'.format(i)
+                key = '{}:{}:{}'.format(seed, module_id, filename)
+            filenames.append(filename)
+            yield '/'.join([module_id, filename]), _content(key, image_size)
+        figures = ''.join([MODULE_FIGURE.format(filename)
+                           for filename in filenames])
+        module_xml = MODULE_XML.format(id=module_id, license_url=LICENSE_URL,
+                                       figures=figures)
+        yield '/'.join([module_id, 'index.cnxml']), module_xml
+        yield '/'.join([module_id, 'index_auto_generated.cnxml']), module_xml
+
+
+def make_completezip(output_dir, modules=10, images=5, image_size=32 * 1024,
+                     shared_ratio=0.0, collection_id='col90000',
+                     version='1.1', seed=0, as_zip=False):
+    """Make a synthetic completezip in ``output_dir`` of ``modules``
+    modules, each with ``images`` images of ``image_size`` bytes.
+    About ``shared_ratio`` of the images are shared, meaning they have
+    the same name and content in each of the modules they're in.
+    The content is an unpacked ``{id}_{version}_complete`` directory
+    or, when ``as_zip`` is true, a ``{id}-{version}.complete.zip``.
+    Returns the location of the content.
+    """
+    directory = '{}_{}_complete'.format(collection_id, version)
+    files = _generate(modules, images, image_size, shared_ratio,
+                      collection_id, version, seed)
+    if as_zip:
+        location = os.path.join(output_dir, '{}-{}.complete.zip' \
+                                .format(collection_id, version))
+        with zipfile.ZipFile(location, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for path, data in files:
+                zf.writestr('/'.join([directory, path]), data)
+        return location
+
+    location = os.path.join(output_dir, directory)
+    for path, data in files:
+        filepath = os.path.join(location, *path.split('/'))
+        if not os.path.exists(os.path.dirname(filepath)):
+            os.makedirs(os.path.dirname(filepath))
+        with open(filepath, 'wb') as fp:
+            fp.write(data)
+    return location
+
+
+def main(argv=None):
+    """Main commandline interface"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('output_dir', nargs='?', default=os.getcwd(),
+                        help="where to make the content "
+                             "(default: the current directory)")
+    parser.add_argument('-m', '--modules', type=int, default=10)
+    parser.add_argument('-i', '--images', type=int, default=5,
+                        help="number of images per module")
+    parser.add_argument('-s', '--image-size', type=int, default=32 * 1024,
+                        help="size of each image in bytes")
+    parser.add_argument('--shared-ratio', type=float, default=0.0,
+                        help="portion of the images shared "
+                             "between modules")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--zip', dest='as_zip', action='store_true',
+                        help="make a complete zip rather than a directory")
+    args = parser.parse_args(argv)
+    print(make_completezip(args.output_dir, args.modules, args.images,
+                           args.image_size, args.shared_ratio,
+                           seed=args.seed, as_zip=args.as_zip))
+
+
+if __name__ == '__main__':
+    main()
@@ -7,12 +7,24 @@
 # ###
 import os
 import json
+import shutil
+import tempfile
+import functools
+import threading
 import unittest
+import uuid
+try:
+    import BaseHTTPServer
+except ImportError:
+    import http.server as BaseHTTPServer
+
+from .lookups import LicenseTable
 
 here = os.path.abspath(os.path.dirname(__file__))
 TEST_DATA_DIRECTORY = os.path.join(here, 'test-data')
 TEST_COLLECTION_XML = os.path.join(TEST_DATA_DIRECTORY,
                                    'collection.xml')
+TEST_LICENSES_JSON = os.path.join(TEST_DATA_DIRECTORY, 'licenses.json')
 TEST_COLLECTION_METADATA = {
     'licensors': [],
     'name': 'Intro to Logic',
@@ -38,25 +50,11 @@ class CollectionTestCase(unittest.TestCase):
 
     def monkey_patch_licenses(self):
         import cnxpopulate as pkg  # 'import . as <name>' doesn't work. :(
-        # Easy way to do this is to say that we have already cached it
-        #   and set the license on the object manually.
-        pkg.licenses._is_cached = True
-        # Now set the licenses.
-        pkg.licenses._licenses = self._get_licenses()
+        # Easy way to do this is to populate the cache from the test data
+        #   rather than from a database.
+        pkg.licenses.populate(LicenseTable.from_json(TEST_LICENSES_JSON))
         # The only cleanup needed is to invalidate the cache.
-        self.addCleanup(setattr, pkg.licenses, '_is_cached', False)
-
-    def _get_licenses(self):
-        licenses_filepath = os.path.join(TEST_DATA_DIRECTORY, 'licenses.json')
-        with open(licenses_filepath, 'r') as f:
-            data = json.load(f)
-
-        from . import License
-
-        deliverable = []
-        for license in data:
-            deliverable.append(License(**license))
-        return deliverable
+        self.addCleanup(pkg.licenses.clear)
 
     def test_from_file_buffer_loads_metadata(self):
         # Case to test that a file can be loaded into the model
@@ -90,3 +88,2011 @@ class CollectionTestCase(unittest.TestCase):
         file = obj.files.retrieve_by_filename('collection.xml')
         with open(TEST_COLLECTION_XML, 'r') as fb:
             self.assertMultiLineEqual(file.data.read(), fb.read())
+
+
+class FilesTestCase(unittest.TestCase):
+    # Cases for the filename index of the ``Files`` sequence.
+
+    def make_files(self, *filenames):
+        from . import File, Files
+        return Files([File(filename) for filename in filenames])
+
+    def test_index_follows_changes(self):
+        from . import File
+        files = self.make_files('index.cnxml', 'a.png')
+        png = files.retrieve_by_filename('a.png')
+        self.assertIn('a.png', files)
+        self.assertIn(png, files)
+
+        del files[1]
+        self.assertNotIn('a.png', files)
+        self.assertNotIn(png, files)
+        self.assertIsNone(files.retrieve_by_filename('a.png'))
+
+        files[0] = File('other.cnxml')
+        self.assertEqual([f.filename for f in files], ['other.cnxml'])
+        self.assertNotIn('index.cnxml', files)
+        files.insert(0, File('index.cnxml'))
+        self.assertEqual([f.filename for f in files],
+                         ['index.cnxml', 'other.cnxml'])
+
+    def test_duplicate_filename(self):
+        from . import File
+        files = self.make_files('index.cnxml', 'a.png')
+        self.assertRaises(ValueError, files.append, File('a.png'))
+        self.assertRaises(ValueError, files.__setitem__, 0, File('a.png'))
+        # Replacing a file with one of the same name is fine.
+        files[1] = File('a.png')
+        self.assertEqual(len(files), 2)
+
+    def test_instances_do_not_share_files(self):
+        from . import Files
+        Files().append(self.make_files('a.png')[0])
+        self.assertEqual(len(Files()), 0)
+
+
+class FileDataTestCase(unittest.TestCase):
+
+    def test_spools_large_data(self):
+        # Case to test that data beyond the size limit goes to disk.
+        from . import FileData
+        data = FileData(max_size=10)
+        data.write('x' * 5)
+        self.assertFalse(data.is_spooled)
+        data.write('x' * 10)
+        self.assertTrue(data.is_spooled)
+        data.seek(0)
+        self.assertEqual(data.read(), 'x' * 15)
+
+    def test_views(self):
+        # Case to test the views of data in memory and on disk.
+        from . import FileData
+        for max_size in (100, 10,):
+            data = FileData('0123456789abcdef', max_size=max_size)
+            self.assertEqual(data.size, 16)
+            self.assertEqual(str(data.view(10)), 'abcdef')
+            self.assertEqual(str(data.view(2, 3)), '234')
+            self.assertEqual([str(v) for v in data.iter_views(6)],
+                             ['012345', '6789ab', 'cdef'])
+            # The view follows data written since the last view.
+            data.seek(0, os.SEEK_END)
+            data.write('gh')
+            self.assertEqual(str(data.view(14)), 'efgh')
+
+    def test_consumers_use_views(self):
+        # Case to test that file data is hashed, sniffed and uploaded
+        #   from views of it rather than read.
+        import hashlib
+        from . import FileData, kadabra
+        from .blobs import BlobIndex, hash_file
+        for max_size in (100, 10,):
+            data = FileData('0123456789abcdef', max_size=max_size)
+            data.read = None
+            self.assertEqual(hash_file(data),
+                             hashlib.sha1('0123456789abcdef').hexdigest())
+            self.assertEqual(kadabra._prefix(data, 4), '0123')
+            cursor = _RecordingCursor(results=[None, (3,)])
+            self.assertEqual(BlobIndex().insert_file(cursor, data), 3)
+            statement, args = cursor.statements[-2]
+            self.assertTrue(statement.startswith('INSERT INTO files'))
+            self.assertEqual(str(args[0].adapted), '0123456789abcdef')
+
+    def test_from_path(self):
+        # Case to test that file data can be backed by an existing file.
+        from . import File
+        file = File.from_path(TEST_COLLECTION_XML, mimetype='text/xml')
+        self.assertEqual(file.filename, 'collection.xml')
+        self.assertTrue(file.data.is_spooled)
+        with open(TEST_COLLECTION_XML, 'rb') as fb:
+            expected = fb.read()
+        self.assertEqual(file.data.read(), expected)
+        self.assertEqual(str(file.data.view()), expected)
+
+
+class CopyFormatTestCase(unittest.TestCase):
+    # Cases for the formatting of COPY text format data.
+
+    def test_format_copy_row(self):
+        from .pgcopy import format_copy_row
+        row = (1, None, 'tab\there', 'line\nbreak\\', u'caf\xe9',)
+        self.assertEqual(format_copy_row(row),
+                         '1\t\\N\ttab\\there\tline\\nbreak\\\\\tcaf\xc3\xa9\n')
+
+    def test_format_copy_value_array(self):
+        from .pgcopy import format_copy_value
+        value = format_copy_value(['ian', 'a "quoted" name', None])
+        self.assertEqual(value, '{"ian","a \\\\"quoted\\\\" name",NULL}')
+
+    def test_write_copy_rows_streams_blobs(self):
+        # Case to test that a blob path is written as hex encoded bytea.
+        from .pgcopy import BlobPath, write_copy_rows
+        from io import BytesIO
+        out = BytesIO()
+        write_copy_rows(out, [(7, BlobPath(TEST_COLLECTION_XML),)])
+        with open(TEST_COLLECTION_XML, 'rb') as fb:
+            expected = '7\t\\\\x{}\n'.format(fb.read().encode('hex'))
+        self.assertEqual(out.getvalue(), expected)
+
+    def test_copy_data_reader(self):
+        # Case to test that reading in small pieces gives the same data
+        #   as writing the rows out in one go.
+        from .pgcopy import BlobPath, CopyDataReader, write_copy_rows
+        from io import BytesIO
+        rows = [(1, 'one',), (2, BlobPath(TEST_COLLECTION_XML),)]
+        out = BytesIO()
+        write_copy_rows(out, rows)
+
+        reader = CopyDataReader(rows)
+        pieces = []
+        while True:
+            piece = reader.read(1000)
+            if not piece:
+                break
+            self.assertTrue(len(piece) <= 1000)
+            pieces.append(piece)
+        self.assertEqual(''.join(pieces), out.getvalue())
+
+
+class _RecordingCursor(object):
+    """A stand-in for a psycopg2 cursor that records the executed
+    statements and answers queries with the given ``results``."""
+    rowcount = 1
+
+    def __init__(self, results=()):
+        self.statements = []
+        self.results = list(results)
+
+    def execute(self, statement, args=None):
+        self.statements.append((statement, args,))
+
+    def fetchone(self):
+        return self.results.pop(0)
+
+
+class BlobIndexTestCase(unittest.TestCase):
+    # Cases for the content addressed file index.
+
+    def test_read_and_hash_file(self):
+        import hashlib
+        from .blobs import read_and_hash_file
+        with open(TEST_COLLECTION_XML, 'rb') as fb:
+            data, digest = read_and_hash_file(fb)
+            fb.seek(0)
+            expected = fb.read()
+        self.assertEqual(data, expected)
+        self.assertEqual(digest, hashlib.sha1(expected).hexdigest())
+
+    def test_committed_entries_are_cached(self):
+        # Case to test that committed entries are answered in-process.
+        from .blobs import BlobIndex
+        index = BlobIndex()
+        cursor = _RecordingCursor()
+        index.add(cursor, 'abc', 7)
+        index.commit()
+        cursor.statements = []
+        self.assertEqual(index.get(cursor, 'abc'), 7)
+        self.assertEqual(cursor.statements, [])
+
+    def test_rollback_forgets_pending_entries(self):
+        # Case to test that a rolled back entry is looked up again.
+        from .blobs import BlobIndex
+        index = BlobIndex()
+        cursor = _RecordingCursor(results=[None])
+        index.add(cursor, 'abc', 7)
+        index.rollback()
+        self.assertEqual(index.get(cursor, 'abc'), None)
+
+    def test_rollback_to_savepoint(self):
+        # Case to test that only the entries since the savepoint
+        #   are forgotten.
+        from .blobs import BlobIndex
+        index = BlobIndex()
+        cursor = _RecordingCursor(results=[None])
+        index.add(cursor, 'abc', 7)
+        index.savepoint()
+        index.add(cursor, 'def', 8)
+        index.rollback_to_savepoint()
+        index.commit()
+        self.assertEqual(index.get(cursor, 'abc'), 7)
+        self.assertEqual(index.get(cursor, 'def'), None)
+
+    def test_concurrently_added_digest(self):
+        # Case to test that content another transaction stored at the same
+        #   time is used in place of this transaction's copy.
+        from .blobs import BlobIndex
+        index = BlobIndex()
+        # The digest is already recorded, with fileid 5.
+        cursor = _RecordingCursor(results=[(5,)])
+        cursor.rowcount = 0
+        self.assertEqual(index.add(cursor, 'abc', 7), 5)
+        self.assertTrue(cursor.statements[-2][0].endswith(
+            "ON CONFLICT (digest) DO NOTHING;"))
+        index.discard(cursor, 7)
+        self.assertEqual(cursor.statements[-1],
+                         ("DELETE FROM files WHERE fileid = %s;", (7,),))
+        index.commit()
+        self.assertEqual(index.get(cursor, 'abc'), 5)
+
+
+class PreparedStatementsTestCase(unittest.TestCase):
+    # Cases for the prepared, multi-row INSERT statements.
+
+    def test_insert_in_batches(self):
+        from .statements import PreparedStatements
+        statements = PreparedStatements(batch_size=2)
+        cursor = _RecordingCursor()
+        rows = [(i, 'name-{}'.format(i),) for i in range(5)]
+        statements.insert(cursor, 'things', ('id', 'name',), rows)
+        prepared = [statement for statement, args in cursor.statements
+                    if statement.startswith('PREPARE')]
+        # A statement of two rows, and one for the remaining row.
+        self.assertEqual(len(prepared), 2)
+        self.assertTrue(prepared[0].endswith(
+            "AS INSERT INTO things (id, name) VALUES ($1, $2), ($3, $4);"))
+        self.assertTrue(prepared[1].endswith(
+            "AS INSERT INTO things (id, name) VALUES ($1, $2);"))
+        executed = [args for statement, args in cursor.statements
+                    if statement.startswith('EXECUTE')]
+        self.assertEqual(executed, [[0, 'name-0', 1, 'name-1'],
+                                    [2, 'name-2', 3, 'name-3'],
+                                    [4, 'name-4']])
+        # Inserting the same shape again doesn't prepare it again.
+        cursor.statements = []
+        statements.insert(cursor, 'things', ('id', 'name',), rows[:2])
+        self.assertEqual([statement.split()[0]
+                          for statement, args in cursor.statements],
+                         ['EXECUTE'])
+        statements.deallocate(cursor)
+        self.assertEqual(len(cursor.statements), 3)
+        self.assertEqual(len(statements), 0)
+
+
+class AbstractIndexTestCase(unittest.TestCase):
+    # Cases for the interning of abstracts.
+
+    def test_identical_text_is_inserted_once(self):
+        from .abstracts import AbstractIndex, hash_text
+        index = AbstractIndex()
+        # The lookup misses and the insert returns abstractid 3.
+        cursor = _RecordingCursor(results=[None, (3,)])
+        self.assertEqual(index.insert_abstract(cursor, u'An abstract'), 3)
+        self.assertEqual(index.insert_abstract(cursor, u'An abstract'), 3)
+        inserts = [args for statement, args in cursor.statements
+                   if statement.startswith('INSERT INTO abstracts')]
+        self.assertEqual(inserts, [(u'An abstract',)])
+        self.assertEqual(index.get(cursor, hash_text('An abstract')), 3)
+
+    def test_cache_is_bounded(self):
+        # Case to test that the least recently used abstracts are
+        #   dropped from the in-process cache.
+        from .abstracts import AbstractIndex
+        index = AbstractIndex(cache_size=2)
+        cursor = _RecordingCursor()
+        for digest, id in (('a', 1,), ('b', 2,), ('c', 3,),):
+            index.add(cursor, digest, id)
+            index.commit()
+            if digest == 'b':
+                # Use 'a', so that 'b' is the least recently used.
+                self.assertEqual(index.get(cursor, 'a'), 1)
+        self.assertEqual(len(index), 2)
+        cursor.results = [(2,)]
+        cursor.statements = []
+        self.assertEqual(index.get(cursor, 'b'), 2)
+        self.assertEqual(len(cursor.statements), 1)
+
+    def test_abstract_model_save(self):
+        from . import Abstract
+        from .abstracts import AbstractIndex
+        index = AbstractIndex()
+        cursor = _RecordingCursor(results=[None, (5,)])
+        first, second = Abstract('Boilerplate'), Abstract('Boilerplate')
+        self.assertEqual(first.save(cursor, index), 5)
+        second.save(cursor, index)
+        self.assertEqual((first.id, second.id,), (5, 5,))
+        # Without an index the abstract is always inserted.
+        cursor.results = [(6,)]
+        self.assertEqual(Abstract('Boilerplate').save(cursor), 6)
+
+
+TEST_MODULE_XML = """\
+<document xmlns="http://cnx.rice.edu/cnxml"
+          xmlns:md="http://cnx.rice.edu/mdml/0.4" id="m10001">
+  <title>A module</title>
+  <metadata xmlns:md="http://cnx.rice.edu/mdml">
+    <md:content-id>m10001</md:content-id>
+    <md:title>A module</md:title>
+    <md:version>1.4</md:version>
+    <md:language>en</md:language>
+    <md:license url="http://creativecommons.org/licenses/by/2.0/"/>
+    <md:roles>
+      <md:role><type xmlns="">author</type>ian<!-- c -->greiner</md:role>
+      <md:role type="maintainer">ian</md:role>
+    </md:roles>
+    <md:abstract><emphasis>An</emphasis> abstract</md:abstract>
+  </metadata>
+  <content>
+    <figure><media><image src="a.png" mime-type="image/png"/></media></figure>
+    <figure><media><image src="b.jpg" mime-type="image/jpeg"/></media></figure>
+    <figure><media><image src="a.png" mime-type="image/png"/></media></figure>
+  </content>
+</document>
+"""
+
+
+class ParsersTestCase(unittest.TestCase):
+    # Cases for the content parsers.
+
+    def assert_same_as_xpath(self, xml_doc):
+        from .parsers import (_parse_common_elements,
+                              _xpath_parse_common_elements)
+        self.assertEqual(_parse_common_elements(xml_doc),
+                         _xpath_parse_common_elements(xml_doc))
+
+    def test_common_elements_of_collection(self):
+        import lxml.etree
+        with open(TEST_COLLECTION_XML, 'r') as fp:
+            doc = lxml.etree.parse(fp).getroot()
+        self.assert_same_as_xpath(doc)
+
+    def test_common_elements_of_module(self):
+        import lxml.etree
+        doc = lxml.etree.fromstring(TEST_MODULE_XML)
+        self.assert_same_as_xpath(doc)
+
+    def test_compile_xpath_is_cached(self):
+        # Case to test that the same expression and namespaces
+        #   only compile once, regardless of the mapping's identity.
+        from .parsers import compile_xpath
+        namespaces = {'md': "http://cnx.rice.edu/mdml"}
+        xpath = compile_xpath('//md:title/text()', namespaces)
+        self.assertIs(compile_xpath('//md:title/text()', namespaces.copy()),
+                      xpath)
+        self.assertIsNot(compile_xpath('//md:version/text()', namespaces),
+                         xpath)
+
+    def test_parse_collection_xml(self):
+        from .parsers import parse_collection_xml
+        with open(TEST_COLLECTION_XML, 'r') as fp:
+            abstract, license, metadata, contents = parse_collection_xml(fp)
+        expected_metadata = TEST_COLLECTION_METADATA.copy()
+        expected_metadata['portal_type'] = 'Collection'
+        self.assertEqual(metadata, expected_metadata)
+        self.assertEqual(abstract, TEST_COLLECTION_ABSTRACT_TEXT)
+        self.assertEqual(license,
+                         'http://creativecommons.org/licenses/by/1.0')
+        self.assertEqual(contents[:3], ['m12727', 'm10714', 'm12072'])
+
+    def test_parse_module_xml(self):
+        from io import BytesIO
+        from .parsers import parse_module_xml
+        abstract, license, metadata, resources = parse_module_xml(
+            BytesIO(TEST_MODULE_XML))
+        self.assertEqual(abstract, ' abstract')
+        self.assertEqual(metadata['authors'], ['ian', 'greiner'])
+        self.assertEqual(metadata['maintainers'], [])
+        self.assertEqual(resources, [('a.png', 'image/png',),
+                                     ('b.jpg', 'image/jpeg',)])
+
+
+class KadabraTestCase(unittest.TestCase):
+    # Cases for the mime-type and encoding guesses.
+
+    def test_reads_a_prefix(self):
+        # Case to test that only a prefix of the buffer is read
+        #   and the buffer is left where it was.
+        from io import BytesIO
+        from . import kadabra
+        buf = BytesIO('<?xml version="1.0"?><a/>' + ' ' * kadabra.SNIFF_SIZE)
+        read_sizes = []
+        original_read = buf.read
+
+        def read(size=-1):
+            read_sizes.append(size)
+            return original_read(size)
+        buf.read = read
+
+        self.assertEqual(kadabra.guess_type(buf), 'text/xml')
+        self.assertEqual(read_sizes, [kadabra.SNIFF_SIZE])
+        self.assertEqual(buf.tell(), 0)
+
+    def test_cached_by_content(self):
+        from . import kadabra
+        calls = []
+
+        class Magic(object):
+            def from_buffer(self, data):
+                calls.append(data)
+                return 'text/plain'
+        original_magic = kadabra._magic
+        kadabra._magic = lambda name: Magic()
+        self.addCleanup(setattr, kadabra, '_magic', original_magic)
+
+        content = 'some unique cached content'
+        guesses = [kadabra.guess_type(content),
+                   kadabra.guess_type(buffer(content)),
+                   kadabra.guess_type(memoryview(content))]
+        self.assertEqual(guesses, ['text/plain'] * 3)
+        self.assertEqual(calls, [content])
+
+    def test_classify(self):
+        from io import BytesIO
+        from . import kadabra
+        results = kadabra.classify([BytesIO('<?xml version="1.0"?><a/>'),
+                                    'plain text\n'])
+        self.assertEqual(results, [('text/xml', 'us-ascii',),
+                                   ('text/plain', 'us-ascii',)])
+
+
+class LicenseTableTestCase(unittest.TestCase):
+    # Cases for the license lookup table.
+
+    def test_trailing_slashes_match(self):
+        table = LicenseTable.from_json(TEST_LICENSES_JSON)
+        self.assertEqual(
+            table.get_id('http://creativecommons.org/licenses/by/2.0'), 6)
+        self.assertEqual(
+            table.get_id('http://creativecommons.org/licenses/by/1.0/'), 1)
+
+    def test_unknown_url(self):
+        table = LicenseTable.from_json(TEST_LICENSES_JSON)
+        self.assertEqual(table.get('http://example.com/license'), None)
+        self.assertRaises(ValueError, table.get_id,
+                          'http://example.com/license')
+
+    def test_loaded_with_one_query(self):
+        cursor = _RecordingCursor()
+        cursor.fetchall = lambda: [
+            (11, 'by', '3.0', 'Attribution',
+             'http://creativecommons.org/licenses/by/3.0/',)]
+        table = LicenseTable.from_cursor(cursor)
+        self.assertEqual(len(cursor.statements), 1)
+        self.assertEqual(
+            table.get_id('http://creativecommons.org/licenses/by/3.0'), 11)
+
+    def test_licenses_singleton(self):
+        # Case to test the singleton loads lazily from its source.
+        from . import Licenses
+        licenses = Licenses(TEST_LICENSES_JSON)
+        license = licenses.retrieve_by_url(
+            'http://creativecommons.org/licenses/by/2.0')
+        self.assertEqual((license.id, license.code,), (6, 'by',))
+
+
+class _RangeRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves ``server.files`` (a path to bytes mapping),
+    honoring ``Range: bytes=N-`` headers."""
+
+    def do_GET(self):
+        try:
+            data = self.server.files[self.path]
+        except KeyError:
+            self.send_error(404)
+            return
+        self.server.requests.append((self.path, self.headers.get('Range'),))
+        range_header = self.headers.get('Range')
+        if range_header is not None:
+            offset = int(range_header.split('=')[1].rstrip('-'))
+            if offset >= len(data):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            data = data[offset:]
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class AcquireContentTestCase(unittest.TestCase):
+    # Cases for downloading content from a local http server.
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                _RangeRequestHandler)
+        self.server.files = {}
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.shutdown)
+        self.host = 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+    def make_complete_zip(self, id, version):
+        from io import BytesIO
+        import zipfile
+        buf = BytesIO()
+        with zipfile.ZipFile(buf, 'w') as zf:
+            zf.write(TEST_COLLECTION_XML,
+                     '{}_{}_complete/collection.xml'.format(id, version))
+        path = '/content/{}/{}/complete'.format(id, version)
+        self.server.files[path] = buf.getvalue()
+        return path
+
+    def test_download_resumes_partial_file(self):
+        from .fetch import download
+        path = self.make_complete_zip('col10154', '1.20')
+        data = self.server.files[path]
+        filename = os.path.join(self.output_dir, 'col10154.zip')
+        with open(filename + '.part', 'wb') as fp:
+            fp.write(data[:100])
+
+        download(self.host + path, filename)
+
+        with open(filename, 'rb') as fp:
+            self.assertEqual(fp.read(), data)
+        self.assertEqual(self.server.requests, [(path, 'bytes=100-',)])
+        self.assertFalse(os.path.exists(filename + '.part'))
+
+    def test_acquire_content_in_order(self):
+        from .archive import acquire_content
+        versions = ['1.{}'.format(i) for i in range(5)]
+        for version in versions:
+            self.make_complete_zip('col10154', version)
+
+        locations = acquire_content('col10154', versions, host=self.host,
+                                    output_dir=self.output_dir,
+                                    downloads=3, queue_size=2)
+
+        expected = [os.path.join(self.output_dir,
+                                 'col10154_{}_complete'.format(version))
+                    for version in versions]
+        self.assertEqual(list(locations), expected)
+        for location in expected:
+            self.assertTrue(os.path.exists(
+                os.path.join(location, 'collection.xml')))
+
+    def test_acquire_content_raises_in_order(self):
+        from .archive import acquire_content
+        self.make_complete_zip('col10154', '1.1')
+        locations = acquire_content('col10154', ['1.1', '9.9'],
+                                    host=self.host,
+                                    output_dir=self.output_dir, downloads=2)
+        self.assertTrue(next(locations).endswith('col10154_1.1_complete'))
+        self.assertRaises(Exception, next, locations)
+
+
+class SourcesTestCase(unittest.TestCase):
+    # Cases for reading content from directories and complete zips.
+
+    def setUp(self):
+        import zipfile
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.location = os.path.join(self.directory,
+                                     'col10154_1.20_complete')
+        os.makedirs(os.path.join(self.location, 'm10001'))
+        shutil.copy(TEST_COLLECTION_XML, self.location)
+        with open(os.path.join(self.location, 'm10001', 'a.png'), 'wb') as fp:
+            fp.write('png data')
+        self.zip_location = os.path.join(self.directory,
+                                         'col10154-1.20.complete.zip')
+        with zipfile.ZipFile(self.zip_location, 'w') as zf:
+            for path in ('collection.xml', 'm10001/a.png',):
+                zf.write(os.path.join(self.location, *path.split('/')),
+                         'col10154_1.20_complete/' + path)
+
+    def assert_source(self, source):
+        self.assertTrue(source.exists('m10001/a.png'))
+        self.assertFalse(source.exists('m10001/b.png'))
+        self.assertEqual(source.getsize('m10001/a.png'), len('png data'))
+        with source.open('m10001/a.png') as fp:
+            self.assertEqual(fp.read(), 'png data')
+        with source.open('collection.xml') as fp:
+            with open(TEST_COLLECTION_XML, 'rb') as expected:
+                self.assertEqual(fp.read(), expected.read())
+        self.assertEqual(source.list_files('m10001'), ['m10001/a.png'])
+        self.assertEqual(source.list_files('m10002'), [])
+
+    def test_directory_source(self):
+        from .sources import DirectorySource, get_source
+        source = get_source(self.location)
+        self.assertTrue(isinstance(source, DirectorySource))
+        self.assert_source(source)
+
+    def test_zip_source(self):
+        from .sources import ZipSource, get_source
+        source = get_source(self.zip_location)
+        self.assertTrue(isinstance(source, ZipSource))
+        self.assertEqual(source.root, 'col10154_1.20_complete/')
+        self.assert_source(source)
+        source.close()
+
+    def assert_index(self, source):
+        index = source.index('m10001')
+        self.assertEqual(list(index), ['a.png'])
+        self.assertTrue('a.png' in index)
+        self.assertEqual(index.path('a.png'), 'm10001/a.png')
+        self.assertEqual(index.getsize('a.png'), len('png data'))
+        self.assertTrue(index.getmtime('a.png') > 0)
+        self.assertEqual(index.report(['a.png', 'b.png']), (['b.png'], [],))
+        self.assertEqual(index.report([]), ([], ['a.png'],))
+        self.assertEqual(index.report([], expected=['a.png']), ([], [],))
+        self.assertEqual(len(source.index('m10002')), 0)
+
+    def test_directory_source_index(self):
+        from .sources import DirectorySource
+        source = DirectorySource(self.location)
+        os.makedirs(os.path.join(self.location, 'm10001', 'images'))
+        self.assert_index(source)
+        # Case to test that the files of an indexed directory are looked
+        #   up in the index rather than on disk.
+        os.remove(os.path.join(self.location, 'm10001', 'a.png'))
+        self.assertTrue(source.exists('m10001/a.png'))
+        self.assertEqual(source.getsize('m10001/a.png'), len('png data'))
+        self.assertFalse(source.exists('m10002/a.png'))
+
+    def test_zip_source_index(self):
+        from .sources import ZipSource
+        source = ZipSource(self.zip_location)
+        self.assert_index(source)
+        # Case to test that the table of contents is only scanned once.
+        members, source._members = source._members, {}
+        self.assertEqual(list(source.index('m10001')), ['a.png'])
+        self.assertEqual(list(source.index('m10001/')), ['a.png'])
+        source._members = members
+        source.close()
+
+    def test_resolve_resources(self):
+        # Case to test that missing and unreferenced files are reported.
+        import logging
+        from .archive import _resolve_resources, logger
+        from .sources import DirectorySource
+        for name in ('index.cnxml', 'c.png',):
+            with open(os.path.join(self.location, 'm10001', name), 'w') as fp:
+                fp.write('data')
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        logger.setLevel(logging.DEBUG)
+        self.addCleanup(logger.setLevel, logging.NOTSET)
+
+        source = DirectorySource(self.location)
+        files = _resolve_resources(source, 'm10001',
+                                   [('a.png', 'image/png',),
+                                    ('b.png', 'image/png',)])
+        self.assertEqual(files, [('a.png', 'image/png', 'm10001/a.png',)])
+        messages = [(record.levelno, record.getMessage(),)
+                    for record in records]
+        self.assertEqual(messages, [
+            (logging.ERROR, "Missing resources of 'm10001' in '{}': b.png" \
+                            .format(self.location),),
+            (logging.INFO, "Unreferenced files of 'm10001' in '{}': c.png" \
+                           .format(self.location),),
+            ])
+
+    def test_zip_source_blob(self):
+        # Case to test that zip members stream into COPY data.
+        from .pgcopy import write_copy_rows
+        from .sources import ZipSource
+        from io import BytesIO
+        source = ZipSource(self.zip_location)
+        out = BytesIO()
+        write_copy_rows(out, [(1, source.blob('m10001/a.png'),)])
+        source.close()
+        self.assertEqual(out.getvalue(),
+                         '1\t\\\\x{}\n'.format('png data'.encode('hex')))
+
+    def test_open_source_closes_what_it_opens(self):
+        from .sources import ZipSource, open_source
+        source = ZipSource(self.zip_location)
+        with open_source(source) as given:
+            self.assertIs(given, source)
+        self.assertTrue(source.exists('collection.xml'))
+        source.close()
+
+
+TEST_SMALL_COLLECTION_XML = """\
+<col:collection xmlns="http://cnx.rice.edu/collxml"
+                xmlns:col="http://cnx.rice.edu/collxml"
+                xmlns:md="http://cnx.rice.edu/mdml">
+  <metadata mdml-version="0.5">
+    <md:content-id>col10001</md:content-id>
+    <md:title>A collection</md:title>
+    <md:version>1.1</md:version>
+    <md:language>en</md:language>
+    <md:license url="http://creativecommons.org/licenses/by/1.0"/>
+    <md:abstract>A collection abstract</md:abstract>
+  </metadata>
+  <col:content>
+    <col:module document="m10001"/>
+    <col:module document="m10002"/>
+  </col:content>
+</col:collection>
+"""
+
+
+def _make_completezip(directory, name='col10001_1.1_complete'):
+    """Make an unpacked completezip of two modules in ``directory``.
+    Each module has one of its two images missing."""
+    location = os.path.join(directory, name)
+    os.makedirs(location)
+    with open(os.path.join(location, 'collection.xml'), 'w') as fp:
+        fp.write(TEST_SMALL_COLLECTION_XML)
+    for module_id in ('m10001', 'm10002',):
+        os.makedirs(os.path.join(location, module_id))
+        module_xml = TEST_MODULE_XML.replace('m10001', module_id)
+        for filename in ('index.cnxml', 'index_auto_generated.cnxml',):
+            with open(os.path.join(location, module_id, filename), 'w') as fp:
+                fp.write(module_xml)
+        with open(os.path.join(location, module_id, 'a.png'), 'wb') as fp:
+            fp.write('png data')
+    return location
+
+
+class _FakeCursor(object):
+    """A stand-in for a psycopg2 cursor, see ``_FakeConnection``."""
+    rowcount = 1
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, statement, args=None):
+        connection = self.connection
+        connection.statements.append((statement, args,))
+        answers = [rows for text, rows in connection.answers.items()
+                   if text in statement]
+        if answers:
+            self._results = list(answers[0])
+        elif statement.startswith('PREPARE'):
+            if 'RETURNING' in statement:
+                connection.returning.add(statement.split()[1])
+            self._results = []
+        elif statement.startswith('EXECUTE'):
+            self._results = []
+            if statement.split()[1] in connection.returning:
+                self._results = [(next(connection.ids),)]
+        elif 'RETURNING' in statement:
+            self._results = [(next(connection.ids),)]
+        elif statement.startswith('SELECT nextval'):
+            self._results = [(next(connection.ids),)
+                             for i in range(args[2])]
+        elif 'FROM licenses' in statement:
+            self._results = [(l['id'], l['code'], l['version'], l['name'],
+                              l['url'],)
+                             for l in json.load(open(TEST_LICENSES_JSON))]
+        else:
+            self._results = []
+
+    def fetchone(self):
+        return self._results and self._results.pop(0) or None
+
+    def fetchall(self):
+        results, self._results = self._results, []
+        return results
+
+    def copy_expert(self, statement, fp, size=8192):
+        self.connection.copies.append((statement, fp.read(),))
+
+
+class _FakeConnection(object):
+    """A stand-in for a psycopg2 connection that records the statements
+    and COPY data sent to it. Statements with a RETURNING clause and
+    sequence allocations are answered with ids from a counter.
+    Statements containing a key of ``answers`` are answered with its rows.
+    Prepared statements with a RETURNING clause are answered likewise."""
+    dsn = 'fake'
+
+    def __init__(self):
+        import itertools
+        self.answers = {}
+        self.returning = set()
+        self.ids = itertools.count(1)
+        self.statements = []
+        self.copies = []
+        self.commits = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.commit()
+
+    def cursor(self):
+        return _FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+    def statements_like(self, text):
+        return [s for s, args in self.statements if text in s]
+
+
+class _ConflictingCursor(_FakeCursor):
+    """A ``_FakeCursor`` on which each digest is found to be recorded
+    (see ``DigestIndex.add``) by another transaction at the same time,
+    with the ids given by ``recorded_ids``."""
+
+    def __init__(self, connection, recorded_ids):
+        super(_ConflictingCursor, self).__init__(connection)
+        self.recorded_ids = recorded_ids
+
+    def execute(self, statement, args=None):
+        conflicted = self.rowcount == 0
+        super(_ConflictingCursor, self).execute(statement, args)
+        self.rowcount = int('ON CONFLICT' not in statement)
+        if conflicted and 'FROM file_digests' in statement:
+            self._results = [(next(self.recorded_ids),)]
+
+
+def _table_rows(connection):
+    """The rows inserted (with the ids returned by the ``connection``)
+    and copied into each table, as a mapping of the table names to lists
+    of rows. The rows map the column names to their values in COPY text
+    format, so the rows of either can be compared.
+    """
+    import itertools
+    import re
+    import psycopg2
+    from .pgcopy import format_copy_value
+    tables = {}
+    ids = itertools.count(1)
+    for statement, args in connection.statements:
+        match = re.match(r'INSERT INTO (\w+)\s+\(([^)]*)\)', statement)
+        if match is None:
+            continue
+        table, columns = match.group(1), match.group(2).split(', ')
+        values = []
+        for arg in args:
+            if isinstance(arg, psycopg2.Binary):
+                arg = bytearray(arg.adapted)
+            values.append(format_copy_value(arg))
+        row = dict(zip(columns, values))
+        returning = re.search(r'RETURNING (\w+)', statement)
+        if returning is not None:
+            row[returning.group(1)] = str(next(ids))
+        tables.setdefault(table, []).append(row)
+    for statement, data in connection.copies:
+        match = re.match(r'COPY (\w+) \(([^)]*)\)', statement)
+        table, columns = match.group(1), match.group(2).split(', ')
+        for line in data.splitlines():
+            tables.setdefault(table, []).append(
+                dict(zip(columns, line.split('\t'))))
+    return tables
+
+
+class PopulateTestCase(unittest.TestCase):
+    # Cases for populating from a completezip, against a fake connection.
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.location = _make_completezip(directory)
+
+    def test_row_by_row(self):
+        from .archive import populate_from_completezip
+        connection = _FakeConnection()
+        populate_from_completezip(self.location, {}, connection)
+        self.assertEqual(len(connection.statements_like(
+            'INSERT INTO modules')), 3)
+        # The collection.xml and each module's index.cnxml and a.png
+        self.assertEqual(len(connection.statements_like(
+            'INSERT INTO module_files')), 5)
+        self.assertEqual(connection.commits, 3)
+
+    def normalize_rows(self, connection):
+        """The module rows (without their ids) and the module files, as
+        ``(moduleid, filename, mimetype, file)``, populated on the
+        ``connection``.
+        """
+        tables = _table_rows(connection)
+        abstracts = dict([(row['abstractid'], row['abstract'],)
+                          for row in tables['abstracts']])
+        files = dict([(row['fileid'], row['file'],)
+                      for row in tables['files']])
+        modules = {}
+        for row in tables['modules']:
+            modules[row.pop('module_ident')] = row
+            row['abstract'] = abstracts[row.pop('abstractid')]
+        module_files = [(modules[row['module_ident']]['moduleid'],
+                         row['filename'], row['mimetype'],
+                         files[row['fileid']],)
+                        for row in tables['module_files']]
+        return (sorted(modules.values(), key=lambda row: row['moduleid']),
+                sorted(module_files),)
+
+    def test_bulk(self):
+        from .archive import (bulk_populate_from_completezip,
+                              populate_from_completezip)
+        ident_mappings = {'col10001': 'a-fixed-uuid'}
+        connection = _FakeConnection()
+        bulk_populate_from_completezip(self.location, dict(ident_mappings),
+                                       connection)
+        copies = dict([(statement.split()[1], data,)
+                       for statement, data in connection.copies])
+        self.assertEqual(len(copies['module_files'].splitlines()), 5)
+        self.assertEqual(len(copies['files'].splitlines()), 5)
+        self.assertEqual(len(copies['abstracts'].splitlines()), 3)
+        self.assertEqual(connection.commits, 1)
+        # The rows match those of the row-by-row population.
+        expected_connection = _FakeConnection()
+        populate_from_completezip(self.location, dict(ident_mappings),
+                                  expected_connection)
+        self.assertEqual(self.normalize_rows(connection),
+                         self.normalize_rows(expected_connection))
+
+    def test_bulk_concurrently_added_files(self):
+        # Case to test that the files another transaction stored at the
+        #   same time are referred to in place of the bulk loaded copies.
+        import itertools
+        from .archive import bulk_populate_from_completezip
+        from .blobs import BlobIndex
+        connection = _FakeConnection()
+        recorded_ids = itertools.count(100)
+        connection.cursor = lambda: _ConflictingCursor(connection,
+                                                       recorded_ids)
+        blob_index = BlobIndex()
+        bulk_populate_from_completezip(self.location, {}, connection,
+                                       blob_index=blob_index)
+        copies = dict([(statement.split()[1], data,)
+                       for statement, data in connection.copies])
+        copied_fileids = [int(line.split('\t')[0])
+                          for line in copies['files'].splitlines()]
+        # The collection.xml, each module's index.cnxml and the shared a.png
+        self.assertEqual(len(copied_fileids), 4)
+        discarded = [args[0] for statement, args in connection.statements
+                     if statement.startswith('DELETE FROM files')]
+        self.assertEqual(sorted(discarded), sorted(copied_fileids))
+        referred_fileids = set([int(line.split('\t')[1]) for line
+                                in copies['module_files'].splitlines()])
+        self.assertEqual(referred_fileids, set(range(100, 104)))
+        self.assertEqual(sorted(blob_index._ids.values()), range(100, 104))
+
+    def test_dedupe_abstracts(self):
+        # Case to test that the modules' identical abstracts
+        #   are only inserted once.
+        from .abstracts import AbstractIndex
+        from .archive import populate_from_completezip
+        connection = _FakeConnection()
+        populate_from_completezip(self.location, {}, connection,
+                                  abstract_index=AbstractIndex())
+        self.assertEqual(len(connection.statements_like(
+            'INSERT INTO abstracts')), 2)
+        self.assertEqual(len(connection.statements_like(
+            'INSERT INTO modules')), 3)
+
+    def test_dedupe_missing_abstracts(self):
+        # Case to test that a document without an abstract
+        #   is populated when abstracts are interned.
+        from .abstracts import AbstractIndex
+        from .archive import populate_from_completezip
+        path = os.path.join(self.location, 'collection.xml')
+        with open(path) as fp:
+            collection_xml = fp.read()
+        with open(path, 'w') as fp:
+            fp.write(collection_xml.replace(
+                '<md:abstract>A collection abstract</md:abstract>', ''))
+        connection = _FakeConnection()
+        populate_from_completezip(self.location, {}, connection,
+                                  abstract_index=AbstractIndex())
+        abstracts = [args for statement, args in connection.statements
+                     if statement.startswith('INSERT INTO abstracts')]
+        self.assertEqual(abstracts[0], (None,))
+        self.assertEqual(len(abstracts), 2)
+        self.assertEqual(len(connection.statements_like(
+            'INSERT INTO modules')), 3)
+
+    def test_module_columns_are_ordered(self):
+        from .archive import populate_from_completezip
+        connection = _FakeConnection()
+        populate_from_completezip(self.location, {}, connection)
+        for statement in connection.statements_like('INSERT INTO modules'):
+            columns = statement[statement.index('(') + 1:
+                                statement.index(')')].split(', ')
+            self.assertEqual(columns, sorted(columns))
+
+    def test_prepared_statements(self):
+        # Case to test that the modules are inserted with prepared
+        #   statements and the files in multi-row batches.
+        from .archive import populate_from_completezip
+        connection = _FakeConnection()
+        populate_from_completezip(self.location, {}, connection,
+                                  batch_size=10)
+        # The collection's insert and the one prepared for the modules.
+        self.assertEqual(len(connection.statements_like(
+            'INSERT INTO modules')), 2)
+        prepared = connection.statements_like('PREPARE')
+        # A module, its files and module_files (both modules have two).
+        self.assertEqual(len(prepared), 3)
+        self.assertTrue(prepared[0].startswith('PREPARE populate_'))
+        self.assertIn('VALUES ($1, $2, $3, $4), ($5, $6, $7, $8)',
+                      prepared[2])
+        executes = [args for statement, args in connection.statements
+                    if statement.startswith('EXECUTE')]
+        # Each of the two modules, its files and its module_files.
+        self.assertEqual([len(args) for args in executes],
+                         [len(executes[0]), 4, 8] * 2)
+        # The statements are deallocated once done.
+        self.assertEqual(len(connection.statements_like('DEALLOCATE')), 3)
+
+    def test_commit_every(self):
+        # Case to test that modules are committed in groups and that
+        #   a failed module is rolled back on its own and recorded.
+        from .archive import populate_from_completezip
+        with open(os.path.join(self.location, 'm10001',
+                               'index_auto_generated.cnxml'), 'w') as fp:
+            fp.write('<broken')
+        connection = _FakeConnection()
+        populate_from_completezip(self.location, {}, connection,
+                                  commit_every=10)
+        self.assertEqual(connection.commits, 1)
+        statements = [statement for statement, args in connection.statements
+                      if 'SAVEPOINT' in statement]
+        self.assertEqual(statements, [
+            'SAVEPOINT populate_module;',
+            'ROLLBACK TO SAVEPOINT populate_module;',
+            'SAVEPOINT populate_module;',
+            'RELEASE SAVEPOINT populate_module;',
+            ])
+        failures = [args[:3] for statement, args in connection.statements
+                    if statement.startswith('INSERT INTO populate_failures')]
+        self.assertEqual(failures, [('col10001', '1.1', 'm10001',)])
+        self.assertEqual(len(connection.statements_like(
+            'INSERT INTO modules')), 2)
+
+        connection = _FakeConnection()
+        populate_from_completezip(self.location, {}, connection,
+                                  commit_every=1)
+        self.assertEqual(connection.commits, 3)
+
+    def test_resumed_module_is_skipped(self):
+        from .archive import populate_module
+        from .blobs import hash_file
+        from .checkpoint import Checkpoint, CollectionProgress
+        path = os.path.join(self.location, 'm10001',
+                            'index_auto_generated.cnxml')
+        with open(path, 'rb') as fp:
+            digest = hash_file(fp)
+        progress = CollectionProgress(Checkpoint(), 'col10001', '1.1',
+                                      {'m10001': (digest, 42,)})
+        connection = _FakeConnection()
+
+        module_ident = populate_module(self.location, 'm10001', connection,
+                                       progress=progress)
+
+        self.assertEqual(module_ident, 42)
+        self.assertEqual(connection.statements, [])
+
+    def test_progress_is_recorded(self):
+        from .archive import populate_from_completezip
+        from .checkpoint import Checkpoint
+        connection = _FakeConnection()
+        populate_from_completezip(self.location, {}, connection,
+                                  checkpoint=Checkpoint())
+        recorded = [args[2:4] for statement, args in connection.statements
+                    if statement.startswith('INSERT INTO populate_progress')]
+        self.assertEqual([document_id for document_id, digest in recorded],
+                         ['collection.xml', 'm10001', 'm10002'])
+        # Each document is recorded with the digest of its metadata file.
+        self.assertEqual([digest for document_id, digest in recorded
+                          if digest is None], [])
+
+    def test_second_run_in_process_is_skipped(self):
+        # Case to test that a run of a collection sees the progress
+        #   recorded by an earlier run with the same checkpoint.
+        from .archive import populate_from_completezip
+        from .checkpoint import Checkpoint
+        checkpoint = Checkpoint()
+        connection = _FakeConnection()
+        populate_from_completezip(self.location, {}, connection,
+                                  checkpoint=checkpoint)
+        self.assertEqual(len(connection.statements_like(
+            'INSERT INTO modules')), 3)
+        connection.answers['FROM populate_progress'] = [
+            args[2:] for statement, args in connection.statements
+            if statement.startswith('INSERT INTO populate_progress')]
+        connection.answers['SELECT uuid FROM modules'] = [(
+            '00000000-0000-0000-0000-000000000001',)]
+
+        populate_from_completezip(self.location, {}, connection,
+                                  checkpoint=checkpoint)
+        self.assertEqual(len(connection.statements_like(
+            'INSERT INTO modules')), 3)
+
+
+class _SharedCounter(object):
+    """An id counter shared by the processes of a pool."""
+
+    def __init__(self):
+        import multiprocessing
+        self.value = multiprocessing.Value('i', 0)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        with self.value.get_lock():
+            self.value.value += 1
+            return self.value.value
+
+
+class _SharedStatements(object):
+    """A list of statements shared by the processes of a pool, kept in
+    a multiprocessing manager's list. Each statement is recorded with
+    the id of the process that executed it."""
+
+    def __init__(self, shared):
+        self.shared = shared
+
+    def append(self, statement):
+        statement, args = statement
+        if args is not None:
+            args = tuple([getattr(arg, 'adapted', arg) for arg in args])
+        self.shared.append((os.getpid(), statement, args,))
+
+    def __iter__(self):
+        return iter([(statement, args,)
+                     for pid, statement, args in list(self.shared)])
+
+
+class WorkerPoolTestCase(unittest.TestCase):
+    # Cases for populating the modules with a pool of worker processes,
+    #   each connected through a patched ``psycopg2.connect``.
+
+    def setUp(self):
+        import multiprocessing
+        import time
+        import psycopg2
+        from .synthetic import make_completezip
+        import cnxpopulate as pkg
+        self.licenses = pkg.licenses
+        self.addCleanup(self.licenses.clear)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.location = make_completezip(directory, modules=6, images=2,
+                                         image_size=100)
+        manager = multiprocessing.Manager()
+        self.addCleanup(manager.shutdown)
+        self.shared = manager.list()
+        ids = _SharedCounter()
+        shared = self.shared
+
+        def connect(dsn):
+            connection = _FakeConnection()
+            connection.ids = ids
+            connection.statements = _SharedStatements(shared)
+            # Slows the workers enough that they all take modules.
+            connection.commit = lambda: time.sleep(0.05)
+            return connection
+
+        original_connect = psycopg2.connect
+        psycopg2.connect = connect
+        self.addCleanup(setattr, psycopg2, 'connect', original_connect)
+
+    def populate(self, pool=None):
+        from .archive import populate_from_completezip
+        from .metrics import metrics
+        self.licenses.clear()
+        metrics.reset()
+        connection = _FakeConnection()
+        ident_mappings = {'col90000': uuid.UUID(int=1)}
+        populate_from_completezip(self.location, ident_mappings, connection,
+                                  pool=pool)
+        statements = list(connection.statements) \
+            + [(statement, args,) for pid, statement, args in self.shared]
+        # The ids differ between the runs, so only the rows' values
+        #   are compared.
+        rows = sorted([(statement, tuple([
+                            not isinstance(arg, (int, long,)) and arg or None
+                            for arg in args or ()]),)
+                       for statement, args in _normalize_statements(statements)
+                       if statement.startswith('INSERT')])
+        return rows, metrics.summary()['stages'], ident_mappings
+
+    def test_same_rows_as_serial(self):
+        from .archive import create_worker_pool
+        expected_rows, expected_stages, expected_mappings = self.populate()
+        pool = create_worker_pool(2, 'fake')
+        try:
+            rows, stages, ident_mappings = self.populate(pool)
+        finally:
+            pool.close()
+            pool.join()
+
+        self.assertEqual(rows, expected_rows)
+        self.assertEqual(ident_mappings, expected_mappings)
+        collection_rows = [args for statement, args in rows
+                           if 'INSERT INTO modules' in statement
+                           and 'Collection' in args]
+        self.assertEqual(len(collection_rows), 1)
+        self.assertIn(str(uuid.UUID(int=1)), collection_rows[0])
+        # The metrics of the workers are merged into those of the parent.
+        for stage in ('parse', 'insert', 'upload',):
+            for counter in ('calls', 'rows', 'bytes',):
+                self.assertEqual(stages[stage][counter],
+                                 expected_stages[stage][counter])
+        # The modules were spread across the workers.
+        pids = set([pid for pid, statement, args in self.shared
+                    if statement.startswith('INSERT INTO modules')])
+        self.assertEqual(len(pids), 2)
+
+
+class _FakeConnectionPool(object):
+    """A stand-in for a ``psycopg2.pool`` of ``_FakeConnection``."""
+
+    def __init__(self):
+        self.connections = []
+        self.idle = []
+
+    def getconn(self):
+        if not self.idle:
+            connection = _FakeConnection()
+            self.connections.append(connection)
+            self.idle.append(connection)
+        return self.idle.pop()
+
+    def putconn(self, connection):
+        self.idle.append(connection)
+
+
+class BatchTestCase(unittest.TestCase):
+    # Cases for populating a batch of collections.
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        _make_completezip(self.directory)
+
+    def test_read_batch(self):
+        from .batch import read_batch
+        lines = ["# The collections\n", "col10001 1.1 1.2\n", "\n",
+                 "  col10002\n"]
+        self.assertEqual(read_batch(lines),
+                         [('col10001', ['1.1', '1.2'],),
+                          ('col10002', ['latest'],)])
+
+    def test_populate_batch(self):
+        # Collections share the pooled connection and a failure
+        #   doesn't stop the rest of the batch.
+        from .archive import populate_from_completezip
+        from .batch import BatchPopulator, format_report
+        connection_pool = _FakeConnectionPool()
+        populator = BatchPopulator(connection_pool,
+                                   lambda: populate_from_completezip,
+                                   self.directory, host='http://127.0.0.1:9')
+        entries = [('col10001', ['1.1'],), ('col10002', ['1.1'],),
+                   ('col10001', ['1.1'],)]
+
+        results = list(populator.run(entries))
+
+        self.assertEqual([r.ok for r in results], [True, False, True])
+        self.assertEqual([r.modules for r in results], [2, 0, 2])
+        self.assertEqual(len(connection_pool.connections), 1)
+        # The identity mapping is kept for the whole batch.
+        collection_uuid = str(populator.ident_mappings['col10001'])
+        inserted = [args for statement, args
+                    in connection_pool.connections[0].statements
+                    if 'INSERT INTO modules' in statement
+                    and collection_uuid in args]
+        self.assertEqual(len(inserted), 2)
+        report = format_report(results, 2.0)
+        self.assertIn("3 collections (1 failed), 2 versions and 4 modules",
+                      report)
+        self.assertIn("2.00 modules/s", report)
+
+    def test_failed_collection_forgets_index_entries(self):
+        # Case to test that the files a failed collection added to the
+        #   blob index aren't reused by the next collection.
+        from .archive import populate_from_completezip
+        from .batch import BatchPopulator
+        from .blobs import BlobIndex
+
+        class FailingConnection(_FakeConnection):
+            failures = 1
+
+            def commit(self):
+                if self.failures:
+                    self.failures -= 1
+                    raise RuntimeError("The commit failed.")
+                _FakeConnection.commit(self)
+
+        connection = FailingConnection()
+        connection_pool = _FakeConnectionPool()
+        connection_pool.idle.append(connection)
+        populate = functools.partial(populate_from_completezip,
+                                     blob_index=BlobIndex())
+        populator = BatchPopulator(connection_pool, lambda: populate,
+                                   self.directory, host='http://127.0.0.1:9')
+        entries = [('col10001', ['1.1'],), ('col10001', ['1.1'],)]
+
+        results = list(populator.run(entries))
+
+        self.assertEqual([r.ok for r in results], [False, True])
+        collection_xml = TEST_SMALL_COLLECTION_XML
+        inserted = [args[0].adapted for statement, args
+                    in connection.statements
+                    if statement.startswith('INSERT INTO files')]
+        # The collection.xml of the failed collection and again
+        #   of the next one.
+        self.assertEqual(inserted.count(collection_xml), 2)
+
+
+class _MemoryQueue(object):
+    """A stand-in for a ``workqueue.WorkQueue`` that keeps its jobs
+    in memory."""
+
+    def __init__(self, entries, max_attempts=2):
+        from .workqueue import Job
+        self.psycopg_conn = _FakeConnection()
+        self.max_attempts = max_attempts
+        self.jobs = [Job(i + 1, collection_id, version, 0)
+                     for i, (collection_id, version) in enumerate(entries)]
+        self.states = dict([(job.id, 'pending',) for job in self.jobs])
+        self.uuids = {}
+
+    def reclaim(self):
+        return 0
+
+    def _earlier_states(self, job):
+        return [self.states[earlier.id] for earlier in self.jobs
+                if earlier.collection_id == job.collection_id
+                and earlier.id < job.id]
+
+    def claim(self, worker):
+        for job in self.jobs:
+            if self.states[job.id] == 'pending' and \
+                    set(self._earlier_states(job)) <= set(['done']):
+                self.states[job.id] = 'running'
+                job.attempts += 1
+                return job
+        return None
+
+    def heartbeat(self, job, worker):
+        return True
+
+    def complete(self, job, worker, modules):
+        self.states[job.id] = 'done'
+        return True
+
+    def fail(self, job, worker, error):
+        self.states[job.id] = job.attempts < self.max_attempts \
+            and 'pending' or 'failed'
+
+    def counts(self):
+        counts = {}
+        for job in self.jobs:
+            state = job in self.blocked() and 'blocked' \
+                or self.states[job.id]
+            counts[state] = counts.get(state, 0) + 1
+        return counts
+
+    def blocked(self):
+        return [job for job in self.jobs
+                if self.states[job.id] == 'pending'
+                and 'failed' in self._earlier_states(job)]
+
+    def ident_uuid(self, collection_id):
+        return self.uuids.setdefault(collection_id, uuid.uuid4())
+
+
+class WorkQueueTestCase(unittest.TestCase):
+    # Cases for the work queue shared by workers on many hosts.
+
+    def test_seed_and_claim(self):
+        from .workqueue import WorkQueue
+        connection = _FakeConnection()
+        queue = WorkQueue(connection)
+        connection.answers['RETURNING jobid;'] = [(1,)]
+        self.assertEqual(queue.seed([('col10001', ['1.1', '1.2'],)]), 2)
+        connection.answers['RETURNING jobid, collectionid'] = [
+            (1, 'col10001', '1.1', 1,)]
+        job = queue.claim('host:1')
+        self.assertEqual((job.id, job.collection_id, job.version,
+                          job.attempts,), (1, 'col10001', '1.1', 1,))
+        statement, args = connection.statements[-1]
+        self.assertIn('FOR UPDATE SKIP LOCKED', statement)
+        self.assertEqual(args, ('host:1',))
+        # Each operation is a transaction of its own.
+        self.assertEqual(connection.commits, 3)
+
+        connection.answers['RETURNING jobid, collectionid'] = []
+        connection.answers['RETURNING jobid;'] = []
+        self.assertEqual(queue.claim('host:1'), None)
+        # A job reclaimed from the worker is no longer held by it.
+        self.assertFalse(queue.complete(job, 'host:1', 2))
+
+    def test_worker_retries_failed_jobs(self):
+        from .workqueue import QueueWorker
+        queue = _MemoryQueue([('col10001', '1.1',), ('col10002', '1.1',),
+                              ('col10003', '1.1',)])
+        calls = []
+
+        def populate(location, ident_mappings, psycopg_conn):
+            calls.append((location, ident_mappings,))
+            # The second collection fails once and the third always does.
+            if location == 'col10003' or \
+                    (location == 'col10002' and len(calls) == 2):
+                raise ValueError("Failed to populate.")
+            return 2
+
+        class Worker(QueueWorker):
+            def _queue(self):
+                return queue
+
+        worker = Worker(lambda: _FakeConnection(), populate,
+                        lambda collection_id, version: collection_id,
+                        name='host:1', heartbeat_interval=60)
+        self.assertEqual(worker.run(), 2)
+        self.assertEqual(queue.counts(), {'done': 2, 'failed': 1})
+        self.assertEqual([location for location, mappings in calls],
+                         ['col10001', 'col10002', 'col10002', 'col10003',
+                          'col10003'])
+        # The uuids are those shared through the queue.
+        self.assertEqual(calls[0][1], {'col10001': queue.uuids['col10001']})
+
+    def test_worker_reports_blocked_jobs(self):
+        # Case to test that the versions after a failed version of
+        #   a collection are reported as blocked when the worker exits.
+        import logging
+        from .workqueue import QueueWorker, format_status, logger
+        queue = _MemoryQueue([('col10001', '1.1',), ('col10001', '1.2',),
+                              ('col10001', '1.3',), ('col10002', '1.1',)])
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+
+        def populate(location, ident_mappings, psycopg_conn):
+            if location == ('col10001', '1.1',):
+                raise ValueError("Failed to populate.")
+            return 2
+
+        class Worker(QueueWorker):
+            def _queue(self):
+                return queue
+
+        worker = Worker(lambda: _FakeConnection(), populate,
+                        lambda collection_id, version: (collection_id,
+                                                        version,),
+                        name='host:1', heartbeat_interval=60)
+        self.assertEqual(worker.run(), 1)
+        self.assertEqual(queue.counts(), {'done': 1, 'failed': 1,
+                                          'blocked': 2})
+        self.assertEqual(format_status(queue.counts()),
+                         "0 pending, 0 running, 1 done, 1 failed, 2 blocked")
+        warnings = [record.getMessage() for record in records
+                    if record.levelno == logging.WARNING]
+        self.assertEqual(warnings, [
+            "Job 2 of 'col10001' version '1.2' is blocked on a failed "
+            "version of the collection.",
+            "Job 3 of 'col10001' version '1.3' is blocked on a failed "
+            "version of the collection."])
+
+    def test_worker_abandons_a_reclaimed_job(self):
+        # Case to test that a worker stops populating a job that was
+        #   reclaimed while it populated, without committing.
+        import time
+        from .workqueue import QueueWorker
+        queue = _MemoryQueue([('col10001', '1.1',)])
+        # The job was reclaimed by another worker.
+        queue.heartbeat = lambda job, worker: False
+
+        def populate(location, ident_mappings, psycopg_conn):
+            psycopg_conn.commit()
+            # Long enough for a heartbeat to find the job lost.
+            time.sleep(0.3)
+            psycopg_conn.commit()
+            return 2
+
+        class Worker(QueueWorker):
+            def _queue(self):
+                return queue
+
+        worker = Worker(lambda: _FakeConnection(), populate,
+                        lambda collection_id, version: collection_id,
+                        name='host:1', heartbeat_interval=0.05)
+        connection = _FakeConnection()
+        job = queue.claim('host:1')
+        self.assertFalse(worker.run_job(queue, job, connection))
+        # Only the first module was committed, and the job is left
+        #   to the worker that reclaimed it.
+        self.assertEqual(connection.commits, 1)
+        self.assertEqual(queue.states[job.id], 'running')
+
+
+@unittest.skipUnless(os.environ.get('CNXPOPULATE_TEST_DSN'),
+                     "CNXPOPULATE_TEST_DSN isn't set to a test database")
+class WorkQueueDatabaseTestCase(unittest.TestCase):
+    # Cases for several worker processes sharing the work queue of
+    #   a PostgreSQL (9.5 or later) test database.
+
+    def setUp(self):
+        import psycopg2
+        self.dsn = os.environ['CNXPOPULATE_TEST_DSN']
+        connection = psycopg2.connect(self.dsn)
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute("DROP TABLE IF EXISTS populate_jobs, "
+                               "populate_idents, populated_test;"
+                               "CREATE TABLE populated_test ("
+                               "  collectionid TEXT, version TEXT,"
+                               "  uuid TEXT, worker INTEGER);")
+        connection.close()
+
+    def test_workers_share_the_queue(self):
+        import multiprocessing
+        import psycopg2
+        from .workqueue import QueueWorker, WorkQueue
+        dsn = self.dsn
+        connect = lambda: psycopg2.connect(dsn)
+        queue = WorkQueue(connect())
+        queue.create_tables()
+        entries = [('col{}'.format(10000 + i), ['1.1', '1.2', '1.3'],)
+                   for i in range(5)]
+        self.assertEqual(queue.seed(entries), 15)
+
+        def work():
+            def populate(location, ident_mappings, psycopg_conn):
+                collection_id, version = location
+                with psycopg_conn.cursor() as cursor:
+                    cursor.execute("INSERT INTO populated_test "
+                                   "VALUES (%s, %s, %s, %s);",
+                                   (collection_id, version,
+                                    str(ident_mappings[collection_id]),
+                                    os.getpid(),))
+                return 1
+            worker = QueueWorker(connect, populate,
+                                 lambda *job: job, poll_interval=0.1)
+            worker.run()
+
+        processes = [multiprocessing.Process(target=work) for i in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        self.assertEqual(queue.counts(), {'done': 15})
+        with queue.psycopg_conn.cursor() as cursor:
+            cursor.execute("SELECT collectionid, version, uuid "
+                           "FROM populated_test ORDER BY worker;")
+            rows = cursor.fetchall()
+        # Each job was populated once, with the collection's one uuid.
+        self.assertEqual(sorted([row[:2] for row in rows]),
+                         sorted([(collection_id, version,)
+                                 for collection_id, versions in entries
+                                 for version in versions]))
+        self.assertEqual(len(set([(row[0], row[2],) for row in rows])), 5)
+        queue.psycopg_conn.close()
+
+
+class SyntheticTestCase(unittest.TestCase):
+    # Cases for the synthetic completezip generator.
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_make_completezip(self):
+        from .parsers import parse_collection_xml, parse_module_xml
+        from .sources import open_source
+        from .synthetic import make_completezip
+        locations = [make_completezip(self.directory, modules=3, images=4,
+                                      image_size=100, shared_ratio=0.5,
+                                      seed=1, as_zip=as_zip)
+                     for as_zip in (False, True,)]
+        trees = []
+        for location in locations:
+            with open_source(location) as source:
+                with source.open('collection.xml') as fp:
+                    contents = parse_collection_xml(fp)[3]
+                self.assertEqual(len(contents), 3)
+                tree = {}
+                for module_id in contents:
+                    path = '/'.join([module_id, 'index_auto_generated.cnxml'])
+                    with source.open(path) as fp:
+                        resources = parse_module_xml(fp)[3]
+                    self.assertEqual(len(resources), 4)
+                    for filename, mimetype in resources:
+                        path = '/'.join([module_id, filename])
+                        with source.open(path) as fp:
+                            tree[path] = fp.read()
+                trees.append(tree)
+        # The directory and the zip have the same content.
+        self.assertEqual(trees[0], trees[1])
+        self.assertEqual(set([len(data) for data in trees[0].values()]),
+                         set([100]))
+        # Shared images have the same content in each module.
+        shared = {}
+        for path, data in trees[0].items():
+            if '/shared-' in path:
+                shared.setdefault(path.split('/')[1], set()).add(data)
+        self.assertTrue(shared)
+        self.assertEqual([len(datas) for datas in shared.values()],
+                         [1] * len(shared))
+
+    def test_reproducible(self):
+        from .synthetic import make_completezip
+        locations = []
+        for name in ('a', 'b',):
+            os.mkdir(os.path.join(self.directory, name))
+            locations.append(make_completezip(
+                os.path.join(self.directory, name), modules=2, images=2,
+                image_size=50, shared_ratio=0.5, seed=7))
+
+        def listing(location):
+            results = {}
+            for dirpath, dirnames, filenames in os.walk(location):
+                for filename in filenames:
+                    with open(os.path.join(dirpath, filename), 'rb') as fp:
+                        results[os.path.relpath(fp.name, location)] = \
+                            fp.read()
+            return results
+        self.assertEqual(listing(locations[0]), listing(locations[1]))
+
+
+class MetricsTestCase(unittest.TestCase):
+    # Cases for the stage metrics.
+
+    def test_timer_and_merge(self):
+        from .metrics import Metrics
+        metrics = Metrics()
+        with metrics.timer('upload', bytes=10, rows=1):
+            pass
+        with metrics.timer('upload') as measure:
+            measure.bytes = 5
+        other = Metrics()
+        other.merge(metrics.snapshot())
+        other.add('commit', 0.5)
+        stages = other.summary()['stages']
+        self.assertEqual(stages.keys(), ['upload', 'commit'])
+        self.assertEqual((stages['upload']['calls'], stages['upload']['bytes'],
+                          stages['upload']['rows'],), (2, 15, 1,))
+        self.assertEqual(stages['commit']['seconds'], 0.5)
+        self.assertIn('commit 1x 0.5s', other.format_progress())
+
+    def test_write_prometheus(self):
+        from .metrics import Metrics
+        metrics = Metrics()
+        metrics.add('parse', 1.5, bytes=100)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        filepath = os.path.join(directory, 'populate.prom')
+        metrics.write_prometheus(filepath)
+        with open(filepath) as fp:
+            lines = fp.read().splitlines()
+        self.assertIn('# TYPE cnxpopulate_stage_seconds_total counter', lines)
+        self.assertIn('cnxpopulate_stage_seconds_total{stage="parse"} 1.5',
+                      lines)
+        self.assertIn('cnxpopulate_stage_bytes_total{stage="parse"} 100',
+                      lines)
+        self.assertEqual(os.listdir(directory), ['populate.prom'])
+
+    def test_populate_is_measured(self):
+        from .archive import populate_from_completezip
+        from .metrics import metrics
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        location = _make_completezip(directory)
+        metrics.reset()
+        populate_from_completezip(location, {}, _FakeConnection())
+        stages = metrics.summary()['stages']
+        self.assertEqual(set(stages), set(['read', 'parse', 'license',
+                                           'insert', 'upload', 'commit']))
+        self.assertEqual(stages['parse']['calls'], 3)
+        self.assertEqual(stages['upload']['rows'], 5)
+        # The abstract and modules rows of each document,
+        #   and the module_files rows.
+        self.assertEqual(stages['insert']['rows'], 2 + 2 * 2 + 5)
+
+
+class ExportTestCase(unittest.TestCase):
+    # Cases for the offline export and its loader.
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def export(self, **kwargs):
+        from .export import export_completezip
+        from .synthetic import make_completezip
+        location = make_completezip(self.directory, **kwargs)
+        output_dir = os.path.join(self.directory, 'export')
+        manifest = export_completezip(
+            location, output_dir, LicenseTable.from_json(TEST_LICENSES_JSON))
+        return output_dir, manifest
+
+    def test_export(self):
+        output_dir, manifest = self.export(modules=2, images=2,
+                                           image_size=10, shared_ratio=1.0)
+        tables = {}
+        for entry in manifest['tables']:
+            tables.setdefault(entry['table'], {'rows': 0})
+            tables[entry['table']]['rows'] += entry['rows']
+        # The modules are exported in a file per column set.
+        self.assertEqual([entry['table'] for entry in manifest['tables']],
+                         ['abstracts', 'modules', 'modules', 'files',
+                          'module_files'])
+        self.assertEqual(tables['modules']['rows'], 3)
+        # The images are shared by both modules and exported once.
+        self.assertEqual(tables['files']['rows'], 5)
+        self.assertEqual(tables['module_files']['rows'], 7)
+        self.assertEqual(len(manifest['digests']), 5)
+        with open(os.path.join(output_dir, 'module_files.copy')) as fp:
+            lines = fp.read().splitlines()
+        self.assertEqual(lines[0], '1\t1\tcollection.xml\ttext/xml')
+        with open(os.path.join(output_dir, 'manifest.json')) as fp:
+            self.assertEqual(json.load(fp), manifest)
+
+    def test_load_export(self):
+        from .export import load_export
+        output_dir, manifest = self.export(modules=1, images=1,
+                                           image_size=10)
+        connection = _FakeConnection()
+        load_export(output_dir, connection)
+        copied = [statement for statement, data in connection.copies]
+        self.assertEqual(copied, [
+            'COPY _staging_{} ({}) FROM STDIN'.format(
+                i, ', '.join(entry['columns']))
+            for i, entry in enumerate(manifest['tables'])])
+        inserts = connection.statements_like('INSERT INTO module_files')
+        self.assertEqual(inserts, [
+            'INSERT INTO module_files (module_ident, fileid, filename, '
+            'mimetype) SELECT m0.id, m1.id, s.filename, s.mimetype '
+            'FROM _staging_4 s JOIN _ids_modules m0 ON m0.local = '
+            's.module_ident JOIN _ids_files m1 ON m1.local = s.fileid;'])
+        self.assertEqual(len(connection.statements_like('INSERT INTO _ids_')),
+                         4)
+        self.assertEqual(connection.commits, 1)
+
+    def test_load_export_twice(self):
+        # Case to test that the files of an export loaded again refer
+        #   to the content stored by the first load.
+        from .blobs import BlobIndex
+        from .export import load_export
+        output_dir, manifest = self.export(modules=1, images=1,
+                                           image_size=10)
+        blob_index = BlobIndex()
+        connection = _FakeConnection()
+        connection.answers['FROM _ids_files'] = [(21,)]
+        load_export(output_dir, connection, blob_index)
+        self.assertEqual(len(connection.statements_like('INSERT INTO files')),
+                         1)
+        self.assertEqual(len(blob_index), len(manifest['digests']))
+        del connection.statements[:]
+        load_export(output_dir, connection, blob_index)
+        self.assertEqual(connection.statements_like('INSERT INTO files'), [])
+        self.assertEqual(connection.statements_like('file_digests'), [])
+        mapped = [args for statement, args in connection.statements
+                  if statement.startswith('INSERT INTO _ids_files')]
+        self.assertEqual(sorted(mapped),
+                         [(int(local), 21,) for local in
+                          sorted(manifest['digests'], key=int)])
+        self.assertEqual(len(connection.statements_like(
+            'INSERT INTO module_files')), 1)
+
+
+def _normalize_statements(statements):
+    """Replace the adapted binary arguments of the ``statements`` by
+    their content, so they can be compared.
+    """
+    import re
+    normalized = []
+    names = {}
+    for statement, args in statements:
+        if args is not None:
+            args = tuple([getattr(arg, 'adapted', arg) for arg in args])
+        # Prepared statements are numbered in the order they're prepared.
+        statement = re.sub(r'populate_\d+',
+                           lambda m: names.setdefault(m.group(),
+                                                      len(names)).__str__(),
+                           statement)
+        normalized.append((statement, args,))
+    return normalized
+
+
+class PipelineTestCase(unittest.TestCase):
+    # Cases for the pipelined population, which is to produce the same
+    #   rows as the reference implementation.
+
+    def setUp(self):
+        import cnxpopulate as pkg
+        self.licenses = pkg.licenses
+        self.addCleanup(self.licenses.clear)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def assert_same_rows(self, location, dedupe=False, pipeline_options={},
+                         **kwargs):
+        from .archive import populate_from_completezip
+        from .blobs import BlobIndex
+        from .pipeline import pipelined_populate_from_completezip
+        pipelined_populate = functools.partial(
+            pipelined_populate_from_completezip, **pipeline_options)
+        connections = []
+        for populate in (populate_from_completezip, pipelined_populate,):
+            # Each run is against a new database.
+            self.licenses.clear()
+            connection = _FakeConnection()
+            blob_index = dedupe and BlobIndex() or None
+            populate(location, {'col90000': 'a-fixed-uuid'}, connection,
+                     blob_index=blob_index, **kwargs)
+            connections.append(connection)
+        expected, actual = connections
+        self.assertEqual(_normalize_statements(actual.statements),
+                         _normalize_statements(expected.statements))
+        self.assertEqual(actual.commits, expected.commits)
+
+    def test_same_rows(self):
+        from .synthetic import make_completezip
+        location = make_completezip(self.directory, modules=12, images=3,
+                                    image_size=100)
+        self.assert_same_rows(location, pipeline_options={'readers': 3,
+                                                          'queue_size': 2})
+
+    def test_same_rows_from_zip(self):
+        from .synthetic import make_completezip
+        location = make_completezip(self.directory, modules=12, images=3,
+                                    image_size=100, as_zip=True)
+        self.assert_same_rows(location)
+
+    def test_same_rows_with_prepared_statements(self):
+        from .synthetic import make_completezip
+        location = make_completezip(self.directory, modules=6, images=5,
+                                    image_size=1000, shared_ratio=0.5)
+        self.assert_same_rows(location, dedupe=True, batch_size=2)
+
+    def test_same_rows_with_dedupe_and_streaming(self):
+        # Case for the files being deduplicated and the files over the
+        #   threshold being streamed by the writer rather than read ahead.
+        from .synthetic import make_completezip
+        location = make_completezip(self.directory, modules=12, images=3,
+                                    image_size=1000, shared_ratio=0.5,
+                                    as_zip=True)
+        self.assert_same_rows(location, dedupe=True, stream_threshold=500)
+
+
+class IncrementalTestCase(unittest.TestCase):
+    # Cases for loading a collection incrementally from its previous
+    #   version, using the fingerprints of the module directories.
+
+    def setUp(self):
+        from .synthetic import make_completezip
+        import cnxpopulate as pkg
+        pkg.licenses.populate(LicenseTable.from_json(TEST_LICENSES_JSON))
+        self.addCleanup(pkg.licenses.clear)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.locations = [make_completezip(self.directory, modules=5,
+                                           images=2, image_size=100,
+                                           version=version)
+                          for version in ('1.1', '1.2',)]
+
+    def recorded_fingerprints(self, connection):
+        return [args[1:] for statement, args in connection.statements
+                if statement.startswith('INSERT INTO populate_fingerprints')]
+
+    def test_fingerprint_module(self):
+        from .fingerprints import fingerprint_module
+        from .sources import DirectorySource
+        first, second = [DirectorySource(location)
+                         for location in self.locations]
+        self.assertEqual(fingerprint_module(first, 'm90001'),
+                         fingerprint_module(second, 'm90001'))
+        self.assertNotEqual(fingerprint_module(first, 'm90001'),
+                            fingerprint_module(first, 'm90002'))
+        # A change to any file changes the fingerprint.
+        with open(os.path.join(self.locations[1], 'm90001', 'image-1.png'),
+                  'ab') as fp:
+            fp.write('changed')
+        self.assertNotEqual(fingerprint_module(first, 'm90001'),
+                            fingerprint_module(second, 'm90001'))
+
+    def test_unchanged_modules_are_reused(self):
+        from .archive import populate_from_completezip
+        from .fingerprints import Fingerprints
+        with open(os.path.join(self.locations[1], 'm90003', 'image-0.png'),
+                  'ab') as fp:
+            fp.write('changed')
+
+        connection = _FakeConnection()
+        populate_from_completezip(self.locations[0], {}, connection,
+                                  fingerprints=Fingerprints())
+        recorded = self.recorded_fingerprints(connection)
+        self.assertEqual([document_id for document_id, f, i in recorded],
+                         ['m90000', 'm90001', 'm90002', 'm90003', 'm90004'])
+
+        # The next version, against the fingerprints recorded for the first.
+        connection.answers['FROM populate_fingerprints'] = recorded
+        del connection.statements[:]
+        populate_from_completezip(self.locations[1], {}, connection,
+                                  fingerprints=Fingerprints())
+        # Only the collection and the changed module are inserted.
+        self.assertEqual(len(connection.statements_like(
+            'INSERT INTO modules')), 2)
+        self.assertEqual([document_id for document_id, f, i
+                          in self.recorded_fingerprints(connection)],
+                         ['m90003'])
+
+
+class ParseCacheTestCase(unittest.TestCase):
+    # Cases for the persistent cache of parsed documents.
+
+    def setUp(self):
+        import cnxpopulate as pkg
+        self.licenses = pkg.licenses
+        self.addCleanup(self.licenses.clear)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'parse-cache.db')
+
+    def test_put_and_get(self):
+        from .parsecache import ParseCache
+        cache = ParseCache(self.path)
+        self.assertEqual(cache.get('parse_module_xml', 'abc'), None)
+        result = [u'An abstract', 'http://a/license', {'title': u'A'},
+                  [('a.png', 'image/png',)]]
+        cache.put('parse_module_xml', 'abc', result)
+        self.assertEqual(cache.get('parse_module_xml', 'abc'), result)
+        self.assertEqual(cache.get('parse_collection_xml', 'abc'), None)
+        cache.close()
+
+        # The results persist, but only for the same parser version.
+        cache = ParseCache(self.path)
+        self.assertEqual(cache.get('parse_module_xml', 'abc'), result)
+        cache.close()
+        cache = ParseCache(self.path, version=-1)
+        self.assertEqual(cache.get('parse_module_xml', 'abc'), None)
+        self.assertEqual(len(cache), 0)
+        cache.close()
+
+    def test_least_recently_used_are_evicted(self):
+        from .parsecache import ParseCache
+        cache = ParseCache(self.path)
+        cache.put('parse_module_xml', 'a', ['a' * 100])
+        size = cache._size
+        cache.close()
+
+        # Room for two results, but not for three.
+        cache = ParseCache(self.path, max_size=size * 3 - 1)
+        cache.put('parse_module_xml', 'b', ['a' * 100])
+        cache.get('parse_module_xml', 'a')
+        cache.put('parse_module_xml', 'c', ['a' * 100])
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('parse_module_xml', 'b'), None)
+        self.assertNotEqual(cache.get('parse_module_xml', 'a'), None)
+        self.assertNotEqual(cache.get('parse_module_xml', 'c'), None)
+        cache.close()
+
+    def test_rerun_skips_parsing(self):
+        from .archive import populate_from_completezip
+        from .metrics import metrics
+        from .parsecache import ParseCache
+        location = _make_completezip(self.directory)
+        connections = []
+        for run in range(2):
+            self.licenses.clear()
+            metrics.reset()
+            cache = ParseCache(self.path)
+            connection = _FakeConnection()
+            populate_from_completezip(location, {'col10001': 'a-fixed-uuid'},
+                                      connection, parse_cache=cache)
+            cache.close()
+            connections.append(connection)
+        stages = metrics.summary()['stages']
+        self.assertFalse('parse' in stages)
+        self.assertEqual(stages['parse_cache']['calls'], 3)
+        first, second = connections
+        self.assertEqual(_normalize_statements(second.statements),
+                         _normalize_statements(first.statements))
@@ -0,0 +1,530 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""Populate a cnx-archive database from a work queue kept in the database,
+which any number of worker processes on any number of hosts take jobs
+from. A job is a version of a collection. The queue is seeded from a
+batch file (see ``batch.read_batch``), for example::
+
+    python -m cnxpopulate.workqueue seed collections.txt
+    python -m cnxpopulate.workqueue work     # on as many hosts as wanted
+    python -m cnxpopulate.workqueue status
+
+Workers claim jobs with ``SELECT ... FOR UPDATE SKIP LOCKED``, so no two
+workers claim the same job, and the versions of a collection are
+populated one at a time in the order they were seeded (so the versions
+after one that failed are blocked, see ``WorkQueue.blocked``). A worker sends
+heartbeats while it populates a job. A job whose heartbeats stop, because
+its worker died, is retried by another worker, as is a job that failed,
+up to a number of attempts. Workers always record their progress
+(see ``checkpoint``), so a retried job picks up where it stopped.
+The collections' uuids are kept in the database, so every worker uses
+the same one for a collection.
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import logging
+import threading
+import uuid
+
+import psycopg2
+
+from .archive import (DEFAULT_PSYCOPG_CONNECTION_STRING, acquire_content,
+                      add_populate_arguments, check_populate_arguments,
+                      create_index_tables, create_worker_pool,
+                      make_populate, rollback_populate)
+from .batch import read_batch
+from .checkpoint import Checkpoint
+from .metrics import add_instrumentation_arguments, instrument
+
+
+__all__ = ('Job', 'JobLost', 'WorkQueue', 'Heartbeat', 'QueueWorker',)
+
+logger = logging.getLogger('populate')
+
+# Seconds between the heartbeats of a worker.
+HEARTBEAT_INTERVAL = 30
+# Seconds without a heartbeat before a job is taken to be abandoned.
+TIMEOUT = 300
+# Number of times a job is attempted before it is marked as failed.
+MAX_ATTEMPTS = 3
+# Seconds a worker waits for the jobs it is blocked on.
+POLL_INTERVAL = 10
+
+
+class Job(object):
+    """A version of a collection claimed from the ``WorkQueue``."""
+
+    def __init__(self, id, collection_id, version, attempts):
+        self.id = id
+        self.collection_id = collection_id
+        self.version = version
+        self.attempts = attempts
+
+    def __repr__(self):
+        return "<{} {} '{}' '{}'>".format(self.__class__.__name__, self.id,
+                                          self.collection_id, self.version)
+
+
+class WorkQueue(object):
+    """The work queue kept in the ``populate_jobs`` table of the database
+    ``psycopg_conn`` is connected to, along with the collections' uuids
+    in the ``populate_idents`` table. Each method runs and commits its
+    own transaction, so the connection is not to be used for anything
+    else.
+    A running job without a heartbeat for ``timeout`` seconds is taken
+    to be abandoned. A job is attempted at most ``max_attempts`` times.
+    """
+    jobs_table = 'populate_jobs'
+    idents_table = 'populate_idents'
+
+    def __init__(self, psycopg_conn, timeout=TIMEOUT,
+                 max_attempts=MAX_ATTEMPTS):
+        self.psycopg_conn = psycopg_conn
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+
+    def _execute(self, statement, args=None, fetch=None):
+        """Execute the ``statement`` in a transaction of its own. Returns
+        the first row when ``fetch`` is 'one' or all of them when 'all'.
+        """
+        with self.psycopg_conn:
+            with self.psycopg_conn.cursor() as cursor:
+                cursor.execute(statement.format(jobs=self.jobs_table,
+                                                idents=self.idents_table),
+                               args)
+                if fetch == 'one':
+                    return cursor.fetchone()
+                elif fetch == 'all':
+                    return cursor.fetchall()
+
+    def create_tables(self):
+        self._execute("CREATE TABLE IF NOT EXISTS {jobs} ("
+                      "  jobid SERIAL PRIMARY KEY,"
+                      "  collectionid TEXT NOT NULL,"
+                      "  version TEXT NOT NULL,"
+                      "  state TEXT NOT NULL DEFAULT 'pending',"
+                      "  attempts INTEGER NOT NULL DEFAULT 0,"
+                      "  worker TEXT,"
+                      "  heartbeat TIMESTAMP WITH TIME ZONE,"
+                      "  modules INTEGER,"
+                      "  error TEXT,"
+                      "  UNIQUE (collectionid, version)"
+                      ");"
+                      "CREATE TABLE IF NOT EXISTS {idents} ("
+                      "  collectionid TEXT PRIMARY KEY,"
+                      "  uuid UUID NOT NULL"
+                      ");")
+
+    def seed(self, entries):
+        """Add a job for each version of the collections of ``entries``
+        (see ``batch.read_batch``), unless it is already queued.
+        Returns the number of jobs added.
+        """
+        added = 0
+        for collection_id, versions in entries:
+            for version in versions:
+                row = self._execute(
+                    "INSERT INTO {jobs} (collectionid, version) "
+                    "SELECT %s, %s WHERE NOT EXISTS "
+                    "  (SELECT 1 FROM {jobs} WHERE collectionid = %s "
+                    "   AND version = %s) "
+                    "RETURNING jobid;",
+                    (collection_id, version, collection_id, version,),
+                    fetch='one')
+                added += row is not None and 1 or 0
+        return added
+
+    def reclaim(self):
+        """Return the abandoned jobs to the queue, or fail them when they
+        have used up their attempts. Returns the number of jobs reclaimed.
+        """
+        rows = self._execute(
+            "UPDATE {jobs} SET worker = NULL, "
+            "  state = CASE WHEN attempts < %s "
+            "    THEN 'pending' ELSE 'failed' END, "
+            "  error = 'Abandoned by ' || worker "
+            "WHERE state = 'running' "
+            "  AND heartbeat < now() - %s * interval '1 second' "
+            "RETURNING jobid;", (self.max_attempts, self.timeout,),
+            fetch='all')
+        for row in rows:
+            logger.warning("Reclaimed abandoned job {}.".format(row[0]))
+        return len(rows)
+
+    def claim(self, worker):
+        """Claim the next job for the ``worker`` (its name). A version
+        of a collection is only claimed once the versions seeded before
+        it are done. Returns the ``Job``, or None when there is none
+        to claim.
+        """
+        row = self._execute(
+            "UPDATE {jobs} SET state = 'running', worker = %s, "
+            "  attempts = attempts + 1, heartbeat = now() "
+            "WHERE jobid = ("
+            "  SELECT jobid FROM {jobs} j WHERE state = 'pending' "
+            "    AND NOT EXISTS (SELECT 1 FROM {jobs} e "
+            "      WHERE e.collectionid = j.collectionid "
+            "      AND e.jobid < j.jobid AND e.state <> 'done') "
+            "  ORDER BY jobid LIMIT 1 "
+            "  FOR UPDATE SKIP LOCKED) "
+            "RETURNING jobid, collectionid, version, attempts;",
+            (worker,), fetch='one')
+        if row is None:
+            return None
+        return Job(*row)
+
+    def heartbeat(self, job, worker):
+        """Beat for the ``job`` claimed by the ``worker``.
+        Returns whether the worker still holds the job.
+        """
+        row = self._execute(
+            "UPDATE {jobs} SET heartbeat = now() "
+            "WHERE jobid = %s AND worker = %s AND state = 'running' "
+            "RETURNING jobid;", (job.id, worker,), fetch='one')
+        return row is not None
+
+    def complete(self, job, worker, modules):
+        """Mark the ``job`` as done, having populated ``modules``.
+        Returns whether the worker still held the job.
+        """
+        row = self._execute(
+            "UPDATE {jobs} SET state = 'done', modules = %s, "
+            "  heartbeat = now(), error = NULL "
+            "WHERE jobid = %s AND worker = %s AND state = 'running' "
+            "RETURNING jobid;", (modules, job.id, worker,), fetch='one')
+        return row is not None
+
+    def fail(self, job, worker, error):
+        """Record the ``error`` of the ``job`` and return it to the
+        queue, or fail it when it has used up its attempts.
+        """
+        self._execute(
+            "UPDATE {jobs} SET worker = NULL, error = %s, "
+            "  state = CASE WHEN attempts < %s "
+            "    THEN 'pending' ELSE 'failed' END "
+            "WHERE jobid = %s AND worker = %s AND state = 'running';",
+            ('{}: {}'.format(type(error).__name__, error),
+             self.max_attempts, job.id, worker,))
+
+    def counts(self):
+        """The number of jobs in each state, the pending jobs that are
+        blocked (see ``blocked``) being counted as 'blocked'.
+        """
+        return dict(self._execute(
+            "SELECT CASE WHEN state = 'pending' AND EXISTS ("
+            "    SELECT 1 FROM {jobs} e "
+            "    WHERE e.collectionid = j.collectionid "
+            "    AND e.jobid < j.jobid AND e.state = 'failed') "
+            "  THEN 'blocked' ELSE state END, count(*) "
+            "FROM {jobs} j GROUP BY 1;", fetch='all'))
+
+    def blocked(self):
+        """The pending jobs that follow a failed version of their
+        collection, which are never claimed (see ``claim``).
+        Returns a list of ``Job``.
+        """
+        rows = self._execute(
+            "SELECT jobid, collectionid, version, attempts FROM {jobs} j "
+            "WHERE state = 'pending' AND EXISTS ("
+            "  SELECT 1 FROM {jobs} e "
+            "  WHERE e.collectionid = j.collectionid "
+            "  AND e.jobid < j.jobid AND e.state = 'failed') "
+            "ORDER BY jobid;", fetch='all')
+        return [Job(*row) for row in rows]
+
+    def ident_uuid(self, collection_id):
+        """Retrieve the uuid of the collection, which is made on first
+        use and then shared by all the workers.
+        """
+        try:
+            self._execute("INSERT INTO {idents} (collectionid, uuid) "
+                          "SELECT %s, %s WHERE NOT EXISTS "
+                          "  (SELECT 1 FROM {idents} "
+                          "   WHERE collectionid = %s);",
+                          (collection_id, str(uuid.uuid4()), collection_id,))
+        except psycopg2.IntegrityError:
+            # Another worker made it first.
+            pass
+        row = self._execute("SELECT uuid FROM {idents} "
+                            "WHERE collectionid = %s;", (collection_id,),
+                            fetch='one')
+        return uuid.UUID(str(row[0]))
+
+
+class JobLost(Exception):
+    """Raised when the job being populated has been reclaimed
+    by another worker."""
+
+
+class Heartbeat(object):
+    """Beat for a claimed ``job`` every ``interval`` seconds from
+    a background thread, using a ``WorkQueue`` of its own connection.
+    ``lost`` is set when the job is found to have been reclaimed.
+    """
+
+    def __init__(self, queue, job, worker, interval=HEARTBEAT_INTERVAL):
+        self.queue = queue
+        self.job = job
+        self.worker = worker
+        self.interval = interval
+        self.lost = False
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                if not self.queue.heartbeat(self.job, self.worker):
+                    logger.warning("Lost job {} to another worker." \
+                                   .format(self.job.id))
+                    self.lost = True
+                    return
+            except Exception:
+                logger.exception("Failed to send a heartbeat.")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+
+
+class _GuardedConnection(object):
+    """A psycopg2 connection that is only committed while the job of
+    the ``heartbeat`` is still held, and is otherwise rolled back with
+    ``JobLost`` raised. Population commits between modules, so a worker
+    that has lost its job stops at the next module, rather than populating
+    the job alongside the worker that reclaimed it. (The modules committed
+    by the workers of a pool aren't guarded.)
+    """
+
+    def __init__(self, psycopg_conn, heartbeat):
+        self.psycopg_conn = psycopg_conn
+        self.heartbeat = heartbeat
+
+    def __getattr__(self, name):
+        return getattr(self.psycopg_conn, name)
+
+    def _check(self):
+        if self.heartbeat.lost:
+            self.psycopg_conn.rollback()
+            raise JobLost("Job {} was reclaimed by another worker." \
+                          .format(self.heartbeat.job.id))
+
+    def commit(self):
+        self._check()
+        self.psycopg_conn.commit()
+
+    def __enter__(self):
+        self.psycopg_conn.__enter__()
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self._check()
+        return self.psycopg_conn.__exit__(exc_type, *exc_info)
+
+
+class QueueWorker(object):
+    """Populates the jobs claimed from the work queue. ``connect`` is
+    called to make each of the database connections the worker uses:
+    one for the queue, one for the heartbeats and one to populate with.
+    ``populate`` populates a location (see ``archive.make_populate``),
+    which is to record its progress, so that a retried job resumes.
+    ``acquire`` is called with the collection id and version of a job
+    to acquire its content (see ``archive.acquire_content``) and returns
+    its location.
+    """
+
+    def __init__(self, connect, populate, acquire, name=None,
+                 timeout=TIMEOUT, max_attempts=MAX_ATTEMPTS,
+                 heartbeat_interval=HEARTBEAT_INTERVAL,
+                 poll_interval=POLL_INTERVAL):
+        self.connect = connect
+        self.populate = populate
+        self.acquire = acquire
+        self.name = name or '{}:{}'.format(socket.gethostname(),
+                                           os.getpid())
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.heartbeat_interval = heartbeat_interval
+        self.poll_interval = poll_interval
+
+    def _queue(self):
+        return WorkQueue(self.connect(), self.timeout, self.max_attempts)
+
+    def run_job(self, queue, job, psycopg_conn):
+        """Populate the ``job`` and mark it as done, or as failed when
+        it raises. A job that is reclaimed while it populates is rolled
+        back and abandoned to the worker that reclaimed it.
+        Returns whether it populated.
+        """
+        logger.info("Populating '{}' version '{}' (attempt {})." \
+                    .format(job.collection_id, job.version, job.attempts))
+        heartbeat_queue = self._queue()
+        try:
+            with Heartbeat(heartbeat_queue, job, self.name,
+                           self.heartbeat_interval) as heartbeat:
+                location = self.acquire(job.collection_id, job.version)
+                ident_mappings = {
+                    job.collection_id: queue.ident_uuid(job.collection_id)}
+                guarded_conn = _GuardedConnection(psycopg_conn, heartbeat)
+                with guarded_conn:
+                    modules = self.populate(location, ident_mappings,
+                                            guarded_conn)
+        except JobLost:
+            logger.warning("Abandoned job {}, which was reclaimed before "
+                           "it completed.".format(job.id))
+            rollback_populate(self.populate)
+            return False
+        except Exception as exc:
+            logger.exception("Failed to populate '{}' version '{}'." \
+                             .format(job.collection_id, job.version))
+            rollback_populate(self.populate)
+            queue.fail(job, self.name, exc)
+            return False
+        finally:
+            heartbeat_queue.psycopg_conn.close()
+        if not queue.complete(job, self.name, modules or 0):
+            logger.warning("Job {} was reclaimed before it completed." \
+                           .format(job.id))
+        return True
+
+    def run(self, wait=True):
+        """Claim and populate jobs until there are none left to claim.
+        When ``wait`` is true the worker waits while the jobs it could
+        claim are blocked on the running jobs of other workers. The jobs
+        left blocked on failed jobs (see ``WorkQueue.blocked``) are logged.
+        Returns the number of jobs populated.
+        """
+        queue = self._queue()
+        psycopg_conn = self.connect()
+        populated = 0
+        try:
+            while True:
+                queue.reclaim()
+                job = queue.claim(self.name)
+                if job is None:
+                    if not wait or not queue.counts().get('running'):
+                        break
+                    time.sleep(self.poll_interval)
+                    continue
+                if self.run_job(queue, job, psycopg_conn):
+                    populated += 1
+            for job in queue.blocked():
+                logger.warning("Job {} of '{}' version '{}' is blocked on "
+                               "a failed version of the collection." \
+                               .format(job.id, job.collection_id,
+                                       job.version))
+        finally:
+            psycopg_conn.close()
+            queue.psycopg_conn.close()
+        return populated
+
+
+def format_status(counts):
+    """Format the number of jobs in each state (see ``WorkQueue.counts``)."""
+    states = ('pending', 'running', 'done', 'failed', 'blocked',)
+    return ', '.join(['{} {}'.format(counts.get(state, 0), state)
+                      for state in states])
+
+
+def main(argv=None):
+    """Main commandline interface"""
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--timeout', type=int, default=TIMEOUT,
+                        help="seconds without a heartbeat before a job is "
+                             "retried (default: %(default)s)")
+    parser.add_argument('--max-attempts', type=int, default=MAX_ATTEMPTS,
+                        help="number of times a job is attempted "
+                             "(default: %(default)s)")
+    subparsers = parser.add_subparsers(dest='command')
+
+    seed_parser = subparsers.add_parser(
+        'seed', help="queue the collections of a batch file")
+    seed_parser.add_argument('batch_file', nargs='?',
+                             type=argparse.FileType('r'), default=sys.stdin,
+                             help="the collections to queue (default: stdin)")
+    status_parser = subparsers.add_parser(
+        'status', help="show the number of jobs in each state")
+    work_parser = subparsers.add_parser(
+        'work', help="populate jobs until there are none left")
+    work_parser.add_argument('--no-wait', dest='wait', action='store_false',
+                             help="exit rather than wait for jobs blocked "
+                                  "on other workers")
+    work_parser.add_argument('--heartbeat-interval', type=int,
+                             default=HEARTBEAT_INTERVAL,
+                             help="seconds between heartbeats "
+                                  "(default: %(default)s)")
+    add_populate_arguments(work_parser)
+    add_instrumentation_arguments(work_parser)
+    # The seed and status commands only need the connection string.
+    for subparser in (seed_parser, status_parser,):
+        subparser.add_argument('-p', '--psycopg-conn-str',
+                               default=DEFAULT_PSYCOPG_CONNECTION_STRING,
+                               help="a psycopg2 connection string")
+    args = parser.parse_args(argv)
+
+    connect = lambda: psycopg2.connect(args.psycopg_conn_str)
+    queue = WorkQueue(connect(), args.timeout, args.max_attempts)
+    queue.create_tables()
+    if args.command == 'seed':
+        added = queue.seed(read_batch(args.batch_file))
+        print("Queued {} jobs.".format(added))
+        return 0
+    elif args.command == 'status':
+        print(format_status(queue.counts()))
+        return 0
+
+    check_populate_arguments(work_parser, args)
+    # Progress is always recorded, so that a retried job resumes.
+    create_index_tables(args.psycopg_conn_str, args.dedupe_files,
+                        args.dedupe_abstracts)
+    pool = None
+    if args.workers > 1:
+        pool = create_worker_pool(args.workers, args.psycopg_conn_str,
+                                  args.dedupe_files, args.stream_threshold,
+                                  True, args.dedupe_abstracts,
+                                  args.prepare and args.batch_size or None,
+                                  args.parse_cache, args.parse_cache_size)
+    populate = make_populate(args, pool, Checkpoint())
+
+    def acquire(collection_id, version):
+        locations = acquire_content(collection_id, [version],
+                                    host=args.legacy_url,
+                                    output_dir=os.getcwd(),
+                                    extract=args.extract)
+        return next(iter(locations))
+
+    worker = QueueWorker(connect, populate, acquire,
+                         timeout=args.timeout,
+                         max_attempts=args.max_attempts,
+                         heartbeat_interval=args.heartbeat_interval)
+    try:
+        with instrument(args):
+            populated = worker.run(args.wait)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    counts = queue.counts()
+    print("Populated {} jobs; {}.".format(populated, format_status(counts)))
+    return counts.get('failed') and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())